@@ -19,7 +19,11 @@ class Config:
         self._fernet = None
         self.default_config = {
             "woocommerce": {"base_url": "", "consumer_key": "", "consumer_secret": ""},
-            "app": {"sync_interval": 60, "per_page": 100, "first_run": True},
+            "app": {"sync_interval": 60, "per_page": 100, "first_run": True, "archive_after_days": 730, "sync_concurrency": 4,
+                    "http_pool_size": 10, "http_retries": 3, "http_connect_timeout": 10, "http_timeout": 60,
+                    "rate_limit": 4.0, "rate_limit_max": 20.0, "reconcile_interval": 900,
+                    "traveler_concurrency": 4},
+            "webhook": {"enabled": False, "host": "127.0.0.1", "port": 8765, "path": "/webhook", "secret": ""},
         }
         self._load_or_create_config()
     def get_database_path(self) -> str: return self.db_file
@@ -3,135 +3,1315 @@
 """
 Database Manager SQLite per Gestionale Gitemania PORTABLE (Versione con statistiche complete)
 """
-import sqlite3, json, hashlib, os, threading
+import sqlite3, json, hashlib, os, threading, zlib, queue, time, copy, gzip, shutil
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
-from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
 from config import config
 
+ORDER_COLUMNS = ('woo_id', 'order_number', 'status', 'currency', 'total', 'total_tax', 'shipping_total', 'customer_id', 'customer_email', 'customer_name', 'billing_data', 'shipping_data', 'line_items', 'shipping_lines', 'payment_method', 'payment_method_title', 'date_created', 'date_modified', 'date_completed', 'raw_data', 'hash_signature')
+
+# Chiavi del JSON WooCommerce già salvate in colonne dedicate: in raw_data non vengono ripetute
+RAW_DATA_SPLIT_FIELDS = {'billing': 'billing_data', 'shipping': 'shipping_data', 'line_items': 'line_items', 'shipping_lines': 'shipping_lines'}
+RAW_FORMAT_ZLIB, RAW_FORMAT_ZLIB_DICT = 1, 2  # primo byte del BLOB raw_data
+_compression_dicts = {}  # crc32 -> dizionario zlib preimpostato (caricati da DatabaseManager)
+
+def compress_raw_data(order_data: dict, zdict: bytes = None) -> bytes:
+    """Comprime il JSON completo dell'ordine, esclusi i campi già presenti nelle colonne dedicate."""
+    payload = json.dumps({k: v for k, v in order_data.items() if k not in RAW_DATA_SPLIT_FIELDS}, separators=(',', ':')).encode()
+    if not zdict: return bytes([RAW_FORMAT_ZLIB]) + zlib.compress(payload, 9)
+    compressor = zlib.compressobj(9, zdict=zdict)
+    return bytes([RAW_FORMAT_ZLIB_DICT]) + zlib.crc32(zdict).to_bytes(4, 'big') + compressor.compress(payload) + compressor.flush()
+
+def decompress_raw_data(blob: bytes) -> dict:
+    if blob[0] == RAW_FORMAT_ZLIB: return json.loads(zlib.decompress(blob[1:]))
+    if blob[0] == RAW_FORMAT_ZLIB_DICT:
+        decompressor = zlib.decompressobj(zdict=_compression_dicts[int.from_bytes(blob[1:5], 'big')])
+        return json.loads(decompressor.decompress(blob[5:]) + decompressor.flush())
+    raise ValueError(f"Formato raw_data sconosciuto: {blob[0]}")
+
+class OrderRecord:
+    """
+    Riga della tabella orders con __slots__: le colonne scalari sono attributi, i campi JSON
+    vengono decodificati solo al primo accesso. Supporta l'accesso stile dict (get, [], in)
+    usato da viste ed export; le colonne non selezionate risultano semplicemente assenti.
+    """
+    JSON_FIELDS = frozenset(('billing_data', 'shipping_data', 'line_items', 'shipping_lines', 'raw_data'))
+    __slots__ = ('id',) + ORDER_COLUMNS + ('_extra',)
+
+    def __init__(self, columns, values):
+        for name, value in zip(columns, values): setattr(self, name, value)
+
+    def __getitem__(self, key: str):
+        try:
+            if key in self.JSON_FIELDS: return self._decode(key)
+            return getattr(self, key) if key in self.__slots__ else self._extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value):
+        if key in self.__slots__ and key != '_extra': setattr(self, key, value)
+        else:
+            try: self._extra[key] = value
+            except AttributeError: self._extra = {key: value}
+
+    def __contains__(self, key: str) -> bool:
+        try: self[key]; return True
+        except KeyError: return False
+
+    def get(self, key: str, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def keys(self) -> List[str]:
+        names = [name for name in self.__slots__[:-1] if hasattr(self, name)]
+        return names + list(getattr(self, '_extra', {}))
+
+    def to_dict(self) -> dict:
+        return {key: self[key] for key in self.keys()}
+
+    def _decode(self, field: str):
+        value = getattr(self, field)  # AttributeError se la colonna non è stata selezionata
+        if value and isinstance(value, (str, bytes)):
+            try:
+                if isinstance(value, bytes):
+                    # raw_data compresso: si ricompone con i campi salvati nelle colonne dedicate
+                    value = decompress_raw_data(value)
+                    for key, column in RAW_DATA_SPLIT_FIELDS.items():
+                        if key not in value and hasattr(self, column): value[key] = self._decode(column)
+                else:
+                    value = json.loads(value)
+            except (ValueError, KeyError, TypeError, zlib.error):
+                print(f"⚠️ Warning: Impossibile decodificare il campo JSON '{field}' per l'ordine ID {getattr(self, 'woo_id', None)}")
+                value = {}
+            setattr(self, field, value)
+        return value
+
+    def __repr__(self) -> str:
+        return f"OrderRecord(woo_id={getattr(self, 'woo_id', None)!r}, status={getattr(self, 'status', None)!r})"
+
 class DatabaseManager:
-    def __init__(self):
-        self.db_path = config.get_database_path()
-        self.lock = threading.Lock()
+    # PRAGMA applicati una sola volta all'apertura di ogni connessione persistente
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",       # sicuro in WAL, evita un fsync per commit
+        "PRAGMA cache_size=-16000",        # ~16 MB di page cache per connessione
+        "PRAGMA mmap_size=268435456",      # letture via memory-map fino a 256 MB
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+    SQL_CHUNK_SIZE = 500  # parametri massimi per clausola IN (...)
+    WRITE_QUEUE_SIZE = 32         # batch in attesa oltre i quali chi scrive viene rallentato (backpressure)
+    COALESCE_MAX_ORDERS = 2000    # ordini massimi raggruppati in un'unica transazione
+    COALESCE_WINDOW = 0.02        # secondi di attesa per raccogliere altri batch nella stessa transazione
+    RESULT_CACHE_SIZE = 64        # risultati di viste/statistiche tenuti in memoria (LRU)
+    BACKLOG_STATUSES = ('pending', 'processing')  # ordini ancora da evadere
+    KPI_PERIODS = ('day', 'week', 'month', 'ytd')
+    ARCHIVE_STATUSES = ('completed', 'cancelled', 'refunded', 'failed')  # stati finali archiviabili
+    ARCHIVE_AFTER_DAYS = 730      # età predefinita oltre la quale un ordine finale passa in archivio
+    MAINTENANCE_TIME_BUDGET = 5.0  # secondi massimi di manutenzione per ogni pausa del polling
+    MAINTENANCE_INTERVALS = {'optimize': 3600, 'incremental_vacuum': 3600, 'wal_checkpoint': 0, 'integrity_check': 86400}  # secondi tra due esecuzioni
+    VACUUM_STEP_PAGES = 512        # pagine liberate per ogni passo di incremental_vacuum
+    MAINTENANCE_LOG_KEEP = 50      # righe di maintenance_log conservate per ogni attività
+    BULK_BATCH_SIZE = 5000         # ordini per executemany durante l'import massivo
+    BULK_DEFERRED_INDEXES = ('idx_orders_date_woo', 'idx_orders_customer_key', 'idx_order_items_product_order', 'idx_order_items_name')
+    MODIFIED_AFTER_KEY = 'orders_modified_after'  # sync_state: ordine modificato più di recente già in locale
+    FULL_SYNC_KEY = 'orders_full_sync'  # sync_state: ultimo download completo dello storico dal negozio (sync completa)
+    BACKUP_STEP_PAGES = 256        # pagine copiate per passo di backup (qualche ms di lavoro per lo scrittore)
+    BACKUP_KEEP = 7                # snapshot compressi conservati a rotazione
+    TRAVELER_RETRY_BASE = 600      # secondi prima di riprovare un download viaggiatori fallito, raddoppiati a ogni errore
+    TRAVELER_RETRY_MAX = 86400
+    ORDER_COLUMNS = ORDER_COLUMNS
+    # Colonne sufficienti per le viste elenco (niente JSON né raw_data)
+    LIST_COLUMNS = ('woo_id', 'order_number', 'status', 'total', 'customer_name', 'customer_email', 'date_created', 'payment_method_title')
+    _UPSERT_SQL = (f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) VALUES ({', '.join('?' * len(ORDER_COLUMNS))}) "
+                   f"ON CONFLICT(woo_id) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in ORDER_COLUMNS[1:])} "
+                   "WHERE orders.hash_signature IS NOT excluded.hash_signature")
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or config.get_database_path()
+        self.archive_path = os.path.splitext(self.db_path)[0] + '_archive.db'  # ordini storici (file "freddo")
+        self._writer_conn = None
+        self._write_queue = queue.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+        self._writer_thread = None
+        self._pending_writes = deque()  # job già estratti dalla coda ma da eseguire per primi
+        self._writer_start_lock = threading.Lock()
+        self._readers = {}  # ident thread -> connessione di sola lettura
+        self._readers_lock = threading.Lock()
+        self.fts_enabled = False
+        self._compression_dict = None  # dizionario zlib attivo per i nuovi raw_data
+        self._generation = 0  # incrementata a ogni commit che modifica davvero gli ordini
+        self._result_cache = OrderedDict()  # chiave normalizzata -> (generazione, risultato)
+        self._cache_lock = threading.Lock()
+        self._checkpointed_changes = None  # total_changes dello scrittore dopo l'ultimo checkpoint registrato
         self._initialize_database()
-        
+
+    def _open_connection(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False, isolation_level=None)
+        if not read_only:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  # effettivo sui database nuovi o dopo un VACUUM completo
+            conn.execute("PRAGMA journal_mode=WAL")
+        for pragma in self.CONNECTION_PRAGMAS: conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def _get_reader(self) -> sqlite3.Connection:
+        """Connessione di lettura dedicata al thread corrente (in WAL non attende mai lo scrittore)."""
+        ident = threading.get_ident()
+        conn = self._readers.get(ident)
+        if conn is None:
+            conn = self._open_connection(read_only=True)
+            with self._readers_lock:
+                alive = {t.ident for t in threading.enumerate()}
+                for dead in [i for i in self._readers if i not in alive]: self._readers.pop(dead).close()
+                self._readers[ident] = conn
+        return conn
+
+    # --- Thread scrittore unico ---------------------------------------------------------------
+    # Tutte le scritture passano da una coda limitata verso un solo thread che possiede la
+    # connessione di scrittura: i batch di ingest vicini vengono uniti in una transazione e
+    # chi scrive riceve un Future; con la coda piena il chiamante attende (backpressure).
+
+    def submit_orders(self, orders_data: List[dict], watermark_key: str = None, columns: Tuple[str, ...] = None, newer_only: bool = False) -> Future:
+        """Accoda un batch di ordini; il Future restituisce (inseriti, aggiornati) dopo il commit.
+        Con watermark_key il segnalibro in sync_state avanza alla date_modified più recente del batch
+        nella stessa transazione delle righe: se il batch fallisce, il segnalibro non si muove.
+        'columns' indica ordini parziali (proiezione _fields): vedi _ingest_partial.
+        Con newer_only gli ordini con date_modified anteriore a quella locale vengono scartati (consegne
+        webhook ripetute o fuori ordine non devono sovrascrivere una versione più recente)."""
+        if columns is not None: columns = self._partial_columns(columns)
+        return self._submit('ingest', (list(orders_data), watermark_key, columns, newer_only))
+
+    def _execute_write(self, func, transaction: bool = True):
+        """Esegue func(conn) sul thread scrittore, in una transazione propria se richiesto, e ne restituisce il risultato."""
+        if threading.current_thread() is self._writer_thread:
+            return self._run_write_call(self._writer_conn, func, transaction)
+        return self._submit('call', (func, transaction)).result()
+
+    def _submit(self, kind: str, payload) -> Future:
+        with self._writer_start_lock:
+            if self._writer_thread is None or not self._writer_thread.is_alive():
+                self._writer_thread = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer_thread.start()
+        future = Future()
+        self._write_queue.put((kind, payload, future))
+        return future
+
+    def _writer_loop(self):
+        if self._writer_conn is None: self._writer_conn = self._open_connection()
+        conn = self._writer_conn
+        pending = self._pending_writes
+        while True:
+            job = pending.popleft() if pending else self._write_queue.get()
+            if job is None: return
+            kind, payload, future = job
+            if kind != 'ingest':
+                try: future.set_result(self._run_write_call(conn, *payload))
+                except Exception as e: future.set_exception(e)
+                continue
+            # Raccoglie altri batch già in coda (o in arrivo entro COALESCE_WINDOW) nella stessa transazione
+            jobs, size = [job], len(payload[0])
+            deadline = time.monotonic() + self.COALESCE_WINDOW
+            while size < self.COALESCE_MAX_ORDERS:
+                try: next_job = self._write_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty: break
+                if next_job is None or next_job[0] != 'ingest':
+                    pending.append(next_job); break
+                jobs.append(next_job); size += len(next_job[1][0])
+            self._run_ingest_jobs(conn, jobs)
+
+    def _run_write_call(self, conn: sqlite3.Connection, func, transaction: bool):
+        if not transaction: return func(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _run_ingest_jobs(self, conn: sqlite3.Connection, jobs: List[tuple]):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for _, (orders_data, watermark_key, columns, newer_only), future in jobs:
+                # Un batch con dati non validi viene annullato da solo, senza perdere gli altri
+                conn.execute("SAVEPOINT ingest_job")
+                try:
+                    result = self._ingest_partial(conn, orders_data, columns) if columns else self._ingest_batch(conn, orders_data, newer_only)
+                    newest = self._newest_modified(orders_data)
+                    if watermark_key and newest: self._advance_sync_state(conn, watermark_key, newest)
+                    outcomes.append((future, result, None))
+                    conn.execute("RELEASE ingest_job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO ingest_job"); conn.execute("RELEASE ingest_job")
+                    outcomes.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            for _, _, future in jobs: future.set_exception(e)
+            return
+        if any(result and any(result) for _, result, _ in outcomes): self._bump_generation()
+        for future, result, error in outcomes:
+            if error is None: future.set_result(result)
+            else: future.set_exception(error)
+
+    # --- Cache dei risultati ------------------------------------------------------------------
+    # Viste e statistiche ripetute (ad esempio a ogni "refresh_view") vengono servite dalla memoria
+    # finché la generazione dei dati non cambia; la generazione avanza solo dopo un commit che ha
+    # inserito o aggiornato righe.
+
+    @property
+    def data_generation(self) -> int:
+        return self._generation
+
+    def _bump_generation(self):
+        with self._cache_lock:
+            self._generation += 1
+            self._result_cache.clear()
+
+    def _cached(self, key: tuple, compute):
+        with self._cache_lock:
+            entry = self._result_cache.get(key)
+            if entry is not None and entry[0] == self._generation:
+                self._result_cache.move_to_end(key)
+                return entry[1]
+            generation = self._generation  # letta prima della query: un commit concorrente invalida il risultato
+        result = compute()
+        with self._cache_lock:
+            if generation == self._generation:
+                self._result_cache[key] = (generation, result)
+                self._result_cache.move_to_end(key)
+                while len(self._result_cache) > self.RESULT_CACHE_SIZE: self._result_cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _filters_key(filters: dict) -> tuple:
+        """Filtri equivalenti (valori vuoti, spazi e maiuscole nella ricerca) producono la stessa chiave."""
+        if not filters: return ()
+        normalized = {k: v for k, v in filters.items() if v not in (None, '', 0)}
+        if 'search_term' in normalized: normalized['search_term'] = ' '.join(str(normalized['search_term']).lower().split())
+        return tuple(sorted(normalized.items()))
+
+    def close(self):
+        if self._writer_thread is not None and self._writer_thread.is_alive():
+            self._write_queue.put(None)
+            self._writer_thread.join(timeout=10)
+        if self._writer_conn is not None: self._writer_conn.close(); self._writer_conn = None
+        self._checkpointed_changes = None
+        with self._readers_lock:
+            for conn in self._readers.values(): conn.close()
+            self._readers.clear()
+
     def _initialize_database(self):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS orders (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT, woo_id INTEGER UNIQUE NOT NULL, 
-                        order_number TEXT, status TEXT, currency TEXT, total REAL, 
-                        total_tax REAL, shipping_total REAL, customer_id INTEGER, 
-                        customer_email TEXT, customer_name TEXT, billing_data TEXT, 
-                        shipping_data TEXT, line_items TEXT, shipping_lines TEXT, 
-                        payment_method TEXT, payment_method_title TEXT, date_created TEXT, 
-                        date_modified TEXT, date_completed TEXT, raw_data TEXT, 
-                        hash_signature TEXT
-                    )
-                ''')
-                conn.commit()
+            self._execute_write(self._create_schema)
         except Exception as e:
             print(f"❌ Errore inizializzazione database: {e}")
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, woo_id INTEGER UNIQUE NOT NULL, 
+                order_number TEXT, status TEXT, currency TEXT, total REAL, 
+                total_tax REAL, shipping_total REAL, customer_id INTEGER, 
+                customer_email TEXT, customer_name TEXT, billing_data TEXT, 
+                shipping_data TEXT, line_items TEXT, shipping_lines TEXT, 
+                payment_method TEXT, payment_method_title TEXT, date_created TEXT, 
+                date_modified TEXT, date_completed TEXT, raw_data TEXT, 
+                hash_signature TEXT
+            )
+        ''')
+        cursor.execute("DROP INDEX IF EXISTS idx_orders_date_created")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_date_woo ON orders(date_created, woo_id)")  # chiave della paginazione keyset
+        items_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'order_items'").fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, woo_id INTEGER NOT NULL,
+                product_id INTEGER, variation_id INTEGER, name TEXT,
+                quantity INTEGER, subtotal REAL, total REAL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_woo_id ON order_items(woo_id)")
+        # Mappa prodotto → ordini: l'indice copre anche woo_id, le liste clienti non leggono la tabella
+        cursor.execute("DROP INDEX IF EXISTS idx_order_items_product")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product_order ON order_items(product_id, woo_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_name ON order_items(name)")
+        if not items_exist:
+            # Migrazione una tantum: esplode i line_items JSON degli ordini già presenti
+            cursor.execute('''
+                INSERT INTO order_items (woo_id, product_id, variation_id, name, quantity, subtotal, total)
+                SELECT o.woo_id, json_extract(j.value, '$.product_id'), json_extract(j.value, '$.variation_id'),
+                       json_extract(j.value, '$.name'), json_extract(j.value, '$.quantity'),
+                       CAST(json_extract(j.value, '$.subtotal') AS REAL), CAST(json_extract(j.value, '$.total') AS REAL)
+                FROM orders o, json_each(o.line_items) j WHERE json_valid(o.line_items)
+            ''')
+        rollups_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_status_rollup'").fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_status_rollup (
+                day TEXT NOT NULL, status TEXT NOT NULL, order_count INTEGER NOT NULL,
+                revenue REAL NOT NULL, tax REAL NOT NULL, shipping REAL NOT NULL,
+                PRIMARY KEY (day, status)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_product_rollup (
+                day TEXT NOT NULL, product_id INTEGER NOT NULL, name TEXT NOT NULL,
+                order_count INTEGER NOT NULL, quantity INTEGER NOT NULL, revenue REAL NOT NULL,
+                PRIMARY KEY (day, product_id, name)
+            ) WITHOUT ROWID
+        ''')
+        if not rollups_exist: self._apply_rollups(conn, "1", [], 1)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_customer_key ON orders(lower(trim(customer_email)))")
+        customers_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'customers'").fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS customers (
+                email TEXT PRIMARY KEY, customer_name TEXT, phone TEXT,
+                purchase_count INTEGER NOT NULL, total_spent REAL NOT NULL,
+                first_purchase TEXT, last_purchase TEXT
+            ) WITHOUT ROWID
+        ''')
+        if not customers_exist: self._refresh_customers(conn, None)
+        self.fts_enabled = self._create_search_index(cursor)
+        cursor.execute("CREATE TABLE IF NOT EXISTS compression_dicts (id INTEGER PRIMARY KEY, data BLOB NOT NULL, created_at TEXT)")
+        for dict_id, data in cursor.execute("SELECT id, data FROM compression_dicts ORDER BY created_at"):
+            _compression_dicts[dict_id] = data; self._compression_dict = data
+        cursor.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT, updated_at TEXT) WITHOUT ROWID")
+        # Dati viaggiatori (endpoint gitemania/v1) con l'hash dell'ordine per cui sono stati scaricati
+        cursor.execute("CREATE TABLE IF NOT EXISTS order_travelers (woo_id INTEGER PRIMARY KEY, order_hash TEXT, travelers TEXT NOT NULL, fetched_at TEXT)")
+        # Download falliti per una versione dell'ordine: esclusi dalla coda fino a retry_after (backoff esponenziale)
+        cursor.execute("CREATE TABLE IF NOT EXISTS traveler_failures (woo_id INTEGER PRIMARY KEY, order_hash TEXT, attempts INTEGER NOT NULL, retry_after TEXT NOT NULL)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT NOT NULL, started_at TEXT NOT NULL,
+                duration REAL, bytes_reclaimed INTEGER, result TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_log_task ON maintenance_log(task, started_at)")
+
+    def _create_search_index(self, cursor: sqlite3.Cursor) -> bool:
+        """Indice FTS5 (trigram) su numero ordine, nome ed email, allineato a 'orders' tramite trigger."""
+        try:
+            exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'orders_fts'").fetchone()
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(order_number, customer_name, customer_email, content='orders', content_rowid='id', tokenize='trigram')")
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_ai AFTER INSERT ON orders BEGIN
+                INSERT INTO orders_fts(rowid, order_number, customer_name, customer_email) VALUES (new.id, new.order_number, new.customer_name, new.customer_email);
+            END''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_ad AFTER DELETE ON orders BEGIN
+                INSERT INTO orders_fts(orders_fts, rowid, order_number, customer_name, customer_email) VALUES ('delete', old.id, old.order_number, old.customer_name, old.customer_email);
+            END''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_au AFTER UPDATE OF order_number, customer_name, customer_email ON orders BEGIN
+                INSERT INTO orders_fts(orders_fts, rowid, order_number, customer_name, customer_email) VALUES ('delete', old.id, old.order_number, old.customer_name, old.customer_email);
+                INSERT INTO orders_fts(rowid, order_number, customer_name, customer_email) VALUES (new.id, new.order_number, new.customer_name, new.customer_email);
+            END''')
+            if not exists: cursor.execute("INSERT INTO orders_fts(orders_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ Indice full-text non disponibile, ricerca con LIKE: {e}")
+            return False
             
     def sync_order(self, order_data: dict):
         self.sync_multiple_orders([order_data])
 
     def sync_multiple_orders(self, orders_data: List[dict]) -> Tuple[int, int]:
-        with self.lock:
-            to_insert, to_update = [], []
+        try:
+            return self.submit_orders(orders_data).result()
+        except Exception as e:
+            print(f"❌ Errore durante la sincronizzazione in blocco: {e}")
+            return 0, 0
+
+    def delete_orders(self, woo_ids: List[int]) -> int:
+        """Elimina ordini cancellati sul negozio (es. webhook order.deleted) togliendone il contributo dagli
+        aggregati, anche dall'archivio storico se presente. Restituisce il numero di ordini eliminati."""
+        def delete(conn: sqlite3.Connection) -> int:
+            archived = os.path.exists(self.archive_path)
+            if archived:
+                conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+                self._create_archive_schema(conn)
             try:
-                with sqlite3.connect(self.db_path) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('SELECT woo_id, hash_signature FROM orders')
-                    existing_orders = {row[0]: row[1] for row in cursor.fetchall()}
-                    for order in orders_data:
-                        order_hash = self._calculate_order_hash(order)
-                        order_tuple = tuple(self._extract_order_data(order, order_hash).values())
-                        woo_id = order.get('id')
-                        if woo_id not in existing_orders:
-                            to_insert.append(order_tuple)
-                        elif existing_orders[woo_id] != order_hash:
-                            to_update.append(order_tuple[1:] + (order_tuple[0],))
-                    if to_insert:
-                        cursor.executemany('INSERT INTO orders (woo_id, order_number, status, currency, total, total_tax, shipping_total, customer_id, customer_email, customer_name, billing_data, shipping_data, line_items, shipping_lines, payment_method, payment_method_title, date_created, date_modified, date_completed, raw_data, hash_signature) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', to_insert)
-                    if to_update:
-                        cursor.executemany('UPDATE orders SET order_number=?, status=?, currency=?, total=?, total_tax=?, shipping_total=?, customer_id=?, customer_email=?, customer_name=?, billing_data=?, shipping_data=?, line_items=?, shipping_lines=?, payment_method=?, payment_method_title=?, date_created=?, date_modified=?, date_completed=?, raw_data=?, hash_signature=? WHERE woo_id = ?', to_update)
-                    conn.commit()
-                    return len(to_insert), len(to_update)
-            except Exception as e:
-                print(f"❌ Errore durante la sincronizzazione in blocco: {e}")
-                return 0, 0
-                
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    stale_customers = self._retract_aggregates(conn, woo_ids)
+                    deleted = set()
+                    for chunk, marks in self._chunked(woo_ids):
+                        conn.execute(f"DELETE FROM main.order_items WHERE woo_id IN ({marks})", chunk)
+                        conn.execute(f"DELETE FROM main.order_travelers WHERE woo_id IN ({marks})", chunk)
+                        conn.execute(f"DELETE FROM main.traveler_failures WHERE woo_id IN ({marks})", chunk)
+                        deleted.update(row[0] for row in conn.execute(f"SELECT woo_id FROM main.orders WHERE woo_id IN ({marks})", chunk))
+                        conn.execute(f"DELETE FROM main.orders WHERE woo_id IN ({marks})", chunk)
+                        if not archived: continue
+                        # Gli ordini archiviati sono già fuori da rollup e clienti: basta toglierli dall'archivio
+                        conn.execute(f"DELETE FROM archive.order_items WHERE woo_id IN ({marks})", chunk)
+                        deleted.update(row[0] for row in conn.execute(f"SELECT woo_id FROM archive.orders WHERE woo_id IN ({marks})", chunk))
+                        conn.execute(f"DELETE FROM archive.orders WHERE woo_id IN ({marks})", chunk)
+                    self._refresh_customers(conn, stale_customers)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                if archived: conn.execute("DETACH DATABASE archive")  # la sincronizzazione non deve mai vedere l'archivio
+            return len(deleted)
+        deleted = self._execute_write(delete, transaction=False)
+        if deleted: self._bump_generation()
+        return deleted
+
+    # --- Dati viaggiatori ----------------------------------------------------------------------
+    # Scaricati in background per gli ordini nuovi o modificati e letti da qui da dettaglio ed export.
+
+    def orders_needing_travelers(self, limit: int = 200) -> List[Tuple[int, str]]:
+        """(woo_id, hash) degli ordini correnti senza dati viaggiatori o con dati scaricati per una versione
+        precedente dell'ordine; i modificati più di recente per primi. Gli ordini il cui download è fallito
+        per la versione attuale restano fuori fino alla scadenza del backoff, così la coda passa ai successivi."""
+        return [tuple(row) for row in self._get_reader().execute('''
+            SELECT o.woo_id, o.hash_signature FROM orders o
+            LEFT JOIN order_travelers t ON t.woo_id = o.woo_id
+            LEFT JOIN traveler_failures f ON f.woo_id = o.woo_id AND f.order_hash IS o.hash_signature
+            WHERE (t.woo_id IS NULL OR t.order_hash IS NOT o.hash_signature) AND (f.woo_id IS NULL OR f.retry_after <= ?)
+            ORDER BY o.date_modified DESC LIMIT ?
+        ''', (datetime.now().isoformat(timespec='seconds'), limit))]
+
+    def save_travelers(self, results: List[Tuple[int, str, list]]):
+        """Salva in un'unica transazione i risultati (woo_id, hash dell'ordine, viaggiatori). Viaggiatori None =
+        download fallito: l'ordine viene riprovato dopo TRAVELER_RETRY_BASE secondi, raddoppiati a ogni nuovo
+        errore sulla stessa versione (al massimo TRAVELER_RETRY_MAX)."""
+        if not results: return
+        now = datetime.now()
+        rows = [(woo_id, order_hash, json.dumps(travelers), now.isoformat()) for woo_id, order_hash, travelers in results if travelers is not None]
+        failed = [(woo_id, order_hash) for woo_id, order_hash, travelers in results if travelers is None]
+        def save(conn: sqlite3.Connection):
+            conn.executemany("INSERT OR REPLACE INTO order_travelers (woo_id, order_hash, travelers, fetched_at) VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("DELETE FROM traveler_failures WHERE woo_id = ?", [row[:1] for row in rows])
+            for woo_id, order_hash in failed:
+                previous = conn.execute("SELECT order_hash, attempts FROM traveler_failures WHERE woo_id = ?", (woo_id,)).fetchone()
+                attempts = previous[1] + 1 if previous and previous[0] == order_hash else 1
+                delay = min(self.TRAVELER_RETRY_MAX, self.TRAVELER_RETRY_BASE * 2 ** (attempts - 1))
+                conn.execute("INSERT OR REPLACE INTO traveler_failures (woo_id, order_hash, attempts, retry_after) VALUES (?, ?, ?, ?)",
+                             (woo_id, order_hash, attempts, (now + timedelta(seconds=delay)).isoformat(timespec='seconds')))
+        self._execute_write(save)
+
+    def get_travelers(self, woo_id: int, order_hash: str = None):
+        """Viaggiatori salvati per l'ordine (None se mai scaricati); con order_hash solo se ancora attuali."""
+        row = self._get_reader().execute("SELECT order_hash, travelers FROM order_travelers WHERE woo_id = ?", (woo_id,)).fetchone()
+        if row is None or (order_hash is not None and row[0] != order_hash): return None
+        return json.loads(row[1])
+
+    def bulk_import(self, orders: Iterable[dict], batch_size: int = None, progress_callback=None) -> dict:
+        """
+        Import massivo (es. bootstrap da un export WooCommerce) in un'unica transazione sul thread scrittore.
+        Gli indici secondari e i trigger full-text vengono tolti e ricostruiti alla fine, così come rollup e
+        clienti; 'orders' può essere un generatore e viene consumato a blocchi di 'batch_size'.
+        Salva in sync_state la date_modified più recente vista, da cui ripartire con la sincronizzazione delta.
+        """
+        result = self._execute_write(lambda conn: self._bulk_import(conn, orders, batch_size or self.BULK_BATCH_SIZE, progress_callback))
+        if result['inserted'] or result['updated']: self._bump_generation()
+        print(f"📥 Import completato: {result['orders']} ordini letti, {result['inserted']} nuovi, {result['updated']} aggiornati")
+        return result
+
+    def _bulk_import(self, conn: sqlite3.Connection, orders: Iterable[dict], batch_size: int, progress_callback) -> dict:
+        marks = ', '.join('?' * len(self.BULK_DEFERRED_INDEXES))
+        deferred = conn.execute(f"SELECT type, name, sql FROM sqlite_master WHERE (type = 'index' AND name IN ({marks})) OR (type = 'trigger' AND name LIKE 'orders_fts_%')", self.BULK_DEFERRED_INDEXES).fetchall()
+        for object_type, name, _ in deferred: conn.execute(f"DROP {object_type.upper()} {name}")
+        result = {'orders': 0, 'inserted': 0, 'updated': 0, 'newest_modified': None}
+
+        def flush(batch: Dict[int, dict]):
+            existing = self._fetch_existing_hashes(conn, list(batch))
+            rows = []
+            for woo_id, order in batch.items():
+                order_hash = self._calculate_order_hash(order)
+                if existing.get(woo_id) == order_hash: continue
+                result['updated' if woo_id in existing else 'inserted'] += 1
+                rows.append(tuple(self._extract_order_data(order, order_hash).values()))
+            conn.executemany(self._UPSERT_SQL, rows)
+            self._replace_order_items(conn, [batch[row[0]] for row in rows])
+            if progress_callback: progress_callback(result['orders'])
+
+        batch = {}
+        for order in orders:
+            if order.get('id') is None: continue
+            result['orders'] += 1
+            batch[order['id']] = order
+            modified = order.get('date_modified')
+            if modified and (result['newest_modified'] is None or modified > result['newest_modified']): result['newest_modified'] = modified
+            if len(batch) >= batch_size: flush(batch); batch = {}
+        if batch: flush(batch)
+
+        # Ricostruzione in un solo passaggio di indici, ricerca full-text e aggregati
+        for _, _, sql in deferred: conn.execute(sql)
+        if result['inserted'] or result['updated']:
+            if any(object_type == 'trigger' for object_type, _, _ in deferred): conn.execute("INSERT INTO orders_fts(orders_fts) VALUES ('rebuild')")
+            conn.execute("DELETE FROM daily_status_rollup"); conn.execute("DELETE FROM daily_product_rollup")
+            self._apply_rollups(conn, "1", [], 1)
+            self._refresh_customers(conn, None)
+        if result['newest_modified']: self._advance_sync_state(conn, self.MODIFIED_AFTER_KEY, result['newest_modified'])
+        return result
+
+    @staticmethod
+    def _newest_modified(orders: Iterable[dict]):
+        """date_modified più recente tra gli ordini (stringhe ISO, confrontabili come testo)."""
+        return max(filter(None, (order.get('date_modified') for order in orders)), default=None)
+
+    def advance_sync_state(self, key: str, value: str):
+        """Avanza un segnalibro di sincronizzazione (mai all'indietro) in una transazione propria."""
+        self._execute_write(lambda conn: self._advance_sync_state(conn, key, value))
+
+    def get_sync_state(self, key: str, default: str = None) -> str:
+        row = self._get_reader().execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _advance_sync_state(self, conn: sqlite3.Connection, key: str, value: str):
+        """Aggiorna un segnalibro di sincronizzazione solo in avanti (confronto tra date ISO)."""
+        conn.execute('''
+            INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value), updated_at = excluded.updated_at
+        ''', (key, value, datetime.now().isoformat()))
+
+    def _ingest_batch(self, conn: sqlite3.Connection, orders_data: List[dict], newer_only: bool = False) -> Tuple[int, int]:
+        """Upsert di una pagina: legge solo gli hash dei woo_id presenti nel batch (costo O(pagina))."""
+        batch = {}
+        for order in orders_data:
+            if order.get('id') is not None: batch[order['id']] = order  # a parità di id vince l'ultima versione
+        if newer_only:
+            # Stesso confronto di _ingest_partial: a parità di date_modified decide il controllo hash
+            local_modified = self._fetch_local_modified(conn, list(batch))
+            batch = {woo_id: order for woo_id, order in batch.items()
+                     if woo_id not in local_modified or (order.get('date_modified') or '') >= (local_modified[woo_id] or '')}
+        existing = self._fetch_existing_hashes(conn, list(batch))
+        rows, changed_ids = [], []
+        for woo_id, order in batch.items():
+            order_hash = self._calculate_order_hash(order)
+            if woo_id in existing:
+                if existing[woo_id] == order_hash: continue
+                changed_ids.append(woo_id)
+            rows.append(tuple(self._extract_order_data(order, order_hash).values()))
+        if rows:
+            written_ids = [row[0] for row in rows]
+            stale_customers = self._retract_aggregates(conn, changed_ids)
+            conn.executemany(self._UPSERT_SQL, rows)
+            self._replace_order_items(conn, [batch[woo_id] for woo_id in written_ids])
+            self._apply_aggregates(conn, written_ids, stale_customers)
+        return len(rows) - len(changed_ids), len(changed_ids)
+
+    def _partial_columns(self, columns: Tuple[str, ...]) -> Tuple[str, ...]:
+        columns = tuple(columns)
+        invalid = set(columns) - (set(ORDER_COLUMNS[1:]) - {'raw_data', 'hash_signature'})
+        if invalid: raise ValueError(f"Colonne non aggiornabili da un ordine parziale: {', '.join(sorted(invalid))}")
+        if 'date_modified' not in columns: raise ValueError("Un aggiornamento parziale richiede la colonna date_modified")
+        return columns
+
+    def _ingest_partial(self, conn: sqlite3.Connection, orders_data: List[dict], columns: Tuple[str, ...]) -> Tuple[int, int]:
+        """
+        Aggiorna solo 'columns' degli ordini già presenti e modificati dopo la versione locale (confronto su
+        date_modified). Un ordine parziale non basta a creare una riga: gli ordini sconosciuti vengono ignorati.
+        hash_signature viene azzerato, così la prossima versione completa riscrive anche raw_data.
+        """
+        batch = {order['id']: order for order in orders_data if order.get('id') is not None}
+        local_modified = self._fetch_local_modified(conn, list(batch))
+        changed_ids = [woo_id for woo_id, order in batch.items()
+                       if woo_id in local_modified and (order.get('date_modified') or '') > (local_modified[woo_id] or '')]
+        if not changed_ids: return 0, 0
+        stale_customers = self._retract_aggregates(conn, changed_ids)
+        rows = []
+        for woo_id in changed_ids:
+            values = self._extract_order_data(batch[woo_id], None)
+            rows.append(tuple(values[column] for column in columns) + (woo_id,))
+        conn.executemany(f"UPDATE orders SET {', '.join(f'{c} = ?' for c in columns)}, hash_signature = NULL WHERE woo_id = ?", rows)
+        if 'line_items' in columns: self._replace_order_items(conn, [batch[woo_id] for woo_id in changed_ids])
+        self._apply_aggregates(conn, changed_ids, stale_customers)
+        return 0, len(changed_ids)
+
+    def _chunked(self, woo_ids: List[int]):
+        """Divide una lista di id in blocchi per clausole IN (...), restituendo (blocco, segnaposto)."""
+        for i in range(0, len(woo_ids), self.SQL_CHUNK_SIZE):
+            chunk = list(woo_ids[i:i + self.SQL_CHUNK_SIZE])
+            yield chunk, ','.join('?' * len(chunk))
+
+    def _fetch_existing_hashes(self, conn: sqlite3.Connection, woo_ids: List[int]) -> Dict[int, str]:
+        existing = {}
+        for chunk, marks in self._chunked(woo_ids):
+            existing.update(conn.execute(f"SELECT woo_id, hash_signature FROM orders WHERE woo_id IN ({marks})", chunk))
+        return existing
+
+    def _fetch_local_modified(self, conn: sqlite3.Connection, woo_ids: List[int]) -> Dict[int, str]:
+        local_modified = {}
+        for chunk, marks in self._chunked(woo_ids):
+            local_modified.update(conn.execute(f"SELECT woo_id, date_modified FROM orders WHERE woo_id IN ({marks})", chunk))
+        return local_modified
+
+    def _retract_aggregates(self, conn: sqlite3.Connection, woo_ids: List[int]) -> set:
+        """Toglie dagli aggregati il contributo attuale degli ordini (da chiamare prima di modificarli).
+        Restituisce i clienti coinvolti, da ricalcolare dopo la modifica."""
+        for chunk, marks in self._chunked(woo_ids):
+            self._apply_rollups(conn, f"o.woo_id IN ({marks})", chunk, -1)
+        if woo_ids:
+            conn.execute("DELETE FROM daily_status_rollup WHERE order_count <= 0")
+            conn.execute("DELETE FROM daily_product_rollup WHERE order_count <= 0")
+        return self._customer_keys(conn, woo_ids)
+
+    def _apply_aggregates(self, conn: sqlite3.Connection, woo_ids: List[int], stale_customers: set = frozenset()):
+        """Aggiunge agli aggregati il contributo degli ordini appena scritti."""
+        for chunk, marks in self._chunked(woo_ids):
+            self._apply_rollups(conn, f"o.woo_id IN ({marks})", chunk, 1)
+        self._refresh_customers(conn, self._customer_keys(conn, woo_ids) | set(stale_customers))
+
+    def _customer_keys(self, conn: sqlite3.Connection, woo_ids: List[int]) -> set:
+        keys = set()
+        for chunk, marks in self._chunked(woo_ids):
+            keys.update(row[0] for row in conn.execute(f"SELECT DISTINCT lower(trim(customer_email)) FROM orders WHERE woo_id IN ({marks})", chunk))
+        keys.discard(''); keys.discard(None)
+        return keys
+
+    def _refresh_customers(self, conn: sqlite3.Connection, emails):
+        """Ricalcola le righe di 'customers' per le email indicate (None = tutte) dai soli ordini di quei clienti."""
+        select = '''
+            INSERT INTO customers (email, customer_name, phone, purchase_count, total_spent, first_purchase, last_purchase)
+            SELECT g.email,
+                   (SELECT o2.customer_name FROM orders o2 WHERE lower(trim(o2.customer_email)) = g.email AND o2.customer_name != '' ORDER BY o2.date_created DESC LIMIT 1),
+                   (SELECT json_extract(o2.billing_data, '$.phone') FROM orders o2 WHERE lower(trim(o2.customer_email)) = g.email AND json_extract(o2.billing_data, '$.phone') != '' ORDER BY o2.date_created DESC LIMIT 1),
+                   g.purchase_count, g.total_spent, g.first_purchase, g.last_purchase
+            FROM (SELECT lower(trim(customer_email)) AS email, COUNT(*) AS purchase_count, COALESCE(SUM(total), 0) AS total_spent,
+                         MIN(date_created) AS first_purchase, MAX(date_created) AS last_purchase
+                  FROM orders WHERE {where} GROUP BY 1) g
+        '''
+        if emails is None:
+            conn.execute("DELETE FROM customers")
+            conn.execute(select.format(where="customer_email IS NOT NULL AND trim(customer_email) != ''"))
+            return
+        for chunk, marks in self._chunked(sorted(emails)):
+            conn.execute(f"DELETE FROM customers WHERE email IN ({marks})", chunk)
+            conn.execute(select.format(where=f"lower(trim(customer_email)) IN ({marks})"), chunk)
+
+    def _apply_rollups(self, conn: sqlite3.Connection, where: str, params: List, sign: int):
+        """Applica ai rollup giornalieri i delta (sign = +1/-1) degli ordini che soddisfano 'where'."""
+        conn.execute(f'''
+            INSERT INTO daily_status_rollup (day, status, order_count, revenue, tax, shipping)
+            SELECT COALESCE(substr(o.date_created, 1, 10), ''), COALESCE(o.status, ''), {sign} * COUNT(*),
+                   {sign} * COALESCE(SUM(o.total), 0), {sign} * COALESCE(SUM(o.total_tax), 0), {sign} * COALESCE(SUM(o.shipping_total), 0)
+            FROM orders o WHERE {where} GROUP BY 1, 2
+            ON CONFLICT (day, status) DO UPDATE SET order_count = order_count + excluded.order_count,
+                revenue = revenue + excluded.revenue, tax = tax + excluded.tax, shipping = shipping + excluded.shipping
+        ''', params)
+        conn.execute(f'''
+            INSERT INTO daily_product_rollup (day, product_id, name, order_count, quantity, revenue)
+            SELECT COALESCE(substr(o.date_created, 1, 10), ''), COALESCE(i.product_id, 0), COALESCE(i.name, ''), {sign} * COUNT(DISTINCT i.woo_id),
+                   {sign} * COALESCE(SUM(i.quantity), 0), {sign} * COALESCE(SUM(i.total), 0)
+            FROM orders o JOIN order_items i ON i.woo_id = o.woo_id WHERE {where} GROUP BY 1, 2, 3
+            ON CONFLICT (day, product_id, name) DO UPDATE SET order_count = order_count + excluded.order_count,
+                quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue
+        ''', params)
+
+    def _replace_order_items(self, conn: sqlite3.Connection, orders: List[dict]):
+        for chunk, marks in self._chunked([order['id'] for order in orders]):
+            conn.execute(f"DELETE FROM order_items WHERE woo_id IN ({marks})", chunk)
+        items = [item for order in orders for item in self._extract_line_items(order)]
+        if items: conn.executemany('INSERT INTO order_items (woo_id, product_id, variation_id, name, quantity, subtotal, total) VALUES (?, ?, ?, ?, ?, ?, ?)', items)
+
+    def _extract_line_items(self, order_data: dict) -> List[tuple]:
+        return [(order_data.get('id'), item.get('product_id'), item.get('variation_id'), item.get('name', 'Sconosciuto'), int(item.get('quantity') or 0), float(item.get('subtotal') or 0), float(item.get('total') or 0)) for item in order_data.get('line_items') or []]
+
     def _calculate_order_hash(self, order_data: dict) -> str:
         fields = ['status', 'total', 'date_modified', 'line_items']
         data = {k: order_data.get(k) for k in fields}; return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
 
     def _extract_order_data(self, order_data: dict, hash_str: str) -> dict:
-        billing = order_data.get('billing', {}) or {}; return {'woo_id': order_data.get('id'), 'order_number': order_data.get('number', ''), 'status': order_data.get('status', ''), 'currency': order_data.get('currency', 'EUR'), 'total': float(order_data.get('total', 0)), 'total_tax': float(order_data.get('total_tax', 0)), 'shipping_total': float(order_data.get('shipping_total', 0)), 'customer_id': order_data.get('customer_id'), 'customer_email': billing.get('email', ''), 'customer_name': f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip(), 'billing_data': json.dumps(billing), 'shipping_data': json.dumps(order_data.get('shipping', {}) or {}), 'line_items': json.dumps(order_data.get('line_items', [])), 'shipping_lines': json.dumps(order_data.get('shipping_lines', [])), 'payment_method': order_data.get('payment_method', ''), 'payment_method_title': order_data.get('payment_method_title', ''), 'date_created': order_data.get('date_created'), 'date_modified': order_data.get('date_modified'), 'date_completed': order_data.get('date_completed'), 'raw_data': json.dumps(order_data), 'hash_signature': hash_str}
+        billing = order_data.get('billing', {}) or {}; return {'woo_id': order_data.get('id'), 'order_number': order_data.get('number', ''), 'status': order_data.get('status', ''), 'currency': order_data.get('currency', 'EUR'), 'total': float(order_data.get('total', 0)), 'total_tax': float(order_data.get('total_tax', 0)), 'shipping_total': float(order_data.get('shipping_total', 0)), 'customer_id': order_data.get('customer_id'), 'customer_email': billing.get('email', ''), 'customer_name': f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip(), 'billing_data': json.dumps(billing), 'shipping_data': json.dumps(order_data.get('shipping', {}) or {}), 'line_items': json.dumps(order_data.get('line_items', [])), 'shipping_lines': json.dumps(order_data.get('shipping_lines', [])), 'payment_method': order_data.get('payment_method', ''), 'payment_method_title': order_data.get('payment_method_title', ''), 'date_created': order_data.get('date_created'), 'date_modified': order_data.get('date_modified'), 'date_completed': order_data.get('date_completed'), 'raw_data': compress_raw_data(order_data, self._compression_dict), 'hash_signature': hash_str}
         
-    def get_orders(self, filters: dict = None) -> List[dict]:
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row; cursor = conn.cursor()
-                query = "SELECT * FROM orders"; where_clauses = []; params = []
-                if filters:
-                    if filters.get('search_term'):
-                        term = f"%{filters['search_term']}%"; where_clauses.append("(order_number LIKE ? OR customer_name LIKE ? OR customer_email LIKE ?)"); params.extend([term, term, term])
-                    if filters.get('status'):
-                        where_clauses.append("status = ?"); params.append(filters['status'])
-                if where_clauses: query += " WHERE " + " AND ".join(where_clauses)
-                query += " ORDER BY date_created DESC"
-                if filters and filters.get('limit'): query += f" LIMIT {int(filters['limit'])}"
-                
-                rows = cursor.execute(query, tuple(params)).fetchall()
-                orders = []
-                for row in rows:
-                    order = dict(row)
-                    for field in ['billing_data', 'shipping_data', 'line_items', 'raw_data']:
-                        if order.get(field):
-                            try: 
-                                order[field] = json.loads(order[field])
-                            except (json.JSONDecodeError, TypeError):
-                                print(f"⚠️ Warning: Impossibile decodificare il campo JSON '{field}' per l'ordine ID {order.get('woo_id')}")
-                                order[field] = {}
-                    orders.append(order)
-                return orders
+    def compact_raw_data(self, train_dictionary: bool = True, batch_size: int = 500) -> dict:
+        """
+        Migrazione una tantum: ricomprime raw_data di tutti gli ordini (anche quelli in JSON testuale),
+        opzionalmente con un dizionario zlib addestrato sugli ordini recenti, poi esegue VACUUM.
+        Restituisce il numero di ordini e la dimensione del file prima e dopo.
+        """
+        self._execute_write(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"), transaction=False)
+        size_before = self._database_size()
+        if train_dictionary: self._train_compression_dictionary()
+        converted, last_id = 0, 0
+        columns = ('id', 'woo_id') + tuple(RAW_DATA_SPLIT_FIELDS.values()) + ('raw_data',)
+        def convert_batch(conn: sqlite3.Connection):
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM orders WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+            updates = []
+            for row in rows:
+                order = OrderRecord(columns, row).get('raw_data')
+                if order: updates.append((compress_raw_data(order, self._compression_dict), row[0]))
+            conn.executemany("UPDATE orders SET raw_data = ? WHERE id = ?", updates)
+            return len(updates), (rows[-1][0] if rows else None)
+        while True:
+            # Blocchi brevi: le sincronizzazioni in coda si inseriscono tra una transazione e l'altra
+            count, last_id = self._execute_write(convert_batch)
+            if last_id is None: break
+            converted += count
+        self._execute_write(lambda conn: (conn.execute("VACUUM"), conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")), transaction=False)
+        size_after = self._database_size()
+        print(f"🗜️ raw_data ricompresso per {converted} ordini: {size_before / 1048576:.1f} MB → {size_after / 1048576:.1f} MB")
+        return {'orders': converted, 'size_before': size_before, 'size_after': size_after}
+
+    def _train_compression_dictionary(self, sample_size: int = 200):
+        """Dizionario zlib preimpostato (max 32 KB) ricavato dagli ordini più recenti."""
+        columns = ('woo_id',) + tuple(RAW_DATA_SPLIT_FIELDS.values()) + ('raw_data',)
+        cursor = self._get_reader().cursor(); cursor.row_factory = None
+        samples = []
+        for row in cursor.execute(f"SELECT {', '.join(columns)} FROM orders ORDER BY date_created DESC LIMIT ?", (sample_size,)).fetchall():
+            order = OrderRecord(columns, row).get('raw_data')
+            if order: samples.append(json.dumps({k: v for k, v in order.items() if k not in RAW_DATA_SPLIT_FIELDS}, separators=(',', ':')).encode())
+        if not samples: return
+        # zlib privilegia le sequenze in fondo al dizionario: i campioni più recenti vanno per ultimi
+        zdict = b''.join(reversed(samples))[-32768:]
+        dict_id = zlib.crc32(zdict)
+        self._execute_write(lambda conn: conn.execute("INSERT OR REPLACE INTO compression_dicts (id, data, created_at) VALUES (?, ?, ?)", (dict_id, zdict, datetime.now().isoformat())))
+        _compression_dicts[dict_id] = zdict; self._compression_dict = zdict
+
+    # --- Archivio storico ---------------------------------------------------------------------
+    # Gli ordini in stato finale più vecchi di una certa età vengono spostati in un secondo file
+    # SQLite. Le viste normali, le statistiche e il controllo hash della sincronizzazione leggono
+    # solo il file corrente; l'archivio viene collegato con ATTACH solo per le letture storiche
+    # (filtro 'include_archive', export, dettaglio di un ordine archiviato).
+
+    _ARCHIVE_COLUMNS = ', '.join(('id',) + ORDER_COLUMNS)
+    _ARCHIVE_UNION = (f"(SELECT {_ARCHIVE_COLUMNS} FROM main.orders UNION ALL SELECT {_ARCHIVE_COLUMNS} FROM archive.orders a "
+                      "WHERE NOT EXISTS (SELECT 1 FROM main.orders h WHERE h.woo_id = a.woo_id)) AS orders")
+
+    def archive_orders(self, older_than_days: int = None, batch_size: int = 500) -> int:
+        """
+        Sposta nell'archivio gli ordini in stato finale creati più di 'older_than_days' giorni fa
+        (predefinito: impostazione app.archive_after_days). Lavora a blocchi, ognuno in una transazione
+        breve, togliendo gli ordini spostati da rollup e clienti. Restituisce il numero di ordini archiviati.
+        """
+        days = older_than_days if older_than_days is not None else config.get('app', 'archive_after_days', self.ARCHIVE_AFTER_DAYS)
+        cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S')
+        moved = 0
+        try:
+            while True:
+                count = self._execute_write(lambda conn: self._archive_batch(conn, cutoff, batch_size), transaction=False)
+                if not count: break
+                moved += count
+                self._bump_generation()
+        except Exception as e:
+            print(f"❌ Errore durante l'archiviazione: {e}")
+        if moved: print(f"🗄️ Archiviati {moved} ordini anteriori al {cutoff[:10]}")
+        return moved
+
+    def _archive_batch(self, conn: sqlite3.Connection, cutoff: str, limit: int) -> int:
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        try:
+            self._create_archive_schema(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                marks = ', '.join('?' * len(self.ARCHIVE_STATUSES))
+                woo_ids = [row[0] for row in conn.execute(f"SELECT woo_id FROM main.orders WHERE status IN ({marks}) AND date_created < ? ORDER BY date_created LIMIT ?", [*self.ARCHIVE_STATUSES, cutoff, limit])]
+                stale_customers = self._retract_aggregates(conn, woo_ids)
+                item_columns = "woo_id, product_id, variation_id, name, quantity, subtotal, total"
+                for chunk, marks in self._chunked(woo_ids):
+                    conn.execute(f"INSERT OR REPLACE INTO archive.orders ({self._ARCHIVE_COLUMNS}) SELECT {self._ARCHIVE_COLUMNS} FROM main.orders WHERE woo_id IN ({marks})", chunk)
+                    conn.execute(f"DELETE FROM archive.order_items WHERE woo_id IN ({marks})", chunk)
+                    conn.execute(f"INSERT INTO archive.order_items ({item_columns}) SELECT {item_columns} FROM main.order_items WHERE woo_id IN ({marks})", chunk)
+                    conn.execute(f"DELETE FROM main.order_items WHERE woo_id IN ({marks})", chunk)
+                    conn.execute(f"DELETE FROM main.orders WHERE woo_id IN ({marks})", chunk)
+                self._refresh_customers(conn, stale_customers)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.execute("DETACH DATABASE archive")  # la sincronizzazione non deve mai vedere l'archivio
+        return len(woo_ids)
+
+    def _create_archive_schema(self, conn: sqlite3.Connection):
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.orders (
+                id INTEGER PRIMARY KEY, woo_id INTEGER UNIQUE NOT NULL,
+                order_number TEXT, status TEXT, currency TEXT, total REAL,
+                total_tax REAL, shipping_total REAL, customer_id INTEGER,
+                customer_email TEXT, customer_name TEXT, billing_data TEXT,
+                shipping_data TEXT, line_items TEXT, shipping_lines TEXT,
+                payment_method TEXT, payment_method_title TEXT, date_created TEXT,
+                date_modified TEXT, date_completed TEXT, raw_data TEXT,
+                hash_signature TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_date_woo ON orders(date_created, woo_id)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, woo_id INTEGER NOT NULL,
+                product_id INTEGER, variation_id INTEGER, name TEXT,
+                quantity INTEGER, subtotal REAL, total REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_order_items_woo_id ON order_items(woo_id)")
+        conn.execute("DROP INDEX IF EXISTS archive.idx_order_items_product")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_order_items_product_order ON order_items(product_id, woo_id)")
+
+    def _attach_archive_reader(self) -> bool:
+        """Collega (una volta per thread) l'archivio alla connessione di lettura; False se non esiste ancora."""
+        conn = self._get_reader()
+        if any(row[1] == 'archive' for row in conn.execute("PRAGMA database_list")): return True
+        if not os.path.exists(self.archive_path): return False
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        if conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'orders'").fetchone(): return True
+        conn.execute("DETACH DATABASE archive")  # archivio appena creato e non ancora popolato
+        return False
+
+    def _orders_reader(self, filters: dict) -> Tuple[sqlite3.Connection, bool]:
+        archived = bool(filters and filters.get('include_archive')) and self._attach_archive_reader()
+        return self._get_reader(), archived
+
+    # --- Manutenzione in background -----------------------------------------------------------
+    # Eseguita nelle pause del polling: ogni attività è un job del thread scrittore, quindi non si
+    # sovrappone mai a una transazione di ingest, e viene interrotta allo scadere del tempo assegnato
+    # tramite il progress handler di SQLite. Durata e byte recuperati finiscono in 'maintenance_log'.
+
+    def run_maintenance(self, time_budget: float = None) -> List[dict]:
+        """Esegue le attività di manutenzione scadute entro 'time_budget' secondi (al massimo MAINTENANCE_TIME_BUDGET)."""
+        budget = self.MAINTENANCE_TIME_BUDGET if time_budget is None else min(time_budget, self.MAINTENANCE_TIME_BUDGET)
+        deadline = time.monotonic() + budget
+        # Il controllo di integrità legge da una connessione propria senza fermare lo scrittore: può usare
+        # tutta la pausa disponibile, così anche su database grandi arriva in fondo invece di ripartire ogni volta
+        idle_deadline = deadline if time_budget is None else max(deadline, time.monotonic() + time_budget)
+        results = []
+        if budget <= 0: return results
+        try:
+            last_runs = dict(self._get_reader().execute("SELECT task, MAX(started_at) FROM maintenance_log WHERE result != 'interrotta' GROUP BY task").fetchall())
+            for task, interval in self.MAINTENANCE_INTERVALS.items():
+                # Se nel frattempo è arrivata una sincronizzazione la manutenzione cede il passo
+                if time.monotonic() >= deadline or not self._write_queue.empty(): break
+                last = last_runs.get(task)
+                if last and (datetime.now() - datetime.fromisoformat(last)).total_seconds() < interval: continue
+                entry = self._run_maintenance_task(task, idle_deadline if task == 'integrity_check' else deadline)
+                if entry: results.append(entry)
+        except Exception as e:
+            print(f"❌ Errore durante la manutenzione del database: {e}")
+        return results
+
+    def get_maintenance_log(self, limit: int = 20) -> List[dict]:
+        rows = self._get_reader().execute("SELECT task, started_at, duration, bytes_reclaimed, result FROM maintenance_log ORDER BY id DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows.fetchall()]
+
+    def _run_maintenance_task(self, task: str, deadline: float) -> Optional[dict]:
+        """Esegue l'attività e la registra; None (e nessuna riga nel registro) se non c'era nulla da fare."""
+        started_at, start, size_before = datetime.now().isoformat(), time.monotonic(), self._database_size()
+        reclaimed = 0
+        try:
+            result = getattr(self, f'_maintenance_{task}')(deadline)
+            if isinstance(result, tuple): result, reclaimed = result  # byte liberati dichiarati dall'attività
+        except sqlite3.OperationalError as e:
+            result = 'interrotta' if 'interrupt' in str(e) else f"errore: {e}"
+        if result is None: return None
+        entry = {'task': task, 'started_at': started_at, 'duration': round(time.monotonic() - start, 3),
+                 'bytes_reclaimed': max(reclaimed, size_before - self._database_size()), 'result': result}
+        def log(conn: sqlite3.Connection):
+            conn.execute("INSERT INTO maintenance_log (task, started_at, duration, bytes_reclaimed, result) VALUES (?, ?, ?, ?, ?)", tuple(entry.values()))
+            # Registro limitato alle ultime MAINTENANCE_LOG_KEEP esecuzioni di ogni attività
+            conn.execute("DELETE FROM maintenance_log WHERE task = ? AND started_at < (SELECT started_at FROM maintenance_log WHERE task = ? ORDER BY started_at DESC LIMIT 1 OFFSET ?)",
+                         (task, task, self.MAINTENANCE_LOG_KEEP - 1))
+            # La riga appena scritta non deve bastare a far ripartire il checkpoint al giro successivo
+            if task == 'wal_checkpoint': self._checkpointed_changes = conn.total_changes
+        self._execute_write(log)
+        return entry
+
+    def _execute_with_deadline(self, func, deadline: float):
+        """Job di manutenzione sul thread scrittore, interrotto (OperationalError) allo scadere di 'deadline'."""
+        def job(conn: sqlite3.Connection):
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try: return func(conn)
+            finally: conn.set_progress_handler(None, 0)
+        return self._execute_write(job, transaction=False)
+
+    def _maintenance_wal_checkpoint(self, deadline: float) -> Optional[str]:
+        def checkpoint(conn: sqlite3.Connection):
+            # Nessuna scrittura dall'ultimo checkpoint registrato: niente da fare e niente da registrare
+            if conn.total_changes == self._checkpointed_changes: return None
+            busy, log_pages, done = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if log_pages <= 0: return None
+            # Se nessun lettore trattiene il WAL lo si tronca, restituendo spazio al disco
+            if not busy and log_pages == done: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return f"{done}/{log_pages} pagine"
+        return self._execute_with_deadline(checkpoint, deadline)
+
+    def _maintenance_optimize(self, deadline: float) -> str:
+        # analysis_limit rende ANALYZE approssimato ma veloce anche su tabelle grandi
+        self._execute_with_deadline(lambda conn: (conn.execute("PRAGMA analysis_limit=1000"), conn.execute("PRAGMA optimize")), deadline)
+        return "ok"
+
+    def _maintenance_incremental_vacuum(self, deadline: float):
+        # Le pagine tolte arrivano sul disco al checkpoint successivo: i byte sono stimati dalle pagine liberate
+        if self._get_reader().execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return "non disponibile (serve un VACUUM completo, ad es. Compatta Database)"
+        free_before = free_pages = self._get_reader().execute("PRAGMA freelist_count").fetchone()[0]
+        try:
+            while free_pages and time.monotonic() < deadline and self._write_queue.empty():
+                # A piccoli passi, ognuno un job separato: le scritture in coda non attendono l'intero vacuum
+                step = min(free_pages, self.VACUUM_STEP_PAGES)
+                self._execute_with_deadline(lambda conn: conn.executescript(f"PRAGMA incremental_vacuum({step})"), deadline)
+                free_pages = self._get_reader().execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            # Pagine effettivamente tolte dalla freelist (anche se l'ultimo passo è stato interrotto)
+            freed = free_before - self._get_reader().execute("PRAGMA freelist_count").fetchone()[0]
+        return f"{freed} pagine liberate", freed * self._get_reader().execute("PRAGMA page_size").fetchone()[0]
+
+    def _maintenance_integrity_check(self, deadline: float) -> str:
+        # quick_check (struttura di pagine e record, senza il confronto completo con gli indici) in sola
+        # lettura: costa una frazione di integrity_check e non blocca le scritture
+        conn = self._open_connection(read_only=True)
+        try:
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            problems = [row[0] for row in conn.execute("PRAGMA quick_check(10)")]
+        finally:
+            conn.close()
+        if problems != ['ok']: print(f"⚠️ Controllo integrità database: {'; '.join(problems)}")
+        return '; '.join(problems)
+
+    # --- Backup locale ------------------------------------------------------------------------
+    # Lo snapshot usa l'API di backup di SQLite a passi di BACKUP_STEP_PAGES pagine da una connessione
+    # propria, dentro una transazione di lettura: la copia è coerente con l'istante di partenza e il thread
+    # scrittore resta libero, così sincronizzazioni e altre scritture procedono nel loro ordine durante
+    # il backup. La copia viene verificata, compressa e ruotata (BACKUP_KEEP file).
+
+    @property
+    def backup_dir(self) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_path)), 'backups')
+
+    def backup_database(self, keep: int = None, progress_callback=None) -> dict:
+        """Crea uno snapshot compresso (.db.gz) del database; progress_callback(copiate, totali) dopo ogni passo."""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = f"{os.path.splitext(os.path.basename(self.db_path))[0]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        snapshot_path = os.path.join(self.backup_dir, name)
+        start = time.monotonic()
+        try:
+            source, target = self._open_connection(read_only=True), sqlite3.connect(snapshot_path)
+            try:
+                # La copia viene verificata e compressa subito dopo: niente journal né fsync sul file temporaneo
+                target.execute("PRAGMA journal_mode=OFF"); target.execute("PRAGMA synchronous=OFF")
+                # Transazione di lettura aperta per tutta la copia: in WAL i commit degli altri non la
+                # fanno ripartire da capo e i passi leggono sempre la stessa versione del database
+                source.execute("BEGIN"); source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                on_step = (lambda status, remaining, total: progress_callback(total - remaining, total)) if progress_callback else None
+                source.backup(target, pages=self.BACKUP_STEP_PAGES, progress=on_step)
+                source.execute("COMMIT")
+            finally:
+                target.close(); source.close()
+            problems = self._check_snapshot(snapshot_path)
+            if problems: raise sqlite3.DatabaseError(f"snapshot non valido: {problems}")
+            with open(snapshot_path, 'rb') as source, gzip.open(snapshot_path + '.gz', 'wb', compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+        finally:
+            if os.path.exists(snapshot_path): os.remove(snapshot_path)
+        removed = self._rotate_backups(self.BACKUP_KEEP if keep is None else keep)
+        result = {'path': snapshot_path + '.gz', 'size': os.path.getsize(snapshot_path + '.gz'), 'duration': round(time.monotonic() - start, 2), 'removed': removed}
+        print(f"💾 Backup creato: {result['path']} ({result['size'] / 1048576:.1f} MB in {result['duration']} s)")
+        return result
+
+    def list_backups(self) -> List[str]:
+        """Snapshot disponibili, dal più recente."""
+        if not os.path.isdir(self.backup_dir): return []
+        prefix = os.path.splitext(os.path.basename(self.db_path))[0] + '_'
+        names = [n for n in os.listdir(self.backup_dir) if n.startswith(prefix) and n.endswith('.db.gz')]
+        return [os.path.join(self.backup_dir, n) for n in sorted(names, reverse=True)]
+
+    def _rotate_backups(self, keep: int) -> List[str]:
+        removed = self.list_backups()[max(keep, 1):]
+        for path in removed: os.remove(path)
+        return removed
+
+    @staticmethod
+    def _check_snapshot(path: str) -> str:
+        """'' se il file è un database integro con la tabella ordini, altrimenti la descrizione del problema."""
+        conn = sqlite3.connect(path)
+        try:
+            problems = [row[0] for row in conn.execute("PRAGMA integrity_check(10)")]
+            if problems != ['ok']: return '; '.join(problems)
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders'").fetchone(): return "tabella ordini mancante"
+            return ''
+        except sqlite3.DatabaseError as e:
+            return str(e)
+        finally:
+            conn.close()
+
+    def restore_database(self, backup_path: str) -> dict:
+        """
+        Ripristina uno snapshot (.db.gz o .db): lo decomprime accanto al database, ne verifica l'integrità e
+        solo allora lo copia sul database attivo con l'API di backup, senza chiudere le connessioni aperte.
+        """
+        restore_path = self.db_path + '.restore'
+        try:
+            opener = gzip.open if backup_path.endswith('.gz') else open
+            with opener(backup_path, 'rb') as source, open(restore_path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            problems = self._check_snapshot(restore_path)
+            if problems: raise sqlite3.DatabaseError(f"backup non valido, ripristino annullato: {problems}")
+            def copy_back(conn: sqlite3.Connection):
+                source = sqlite3.connect(restore_path)
+                try: source.backup(conn)
+                finally: source.close()
+            self._execute_write(copy_back, transaction=False)
+            self._checkpointed_changes = None  # pagine copiate senza modifiche di righe: serve un checkpoint
+        finally:
+            if os.path.exists(restore_path): os.remove(restore_path)
+        self._initialize_database()  # aggiorna lo schema se lo snapshot è di una versione precedente
+        self._bump_generation()
+        orders = self._get_reader().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        print(f"♻️ Database ripristinato da {backup_path}: {orders} ordini")
+        return {'path': backup_path, 'orders': orders}
+
+    def _database_size(self) -> int:
+        return sum(os.path.getsize(path) for path in (self.db_path, self.db_path + '-wal') if os.path.exists(path))
+
+    def get_orders(self, filters: dict = None, columns: Tuple[str, ...] = None) -> List[OrderRecord]:
+        """Ordini filtrati; 'columns' limita le colonne lette (es. LIST_COLUMNS per le viste elenco)."""
+        try:
+            columns = self._select_columns(columns)
+            # In cache restano le righe (tuple immutabili): ogni chiamata riceve record propri, che può
+            # modificare o annotare senza toccare quelli dei lettori successivi
+            rows = self._cached(('orders', self._filters_key(filters), columns), lambda: self._query_orders(filters, columns))
+            return [OrderRecord(columns, row) for row in rows]
         except Exception as e:
             print(f"❌ Errore recupero ordini: {e}"); return []
-            
+
+    def _query_orders(self, filters: dict, columns: Tuple[str, ...]) -> List[tuple]:
+        conn, archived = self._orders_reader(filters)
+        query, params, rank = self._build_orders_query(filters, columns, archived=archived)
+        query += f" ORDER BY {rank + ', ' if rank else ''}orders.date_created DESC, orders.woo_id DESC"
+        if filters and filters.get('limit'): query += f" LIMIT {int(filters['limit'])}"
+        return self._fetch_rows(conn, query, params)
+
+    def get_orders_page(self, filters: dict = None, after_key=None, limit: int = 200, columns: Tuple[str, ...] = None, ranked: bool = True) -> Tuple[List[OrderRecord], object]:
+        """
+        Una pagina di ordini e la chiave da passare come 'after_key' per la successiva (None se finiti).
+        L'ordine cronologico usa la paginazione keyset su (date_created, woo_id); le ricerche testuali
+        ordinate per rilevanza (ranked=True) usano invece come chiave la posizione nel risultato.
+        """
+        try:
+            columns = self._select_columns(columns)
+            if after_key is None:
+                # Solo la prima pagina va in cache: è quella riletta a ogni aggiornamento della vista
+                rows, next_key = self._cached(('page', self._filters_key(filters), columns, limit, ranked), lambda: self._query_orders_page(filters, None, limit, columns, ranked))
+            else:
+                rows, next_key = self._query_orders_page(filters, after_key, limit, columns, ranked)
+            return [OrderRecord(columns, row) for row in rows], next_key
+        except Exception as e:
+            print(f"❌ Errore recupero pagina ordini: {e}"); return [], None
+
+    def _query_orders_page(self, filters: dict, after_key, limit: int, columns: Tuple[str, ...], ranked: bool) -> Tuple[List[tuple], object]:
+        """Righe della pagina (colonne richieste seguite da date_created e woo_id) e chiave della successiva."""
+        conn, archived = self._orders_reader(filters)
+        if not isinstance(after_key, (tuple, list)):
+            # Prima pagina o ricerca per rilevanza (chiave = offset intero nel risultato)
+            query, params, rank = self._build_orders_query(filters, columns, extra_columns=('date_created', 'woo_id'), ranked=ranked, archived=archived)
+            if rank:
+                offset = after_key or 0
+                query += f" ORDER BY {rank}, orders.date_created DESC, orders.woo_id DESC LIMIT ? OFFSET ?"; params += [limit + 1, offset]
+            else:
+                query += " ORDER BY orders.date_created DESC, orders.woo_id DESC LIMIT ?"; params.append(limit + 1)
+            rows = self._fetch_rows(conn, query, params)
+        else:
+            # Chiave keyset (date_created, woo_id). Gli ordini senza data vengono per ultimi e il confronto
+            # fra coppie non li include mai (NULL): si leggono a parte, sempre sull'indice (date_created, woo_id)
+            rank = ""
+            date_created, woo_id = after_key
+            if date_created is None: keyset = ("orders.date_created IS NULL AND orders.woo_id < ?", [woo_id])
+            else: keyset = ("(orders.date_created, orders.woo_id) < (?, ?)", [date_created, woo_id])
+            rows = self._fetch_keyset_rows(conn, filters, columns, archived, keyset, limit + 1)
+            if date_created is not None and len(rows) <= limit:
+                rows += self._fetch_keyset_rows(conn, filters, columns, archived, ("orders.date_created IS NULL", []), limit + 1 - len(rows))
+        has_more = len(rows) > limit; rows = rows[:limit]
+        if not has_more: return rows, None
+        return rows, (offset + limit if rank else tuple(rows[-1][-2:]))
+
+    def _fetch_keyset_rows(self, conn: sqlite3.Connection, filters: dict, columns: Tuple[str, ...], archived: bool, keyset: Tuple[str, List], limit: int) -> List[tuple]:
+        query, params, _ = self._build_orders_query(filters, columns, extra_columns=('date_created', 'woo_id'), ranked=False, archived=archived, extra_where=keyset)
+        query += " ORDER BY orders.date_created DESC, orders.woo_id DESC LIMIT ?"; params.append(limit)
+        return self._fetch_rows(conn, query, params)
+
+    @staticmethod
+    def _fetch_rows(conn: sqlite3.Connection, query: str, params: List) -> List[tuple]:
+        cursor = conn.cursor(); cursor.row_factory = None
+        return cursor.execute(query, params).fetchall()
+
+    def iter_orders(self, filters: dict = None, batch_size: int = 500, columns: Tuple[str, ...] = None):
+        """Generatore a memoria costante: legge a blocchi in ordine cronologico inverso con paginazione keyset.
+        Ogni blocco è una lettura breve, così un export lungo non tiene aperta una transazione sul WAL.
+        Gli errori di lettura arrivano al chiamante: un export non deve mai finire troncato in silenzio."""
+        columns = self._select_columns(columns)
+        after_key = None
+        while True:
+            rows, after_key = self._query_orders_page(filters, after_key, batch_size, columns, False)
+            yield from (OrderRecord(columns, row) for row in rows)
+            if after_key is None: return
+
+    def _build_orders_query(self, filters: dict, columns: Tuple[str, ...], extra_columns: Tuple[str, ...] = (), ranked: bool = True, archived: bool = False, extra_where: Tuple[str, List] = None) -> Tuple[str, List, str]:
+        """SELECT ... FROM ... WHERE per i filtri della vista ordini; restituisce anche l'espressione di rilevanza (o '').
+        Con archived=True la sorgente è l'unione di ordini correnti e archiviati (l'indice full-text copre solo i correnti)."""
+        query = f"SELECT {', '.join('orders.' + c for c in columns + tuple(extra_columns))} FROM {self._ARCHIVE_UNION if archived else 'orders'}"; where_clauses = []; params = []; rank = ""
+        if filters:
+            if filters.get('search_term'):
+                tokens = filters['search_term'].split()
+                fts_tokens = [t for t in tokens if len(t) >= 3] if self.fts_enabled and not archived else []
+                if fts_tokens:
+                    # Ogni parola è una sottostringa (trigram); più parole = AND, ordinate per rilevanza bm25
+                    query += " JOIN orders_fts ON orders_fts.rowid = orders.id"
+                    where_clauses.append("orders_fts MATCH ?"); params.append(" ".join('"' + t.replace('"', '""') + '"' for t in fts_tokens))
+                    if ranked: rank = "bm25(orders_fts, 10.0, 5.0, 1.0)"  # il numero ordine pesa più di nome ed email
+                for token in tokens:
+                    if token in fts_tokens: continue
+                    term = f"%{token}%"; where_clauses.append("(orders.order_number LIKE ? OR orders.customer_name LIKE ? OR orders.customer_email LIKE ?)"); params.extend([term, term, term])
+            if filters.get('status'):
+                where_clauses.append("orders.status = ?"); params.append(filters['status'])
+        if extra_where:
+            where_clauses.append(extra_where[0]); params.extend(extra_where[1])
+        if where_clauses: query += " WHERE " + " AND ".join(where_clauses)
+        return query, params, rank
+
+    def get_order(self, woo_id: int) -> OrderRecord:
+        """Ordine completo (tutte le colonne), ad esempio per la finestra di dettaglio."""
+        try:
+            cursor = self._get_reader().cursor(); cursor.row_factory = None
+            columns = ('id',) + ORDER_COLUMNS
+            row = cursor.execute(f"SELECT {', '.join(columns)} FROM orders WHERE woo_id = ?", (woo_id,)).fetchone()
+            if row is None and self._attach_archive_reader():
+                cursor = self._get_reader().cursor(); cursor.row_factory = None
+                row = cursor.execute(f"SELECT {', '.join(columns)} FROM archive.orders WHERE woo_id = ?", (woo_id,)).fetchone()
+            return OrderRecord(columns, row) if row else None
+        except Exception as e:
+            print(f"❌ Errore recupero ordine {woo_id}: {e}"); return None
+
+    def _select_columns(self, columns: Tuple[str, ...] = None) -> Tuple[str, ...]:
+        if not columns: return ('id',) + ORDER_COLUMNS
+        unknown = set(columns) - set(ORDER_COLUMNS) - {'id'}
+        if unknown: raise ValueError(f"Colonne non valide: {', '.join(sorted(unknown))}")
+        return tuple(columns)
+
     def get_order_stats(self, days: int = 0) -> dict:
+        """Statistiche dai rollup giornalieri: costo O(giorni) indipendente dal numero di ordini."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                query = "SELECT status, total, date_created, line_items FROM orders"
-                params = []
-                if days > 0:
-                    date_from = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S')
-                    query += " WHERE date_created >= ?"
-                    params.append(date_from)
-                cursor.execute(query, tuple(params))
-                orders = cursor.fetchall()
-                if not orders: return {'total_orders': 0, 'total_revenue': 0, 'by_status': {}, 'by_date': {}, 'top_products': {}}
-                total_orders = len(orders)
-                total_revenue = sum(o['total'] for o in orders if o['total'] is not None)
-                by_status = defaultdict(int)
-                by_date = defaultdict(int)
-                top_products = defaultdict(int)
-                for order in orders:
-                    by_status[order['status']] += 1
-                    if order['date_created']:
-                        order_date = order['date_created'][:10]
-                        by_date[order_date] += 1
-                    try:
-                        line_items = json.loads(order['line_items'])
-                        for item in line_items:
-                            top_products[item.get('name', 'Sconosciuto')] += item.get('quantity', 0)
-                    except: pass
-                sorted_products = sorted(top_products.items(), key=lambda item: item[1], reverse=True)[:5]
-                return {'total_orders': total_orders, 'total_revenue': total_revenue, 'by_status': dict(by_status), 'by_date': dict(by_date), 'top_products': dict(sorted_products)}
+            # Copia profonda: chi riceve le statistiche può modificarle senza toccare la cache
+            return copy.deepcopy(self._cached(('stats',) + tuple(self._rollup_window(days)[1]), lambda: self._compute_order_stats(days)))
         except Exception as e:
             print(f"❌ Errore calcolo statistiche: {e}")
             return {}
+
+    def _compute_order_stats(self, days: int) -> dict:
+        cursor = self._get_reader().cursor()
+        where, params = self._rollup_window(days)
+        by_status = {status: count for status, count in cursor.execute(f"SELECT status, SUM(order_count) FROM daily_status_rollup{where} GROUP BY status", params) if count}
+        if not by_status: return {'total_orders': 0, 'total_revenue': 0, 'by_status': {}, 'by_date': {}, 'top_products': {}}
+        total_orders, total_revenue = cursor.execute(f"SELECT SUM(order_count), ROUND(SUM(revenue), 2) FROM daily_status_rollup{where}", params).fetchone()
+        by_date = dict(cursor.execute(f"SELECT day, SUM(order_count) FROM daily_status_rollup{where}{' AND' if where else ' WHERE'} day != '' GROUP BY day", params).fetchall())
+        top_products = {p['name']: p['quantity'] for p in self.get_product_sales(days, limit=5)}
+        return {'total_orders': total_orders, 'total_revenue': total_revenue, 'by_status': by_status, 'by_date': by_date, 'top_products': top_products}
+
+    def _rollup_window(self, days: int) -> Tuple[str, List]:
+        if days <= 0: return "", []
+        return " WHERE day >= ?", [(datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')]
+
+    def get_kpis(self, period: str = 'month', today: datetime = None) -> dict:
+        """
+        KPI del periodo in corso (giorno, settimana, mese o anno fino a oggi) confrontati con lo stesso
+        intervallo del periodo precedente: ordini, fatturato, ordine medio, tasso di completamento,
+        arretrato da evadere e crescita. Una sola lettura per intervallo di date sul rollup giornaliero.
+        """
+        try:
+            current, previous = self._kpi_windows(period, (today or datetime.now()).date())
+            return copy.deepcopy(self._cached(('kpi', period, current, previous), lambda: self._compute_kpis(period, current, previous)))
+        except Exception as e:
+            print(f"❌ Errore calcolo KPI: {e}")
+            return {}
+
+    def _kpi_windows(self, period: str, today) -> Tuple[Tuple[str, str], Tuple[str, str]]:
+        """Intervalli (inizio, fine) inclusi del periodo corrente e del precedente, a parità di giorni trascorsi."""
+        if period == 'day':
+            start, prev_start = today, today - timedelta(days=1)
+        elif period == 'week':
+            start = today - timedelta(days=today.weekday()); prev_start = start - timedelta(days=7)
+        elif period == 'month':
+            start = today.replace(day=1); prev_start = (start - timedelta(days=1)).replace(day=1)
+        elif period == 'ytd':
+            # Stessa data di calendario dell'anno precedente (il 29 febbraio diventa il 28)
+            start = today.replace(month=1, day=1); prev_start = start.replace(year=start.year - 1)
+            prev_end = today.replace(year=today.year - 1, day=28 if (today.month, today.day) == (2, 29) else today.day)
+            return (start.isoformat(), today.isoformat()), (prev_start.isoformat(), prev_end.isoformat())
+        else:
+            raise ValueError(f"Periodo KPI non valido: {period}")
+        prev_end = min(prev_start + (today - start), start - timedelta(days=1))
+        return (start.isoformat(), today.isoformat()), (prev_start.isoformat(), prev_end.isoformat())
+
+    def _compute_kpis(self, period: str, current: Tuple[str, str], previous: Tuple[str, str]) -> dict:
+        cursor = self._get_reader().cursor()
+        backlog_marks = ', '.join('?' * len(self.BACKLOG_STATUSES))
+        # Entrambi i periodi in un'unica scansione per intervallo sulla chiave primaria (day, status)
+        rows = cursor.execute(f'''
+            SELECT CASE WHEN day >= ? THEN 'current' ELSE 'previous' END, COALESCE(SUM(order_count), 0), COALESCE(SUM(revenue), 0),
+                   COALESCE(SUM(CASE WHEN status = 'completed' THEN order_count END), 0),
+                   COALESCE(SUM(CASE WHEN status IN ({backlog_marks}) THEN order_count END), 0)
+            FROM daily_status_rollup WHERE day BETWEEN ? AND ? AND (day >= ? OR day <= ?) GROUP BY 1
+        ''', [current[0], *self.BACKLOG_STATUSES, previous[0], current[1], current[0], previous[1]]).fetchall()
+        result = {'period': period}
+        for name, (start, end) in (('current', current), ('previous', previous)):
+            orders, revenue, completed, pending = next((row[1:] for row in rows if row[0] == name), (0, 0, 0, 0))
+            result[name] = {'start': start, 'end': end, 'orders': orders, 'revenue': round(revenue, 2),
+                            'avg_order': round(revenue / orders, 2) if orders else 0, 'pending': pending,
+                            'completion_rate': round(completed * 100 / orders, 1) if orders else 0}
+        result['pending_backlog'] = cursor.execute(f"SELECT COALESCE(SUM(order_count), 0) FROM daily_status_rollup WHERE status IN ({backlog_marks})", self.BACKLOG_STATUSES).fetchone()[0]
+        cur, prev = result['current'], result['previous']
+        # Variazioni percentuali (None se il periodo precedente è vuoto); il completamento in punti percentuali
+        result['changes'] = {key: (round((cur[key] - prev[key]) * 100 / prev[key], 1) if prev[key] else None) for key in ('orders', 'revenue', 'avg_order')}
+        result['changes']['completion_rate'] = round(cur['completion_rate'] - prev['completion_rate'], 1) if prev['orders'] else None
+        result['growth'] = result['changes']['revenue']
+        return result
+
+    def get_product_sales(self, days: int = 0, limit: int = None) -> List[dict]:
+        """Quantità, fatturato e numero ordini per prodotto, dal rollup giornaliero per prodotto."""
+        try:
+            where, params = self._rollup_window(days)
+            query = f"SELECT name, SUM(quantity) AS quantity, ROUND(SUM(revenue), 2) AS revenue, SUM(order_count) AS orders FROM daily_product_rollup{where} GROUP BY name ORDER BY quantity DESC"
+            if limit: query += f" LIMIT {int(limit)}"
+            return [dict(row) for row in self._get_reader().execute(query, params).fetchall()]
+        except Exception as e:
+            print(f"❌ Errore calcolo vendite per prodotto: {e}")
+            return []
+
+    @staticmethod
+    def customer_key(email: str) -> str:
+        """Email normalizzata che identifica un cliente, come lower(trim(customer_email)) nelle query."""
+        return (email or '').strip().lower()
+
+    def get_customer(self, email: str) -> dict:
+        row = self._get_reader().execute("SELECT * FROM customers WHERE email = ?", (self.customer_key(email),)).fetchone()
+        return dict(row) if row else None
+
+    def get_customers_for_product(self, product_id: int, date_from: str = None, date_to: str = None, until: str = None) -> List[dict]:
+        """
+        Clienti che hanno acquistato un prodotto, nello stesso formato della vista Liste Clienti. Parte dalla
+        mappa prodotto → ordini (indice su order_items) e include gli ordini archiviati; 'until' limita agli
+        ordini creati fino a quell'istante, cioè alla parte coperta dalla sincronizzazione (get_local_coverage).
+        """
+        try:
+            where, bounds = "", []
+            if date_from: where += " AND o.date_created >= ?"; bounds.append(f"{date_from}T00:00:00")
+            if date_to: where += " AND o.date_created <= ?"; bounds.append(f"{date_to}T23:59:59")
+            if until: where += " AND o.date_created <= ?"; bounds.append(until)
+            branch = "SELECT o.woo_id, o.customer_email, o.customer_name, o.total, o.date_created FROM (SELECT DISTINCT woo_id FROM {schema}.order_items WHERE product_id = ?) i JOIN {schema}.orders o ON o.woo_id = i.woo_id WHERE 1 = 1"
+            source, params = branch.format(schema='main') + where, [product_id] + bounds
+            if self._attach_archive_reader():
+                source += " UNION ALL " + branch.format(schema='archive') + where + " AND NOT EXISTS (SELECT 1 FROM main.orders h WHERE h.woo_id = o.woo_id)"
+                params += [product_id] + bounds
+            query = f'''
+                SELECT lower(trim(p.customer_email)) AS customer_email, COUNT(*) AS total_purchases, COALESCE(SUM(p.total), 0) AS total_spent,
+                       MAX(p.date_created) AS last_purchase, COALESCE(c.customer_name, MAX(p.customer_name), '') AS customer_name, COALESCE(c.phone, '') AS customer_phone
+                FROM ({source}) p LEFT JOIN customers c ON c.email = lower(trim(p.customer_email))
+                WHERE trim(p.customer_email) != ''
+                GROUP BY 1 ORDER BY last_purchase DESC
+            '''
+            return [dict(row) for row in self._get_reader().execute(query, params).fetchall()]
+        except Exception as e:
+            print(f"❌ Errore recupero clienti per prodotto {product_id}: {e}")
+            return []
+
+    def get_local_coverage(self) -> str:
+        """Data di creazione fino alla quale il database contiene tutti gli ordini del negozio: il segnalibro
+        della sincronizzazione delta, valido solo dopo una sincronizzazione completa dal negozio (altrimenti None).
+        Un import da file non basta: l'export potrebbe contenere solo una parte degli ordini."""
+        if self.get_sync_state(self.FULL_SYNC_KEY) is None: return None
+        return self.get_sync_state(self.MODIFIED_AFTER_KEY)
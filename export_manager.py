@@ -6,7 +6,7 @@ Gestisce export automatici CSV/DOCX con dettagli viaggiatori
 Sviluppato da TechExpresso
 """
 
-import os, csv, json, schedule, threading, time
+import os, csv, json, schedule, shutil, threading, time
 from datetime import datetime
 from typing import Dict, List
 
@@ -29,8 +29,11 @@ class ExportManager:
         self.scheduler_running = False
         self.scheduler_thread = None
 
-    @staticmethod
-    def _extract_traveler_data(order: Dict) -> List[Dict]:
+    def _extract_traveler_data(self, order: Dict) -> List[Dict]:
+        # Prima i dati scaricati da gitemania/v1 e salvati in locale, poi i meta_data dell'ordine
+        stored = self.database_manager.get_travelers(order.get('woo_id'))
+        if isinstance(stored, dict): stored = [stored]
+        if stored: return stored
         meta_data = order.get('raw_data', {}).get('meta_data', [])
         possible_keys = ['dati_viaggiatori', '_dati_viaggiatori', 'traveler_data', '_traveler_data', '_viaggiatori_data']
         for item in meta_data:
@@ -61,58 +64,44 @@ class ExportManager:
     def export_orders_csv(self, filters: Dict = None):
         """ Esporta ordini in CSV. Se non ci sono filtri, esporta TUTTI gli ordini. """
         try:
-            final_filters = filters if filters else None
+            # Gli export includono sempre anche gli ordini archiviati
+            final_filters = dict(filters or {}, include_archive=True)
             
             print("\n--- AVVIO EXPORT ORDINI ---")
             print("DEBUG: Export richiesto con i seguenti filtri:", final_filters)
             
-            orders = self.database_manager.get_orders(final_filters)
-            
-            print(f"DEBUG: Il database ha restituito {len(orders)} ordini per l'export.")
-            
-            if not orders:
-                result = ExportResult(success=False, error_message="Nessun ordine trovato con i filtri specificati.")
-                if self.on_export_complete: self.on_export_complete(result, "OrderExport")
-                return
-
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f"export_dettaglio_viaggiatori_{timestamp}.csv"
             file_path = os.path.join(self.exports_dir, filename)
 
             fieldnames = ['ID Ordine', 'Numero Ordine', 'Data Ordine', 'Cliente Principale', 'Email Cliente', 'Stato Ordine', 'Totale Ordine', 'Nome Viaggiatore', 'Cognome Viaggiatore', 'Email Viaggiatore', 'Telefono Viaggiatore', 'Partenza Viaggiatore', 'Prodotti', 'Metodo Pagamento']
             
-            rows_to_write = []
             total_spent_orders = 0.0
-            processed_orders = set()
+            total_orders = 0
+            rows_written = 0
 
-            for order in orders:
-                # Aggiungi il totale dell'ordine solo una volta per ogni ID ordine
-                order_id = order.get('woo_id')
-                if order_id not in processed_orders:
+            # Gli ordini arrivano a blocchi dal database e vengono scritti subito: memoria costante
+            with open(file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+                writer.writeheader()
+                for order in self.database_manager.iter_orders(final_filters):
+                    total_orders += 1
                     total_spent_orders += float(order.get('total', 0.0))
-                    processed_orders.add(order_id)
 
-                common_info = {'ID Ordine': order.get('woo_id', ''), 'Numero Ordine': order.get('order_number', ''), 'Data Ordine': order.get('date_created', ''), 'Cliente Principale': order.get('customer_name', ''), 'Email Cliente': order.get('customer_email', ''), 'Stato Ordine': order.get('status', ''), 'Totale Ordine': order.get('total', 0), 'Metodo Pagamento': order.get('payment_method_title', '')}
-                line_items = json.loads(order['line_items']) if isinstance(order.get('line_items'), str) else order.get('line_items', [])
-                common_info['Prodotti'] = '; '.join([f"{item.get('name', 'N/A')} (x{item.get('quantity', 0)})" for item in line_items])
-                travelers = self._extract_traveler_data(order)
+                    common_info = {'ID Ordine': order.get('woo_id', ''), 'Numero Ordine': order.get('order_number', ''), 'Data Ordine': order.get('date_created', ''), 'Cliente Principale': order.get('customer_name', ''), 'Email Cliente': order.get('customer_email', ''), 'Stato Ordine': order.get('status', ''), 'Totale Ordine': order.get('total', 0), 'Metodo Pagamento': order.get('payment_method_title', '')}
+                    line_items = json.loads(order['line_items']) if isinstance(order.get('line_items'), str) else order.get('line_items', [])
+                    common_info['Prodotti'] = '; '.join([f"{item.get('name', 'N/A')} (x{item.get('quantity', 0)})" for item in line_items])
+                    travelers = self._extract_traveler_data(order)
 
-                if travelers:
-                    for traveler in travelers:
+                    if travelers:
+                        for traveler in travelers:
+                            row = common_info.copy()
+                            row.update({'Nome Viaggiatore': traveler.get('nome', ''), 'Cognome Viaggiatore': traveler.get('cognome', ''), 'Email Viaggiatore': traveler.get('email', ''), 'Telefono Viaggiatore': traveler.get('telefono', ''), 'Partenza Viaggiatore': traveler.get('partenza', '')})
+                            writer.writerow(row); rows_written += 1
+                    else:
                         row = common_info.copy()
-                        row.update({'Nome Viaggiatore': traveler.get('nome', ''), 'Cognome Viaggiatore': traveler.get('cognome', ''), 'Email Viaggiatore': traveler.get('email', ''), 'Telefono Viaggiatore': traveler.get('telefono', ''), 'Partenza Viaggiatore': traveler.get('partenza', '')})
-                        rows_to_write.append(row)
-                else:
-                    row = common_info.copy()
-                    row.update({'Nome Viaggiatore': '', 'Cognome Viaggiatore': '', 'Email Viaggiatore': '', 'Telefono Viaggiatore': '', 'Partenza Viaggiatore': ''})
-                    rows_to_write.append(row)
-            
-            print(f"DEBUG: Sto per scrivere {len(rows_to_write)} righe nel file CSV...")
-            
-            with open(file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(rows_to_write)
+                        row.update({'Nome Viaggiatore': '', 'Cognome Viaggiatore': '', 'Email Viaggiatore': '', 'Telefono Viaggiatore': '', 'Partenza Viaggiatore': ''})
+                        writer.writerow(row); rows_written += 1
                 
                 # --- AGGIUNTA RIGA TOTALI PER EXPORT ORDINI ---
                 writer.writerow({}) # Riga vuota
@@ -120,8 +109,16 @@ class ExportManager:
                     'Stato Ordine': 'TOTALE COMPLESSIVO ORDINI',
                     'Totale Ordine': f"{total_spent_orders:,.2f}"
                 })
+            
+            print(f"DEBUG: Il database ha restituito {total_orders} ordini, scritte {rows_written} righe nel file CSV.")
+            
+            if not total_orders:
+                os.remove(file_path)
+                result = ExportResult(success=False, error_message="Nessun ordine trovato con i filtri specificati.")
+                if self.on_export_complete: self.on_export_complete(result, "OrderExport")
+                return
                 
-            result = ExportResult(success=True, file_name=filename, file_path=file_path, total_records=len(rows_to_write))
+            result = ExportResult(success=True, file_name=filename, file_path=file_path, total_records=rows_written)
             if self.on_export_complete: self.on_export_complete(result, "OrderExport")
             print("--- EXPORT ORDINI COMPLETATO ---")
 
@@ -130,6 +127,124 @@ class ExportManager:
             result = ExportResult(success=False, error_message=error_msg)
             if self.on_export_complete: self.on_export_complete(result, "OrderExport")
 
+    # --- Export colonnare (Parquet / Arrow IPC) -------------------------------------------------
+    # Ordini, righe prodotto e viaggiatori in tre file tipizzati, scritti a blocchi di record man mano
+    # che gli ordini arrivano dal database. Stato, prodotti e metodi di pagamento sono colonne a
+    # dizionario: i dizionari crescono tra un blocco e l'altro, così anche l'IPC li scrive come delta.
+
+    COLUMNAR_BATCH_SIZE = 5000
+
+    def export_orders_columnar(self, filters: Dict = None, file_format: str = 'parquet'):
+        """Esporta in una cartella orders/order_items/travelers in formato 'parquet' o 'arrow' (IPC)."""
+        try:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise RuntimeError("export colonnare non disponibile: installare il pacchetto 'pyarrow'")
+            if file_format not in ('parquet', 'arrow'): raise ValueError(f"Formato non supportato: {file_format}")
+
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            folder_name = f"export_colonnare_{timestamp}"
+            folder_path = os.path.join(self.exports_dir, folder_name)
+            os.makedirs(folder_path, exist_ok=True)
+
+            text, integer, decimal, date = pa.string(), pa.int64(), pa.float64(), pa.timestamp('s')
+            category = pa.dictionary(pa.int32(), pa.string())
+            tables = {
+                'orders': pa.schema([('woo_id', integer), ('order_number', text), ('status', category), ('currency', category),
+                                     ('total', decimal), ('total_tax', decimal), ('shipping_total', decimal), ('customer_id', integer),
+                                     ('customer_email', text), ('customer_name', text), ('payment_method', category),
+                                     ('payment_method_title', category), ('date_created', date), ('date_modified', date), ('date_completed', date)]),
+                'order_items': pa.schema([('woo_id', integer), ('date_created', date), ('status', category), ('product_id', integer),
+                                          ('variation_id', integer), ('name', category), ('quantity', pa.int32()), ('subtotal', decimal), ('total', decimal)]),
+                'travelers': pa.schema([('woo_id', integer), ('nome', text), ('cognome', text), ('email', text), ('telefono', text),
+                                        ('partenza', category), ('info', text)]),
+            }
+            extension = 'parquet' if file_format == 'parquet' else 'arrow'
+            writers, buffers, dictionaries = {}, {name: [] for name in tables}, {}
+            for name, schema in tables.items():
+                path = os.path.join(folder_path, f"{name}.{extension}")
+                if file_format == 'parquet': writers[name] = pq.ParquetWriter(path, schema, compression='zstd')
+                else: writers[name] = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True, compression='zstd'))
+
+            def column(table: str, field, values: list):
+                if not pa.types.is_dictionary(field.type):
+                    if field.type == date: values = [self._parse_timestamp(v) for v in values]
+                    return pa.array(values, type=field.type)
+                # Dizionario condiviso da tutti i blocchi della colonna: i nuovi valori vengono solo aggiunti in coda
+                index = dictionaries.setdefault((table, field.name), {})
+                indices = [None if v in (None, '') else index.setdefault(v, len(index)) for v in values]
+                return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(list(index), type=pa.string()))
+
+            def flush(table: str):
+                rows = buffers[table]
+                if not rows: return
+                schema = tables[table]
+                batch = pa.RecordBatch.from_arrays([column(table, field, [row.get(field.name) for row in rows]) for field in schema], schema=schema)
+                writers[table].write_batch(batch)
+                buffers[table] = []
+
+            total_orders = 0
+            try:
+                for order in self.database_manager.iter_orders(dict(filters or {}, include_archive=True)):
+                    total_orders += 1
+                    woo_id, date_created, status = order.get('woo_id'), order.get('date_created'), order.get('status')
+                    buffers['orders'].append({
+                        'woo_id': woo_id, 'order_number': order.get('order_number'), 'status': status, 'currency': order.get('currency'),
+                        'total': order.get('total'), 'total_tax': order.get('total_tax'), 'shipping_total': order.get('shipping_total'),
+                        'customer_id': order.get('customer_id'), 'customer_email': order.get('customer_email'), 'customer_name': order.get('customer_name'),
+                        'payment_method': order.get('payment_method'), 'payment_method_title': order.get('payment_method_title'),
+                        'date_created': date_created, 'date_modified': order.get('date_modified'), 'date_completed': order.get('date_completed')})
+                    for item in order.get('line_items') or []:
+                        buffers['order_items'].append({
+                            'woo_id': woo_id, 'date_created': date_created, 'status': status,
+                            'product_id': self._to_int(item.get('product_id')), 'variation_id': self._to_int(item.get('variation_id')),
+                            'name': item.get('name'), 'quantity': self._to_int(item.get('quantity')),
+                            'subtotal': self._to_float(item.get('subtotal')), 'total': self._to_float(item.get('total'))})
+                    for traveler in self._extract_traveler_data(order):
+                        buffers['travelers'].append({
+                            'woo_id': woo_id, 'nome': self._to_text(traveler.get('nome')), 'cognome': self._to_text(traveler.get('cognome')),
+                            'email': self._to_text(traveler.get('email')), 'telefono': self._to_text(traveler.get('telefono')),
+                            'partenza': self._to_text(traveler.get('partenza')), 'info': self._to_text(traveler.get('Info'))})
+                    for table, rows in buffers.items():
+                        if len(rows) >= self.COLUMNAR_BATCH_SIZE: flush(table)
+                for table in tables: flush(table)
+            finally:
+                for writer in writers.values(): writer.close()
+
+            if not total_orders:
+                shutil.rmtree(folder_path, ignore_errors=True)
+                result = ExportResult(success=False, error_message="Nessun ordine trovato con i filtri specificati.")
+            else:
+                result = ExportResult(success=True, file_name=folder_name, file_path=folder_path, total_records=total_orders)
+            if self.on_export_complete: self.on_export_complete(result, "ColumnarExport")
+
+        except Exception as e:
+            error_msg = f"Errore durante l'export colonnare degli ordini: {e}"
+            result = ExportResult(success=False, error_message=error_msg)
+            if self.on_export_complete: self.on_export_complete(result, "ColumnarExport")
+
+    @staticmethod
+    def _parse_timestamp(value):
+        if not value: return None
+        try: return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+        except ValueError: return None
+
+    @staticmethod
+    def _to_int(value):
+        try: return int(value) if value not in (None, '') else None
+        except (TypeError, ValueError): return None
+
+    @staticmethod
+    def _to_float(value):
+        try: return float(value) if value not in (None, '') else None
+        except (TypeError, ValueError): return None
+
+    @staticmethod
+    def _to_text(value):
+        return None if value in (None, '') else str(value)
+
     def export_customer_list_csv(self, customers: List[Dict], product_name: str):
         """Esporta una lista di clienti per un prodotto in formato CSV."""
         try:
@@ -4,14 +4,18 @@
 Gestionale Gitemania - Applicazione Desktop (Versione Finale Stabile e Real-time)
 """
 import sys, os, tkinter as tk, threading, queue
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 from typing import Dict, List
 from collections import defaultdict
+from datetime import datetime, timedelta
 
 from config import config
 from woocommerce_api import WooCommerceManager
 from database_manager import DatabaseManager
 from export_manager import ExportManager
+from order_importer import OrderImporter
+from webhook_server import WebhookReceiver
+from traveler_prefetcher import TravelerPrefetcher
 from theme_manager import GiteManiTheme
 from modern_components import ModernStatusBar, ModernOrdersView
 from modern_dashboard import ModernDashboard
@@ -19,6 +23,8 @@ from gui_components import SettingsPanel, AboutDialog, OrderDetailWindow
 from customer_list_view import CustomerListView
 
 class GestionaleGitemania:
+    ORDERS_PAGE_SIZE = 500
+
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("🚀 Gestionale Gitemania - TechExpresso")
@@ -29,7 +35,10 @@ class GestionaleGitemania:
         self.queue = queue.Queue()
         self.database_manager = DatabaseManager()
         self.sync_running = False
+        self.webhook_receiver = None
         self.total_orders_synced = 0
+        self._orders_filters = None
+        self._orders_next_key = None
         
         self._init_application()
 
@@ -70,6 +79,9 @@ class GestionaleGitemania:
                 elif msg_type == "customer_list_updated":
                     self.customer_list_view.update_customer_list(data)
                     self.status_bar.set_status(f"Trovati {len(data)} clienti per il prodotto selezionato.")
+                elif msg_type == "info":
+                    messagebox.showinfo("Gestionale Gitemania", data)
+                    self.status_bar.set_status(data.splitlines()[0])
                 elif msg_type == "error": 
                     messagebox.showerror("Errore", data)
                     self.status_bar.set_status(f"Errore: {data}")
@@ -77,11 +89,23 @@ class GestionaleGitemania:
             self.root.after(200, self._process_queue)
 
     def _init_managers(self):
-        self.woo_manager = WooCommerceManager(on_order_update=self.handle_background_sync)
+        self.woo_manager = WooCommerceManager(on_order_update=self.handle_background_sync, on_idle=self.database_manager.run_maintenance,
+                                              get_watermark=lambda: self.database_manager.get_sync_state(DatabaseManager.MODIFIED_AFTER_KEY))
         self.export_manager = ExportManager(database_manager=self.database_manager, on_export_complete=self._on_export_complete)
+        self.traveler_prefetcher = TravelerPrefetcher(self.woo_manager, self.database_manager)
 
     def handle_background_sync(self, orders: List[Dict]):
-        if orders: self.database_manager.sync_multiple_orders(orders); self.queue.put(("refresh_view", None))
+        # Attende il commit: la pagina e il segnalibro vengono salvati insieme prima di passare alla successiva
+        if any(self.database_manager.submit_orders(orders, watermark_key=DatabaseManager.MODIFIED_AFTER_KEY).result()):
+            self.queue.put(("refresh_view", None)); self.traveler_prefetcher.wake()
+
+    def handle_webhook_order(self, order: Dict):
+        # Niente segnalibro: le consegne possono arrivare fuori ordine, il polling di riconciliazione recupera le mancanti;
+        # una consegna ripetuta o in ritardo non sostituisce una versione più recente già salvata
+        if any(self.database_manager.submit_orders([order], newer_only=True).result()): self.queue.put(("refresh_view", None)); self.traveler_prefetcher.wake()
+
+    def handle_webhook_order_deleted(self, woo_id: int):
+        if self.database_manager.delete_orders([woo_id]): self.queue.put(("refresh_view", None))
 
     def _create_gui(self):
         if os.path.exists('assets/icon.ico'): self.root.iconbitmap('assets/icon.ico')
@@ -100,11 +124,19 @@ class GestionaleGitemania:
         file_menu = tk.Menu(menubar, tearoff=0); menubar.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Connetti", command=self._connect_services)
         file_menu.add_command(label="Disconnetti", command=self._disconnect_services)
-        file_menu.add_separator(); file_menu.add_command(label="Esporta Ordini", command=self._export_orders)
+        file_menu.add_separator(); file_menu.add_command(label="Importa Ordini da File...", command=self._import_orders_file)
+        file_menu.add_command(label="Esporta Ordini", command=self._export_orders)
+        file_menu.add_command(label="Esporta Ordini (Parquet)", command=self._export_orders_columnar)
         file_menu.add_separator(); file_menu.add_command(label="Esci", command=self._on_closing)
         orders_menu = tk.Menu(menubar, tearoff=0); menubar.add_cascade(label="Ordini", menu=orders_menu)
         orders_menu.add_command(label="Sincronizza Recenti", command=self._quick_sync)
         orders_menu.add_command(label="Sincronizza Tutto", command=self._force_sync)
+        tools_menu = tk.Menu(menubar, tearoff=0); menubar.add_cascade(label="Strumenti", menu=tools_menu)
+        tools_menu.add_command(label="Compatta Database", command=self._compact_database)
+        tools_menu.add_command(label="Archivia Ordini Storici", command=self._archive_orders)
+        tools_menu.add_separator()
+        tools_menu.add_command(label="Backup Database", command=self._backup_database)
+        tools_menu.add_command(label="Ripristina Backup...", command=self._restore_database)
         
     def _create_modern_toolbar(self):
         toolbar = ttk.Frame(self.root); toolbar.pack(side='top', fill='x', padx=10, pady=10)
@@ -120,7 +152,7 @@ class GestionaleGitemania:
         main_container = ttk.Frame(self.root); main_container.pack(fill='both', expand=True, padx=10, pady=0)
         self.notebook = ttk.Notebook(main_container, style='TNotebook'); self.notebook.pack(fill='both', expand=True)
         self.dashboard = ModernDashboard(self.notebook); self.notebook.add(self.dashboard, text="📊 Dashboard")
-        self.orders_view = ModernOrdersView(self.notebook, on_filter_apply=self._apply_order_filters); self.notebook.add(self.orders_view, text="📋 Ordini")
+        self.orders_view = ModernOrdersView(self.notebook, on_filter_apply=self._apply_order_filters, on_load_more=self._load_more_orders); self.notebook.add(self.orders_view, text="📋 Ordini")
         self.customer_list_view = CustomerListView(self.notebook, on_filter_apply=self._fetch_customer_list, on_export=self._export_customer_list)
         self.notebook.add(self.customer_list_view, text="👥 Liste Clienti")
         settings_panel = SettingsPanel(self.notebook, current_config=config.config, on_save=self._on_settings_saved, on_test=self._test_connections)
@@ -145,6 +177,8 @@ class GestionaleGitemania:
         if self.woo_manager.initialize(url, key, secret):
             self.root.after(0, self._update_connection_status, True)
             self._start_sync()
+            self._start_webhooks()
+            self.traveler_prefetcher.start()
             self._load_initial_data_from_db()
             self._load_products()
         else:
@@ -153,7 +187,8 @@ class GestionaleGitemania:
     def _load_products(self):
         self.queue.put(("update_status", "Caricamento prodotti..."))
         def task():
-            products = self.woo_manager.get_all_products()
+            try: products = self.woo_manager.get_all_products()
+            except Exception as e: self.queue.put(("error", f"Caricamento prodotti non riuscito: {e}")); return
             self.queue.put(("products_loaded", products))
         threading.Thread(target=task, daemon=True).start()
             
@@ -168,11 +203,18 @@ class GestionaleGitemania:
         self._refresh_orders_view()
         
     def _refresh_orders_view(self, filters: Dict = None):
-        orders = self.database_manager.get_orders(filters)
+        self._orders_filters = filters
+        orders, self._orders_next_key = self.database_manager.get_orders_page(filters, limit=self.ORDERS_PAGE_SIZE, columns=DatabaseManager.LIST_COLUMNS)
         stats = self.database_manager.get_order_stats(0 if not filters else 30)
-        self.orders_view.update_orders(orders)
-        self.dashboard.update_dashboard(stats)
+        self.orders_view.update_orders(orders, has_more=self._orders_next_key is not None)
+        self.dashboard.update_dashboard(stats, self.database_manager.get_kpis('month'))
         self.status_bar.set_status(f"Visualizzati {len(orders)} ordini.")
+
+    def _load_more_orders(self):
+        if self._orders_next_key is None: return
+        orders, self._orders_next_key = self.database_manager.get_orders_page(self._orders_filters, self._orders_next_key, self.ORDERS_PAGE_SIZE, DatabaseManager.LIST_COLUMNS)
+        self.orders_view.append_orders(orders, has_more=self._orders_next_key is not None)
+        self.status_bar.set_status(f"Visualizzati {len(self.orders_view.orders_data)} ordini.")
         
     def _apply_order_filters(self):
         filters = self._get_current_filters()
@@ -182,42 +224,82 @@ class GestionaleGitemania:
         search_term = self.orders_view.search_var.get().strip(); status = self.orders_view.status_var.get().strip(); filters = {};
         if search_term: filters['search_term'] = search_term
         if status: filters['status'] = status
+        if self.orders_view.include_archive_var.get(): filters['include_archive'] = True
         return filters
 
-    def _force_sync(self):
+    def _force_sync(self, modified_after: str = None):
         if not (self.woo_manager and self.woo_manager.api):
             self.queue.put(("error", "Per favore, connettiti prima."))
             return
         
         self.total_orders_synced = 0
-        self.queue.put(("update_status", "Download di tutti gli ordini in corso..."))
+        self.queue.put(("update_status", f"Download degli ordini modificati dal {modified_after}..." if modified_after else "Download di tutti gli ordini in corso..."))
+
+        pending_writes, newest = [], {'modified': None}
+
+        def on_written(future):
+            if future.exception() is None and any(future.result()):
+                self.queue.put(("refresh_view", None))
 
         def process_page(orders_page: List[Dict]):
-            inserted, updated = self.database_manager.sync_multiple_orders(orders_page)
+            # Il salvataggio avviene sul thread scrittore: intanto si scarica la pagina successiva
+            future = self.database_manager.submit_orders(orders_page)
+            future.add_done_callback(on_written)
+            pending_writes.append(future)
+            for order in orders_page:
+                modified = order.get('date_modified')
+                if modified and (newest['modified'] is None or modified > newest['modified']): newest['modified'] = modified
             self.total_orders_synced += len(orders_page)
             self.queue.put(("update_status", f"Sincronizzati {self.total_orders_synced} ordini..."))
-            if inserted > 0 or updated > 0:
-                self.queue.put(("refresh_view", None))
 
         def sync_task():
-            success = self.woo_manager.get_orders_paged(params=None, page_callback=process_page)
+            if modified_after: success = self.woo_manager.get_orders_modified_after(modified_after, page_callback=process_page)
+            else: success = self.woo_manager.get_orders_paged(params=None, page_callback=process_page)
+            for future in pending_writes:
+                if future.exception() is not None: success = False
+            if success and newest['modified']:
+                # Le pagine non arrivano in ordine di modifica: il segnalibro avanza solo a download completo
+                self.database_manager.advance_sync_state(DatabaseManager.MODIFIED_AFTER_KEY, newest['modified'])
+            if success and not modified_after:
+                # Storico completo in locale: da qui in poi le liste clienti non hanno bisogno dell'API
+                self.database_manager.advance_sync_state(DatabaseManager.FULL_SYNC_KEY, datetime.now().isoformat(timespec='seconds'))
             if success:
-                self.queue.put(("sync_finished", self.total_orders_synced))
+                self.queue.put(("sync_finished", self.total_orders_synced)); self.traveler_prefetcher.wake()
             else:
                 self.queue.put(("error", "La sincronizzazione completa è fallita."))
 
         threading.Thread(target=sync_task, daemon=True).start()
 
+    def _import_orders_file(self):
+        file_path = filedialog.askopenfilename(title="Importa export ordini WooCommerce", filetypes=[("Export ordini", "*.json *.ndjson *.jsonl *.gz"), ("Tutti i file", "*.*")])
+        if not file_path: return
+        self.queue.put(("update_status", "Import degli ordini in corso..."))
+        def task():
+            try:
+                result = OrderImporter(self.database_manager).import_file(file_path, progress_callback=lambda count: self.queue.put(("update_status", f"Importati {count} ordini...")))
+            except Exception as e:
+                self.queue.put(("error", f"Import fallito: {e}")); return
+            self.queue.put(("info", f"Import completato: {result['orders']} ordini letti, {result['inserted']} nuovi, {result['updated']} aggiornati."))
+            self.queue.put(("refresh_view", None))
+            # Il resto arriva dal negozio: solo gli ordini modificati dopo il più recente del file
+            if result['newest_modified'] and self.woo_manager and self.woo_manager.api:
+                self._force_sync(self.database_manager.get_sync_state(DatabaseManager.MODIFIED_AFTER_KEY))
+        threading.Thread(target=task, daemon=True).start()
+
     def _quick_sync(self):
         threading.Thread(target=self._quick_sync_task, daemon=True).start()
         
     def _quick_sync_task(self):
         if not (self.woo_manager and self.woo_manager.api): self.queue.put(("error", "Per favore, connettiti prima.")); return
         self.queue.put(("update_status", "Sincronizzazione ordini recenti..."))
-        recent_orders = self.woo_manager.fetch_last_day_orders()
-        if recent_orders is not None:
-            inserted, updated = self.database_manager.sync_multiple_orders(recent_orders)
-            self.queue.put(("sync_complete", (inserted, updated)))
+        totals = [0, 0]
+        def save_page(orders: List[Dict]):
+            inserted, updated = self.database_manager.submit_orders(orders).result()
+            totals[0] += inserted; totals[1] += updated
+        # Tutte le pagine degli ordini modificati nelle ultime 24 ore, non solo la prima
+        since = (datetime.now() - timedelta(days=1)).isoformat(timespec='seconds')
+        if self.woo_manager.get_orders_modified_after(since, page_callback=save_page):
+            self.queue.put(("sync_complete", tuple(totals)))
         else:
             self.queue.put(("error", "Errore durante la sincronizzazione rapida."))
     
@@ -225,13 +307,35 @@ class GestionaleGitemania:
         if self.woo_manager and not self.sync_running:
             self.woo_manager.start_sync(); self.sync_running = True; self.status_bar.set_sync_status(True)
             
+    def _start_webhooks(self):
+        if not config.get('webhook', 'enabled', False) or self.webhook_receiver: return
+        try:
+            receiver = WebhookReceiver(config.get_encrypted('webhook', 'secret'), on_order=self.handle_webhook_order,
+                                       on_order_deleted=self.handle_webhook_order_deleted, host=config.get('webhook', 'host', '127.0.0.1'),
+                                       port=config.get('webhook', 'port', 8765), path=config.get('webhook', 'path', '/webhook'))
+            receiver.start()
+        except (ValueError, OSError) as e:
+            self.queue.put(("error", f"Webhook non avviato: {e}")); return
+        self.webhook_receiver = receiver
+        self.woo_manager.webhooks_active = True
+
+    def _stop_webhooks(self):
+        if not self.webhook_receiver: return
+        self.webhook_receiver.stop(); self.webhook_receiver = None
+        self.woo_manager.webhooks_active = False
+
     def _disconnect_services(self):
+        self._stop_webhooks()
+        self.traveler_prefetcher.stop()
         if self.sync_running:
             self.woo_manager.stop_sync(); self.sync_running = False; self.status_bar.set_sync_status(False)
         self._update_connection_status(False)
         
     def _on_closing(self):
-        if self.sync_running: self.woo_manager.stop_sync()
+        self._stop_webhooks()
+        self.traveler_prefetcher.stop()
+        if self.woo_manager: self.woo_manager.close()
+        self.database_manager.close()
         self.root.destroy()
         
     def _on_settings_saved(self, new_config: Dict):
@@ -250,18 +354,27 @@ class GestionaleGitemania:
             order_id = self.orders_view.selected_order_id
             if order_id is None: return
             
-            order_data = next((order for order in self.orders_view.orders_data if order.get('woo_id') == order_id), None)
+            order_data = self.database_manager.get_order(order_id)
             
             if order_data:
+                # Dati viaggiatori già scaricati in background per questa versione dell'ordine: nessuna chiamata
+                order_hash = order_data.get('hash_signature')
+                stored = self.database_manager.get_travelers(order_id, order_hash)
+                if stored is not None:
+                    order_data['travelers'] = stored
+                    OrderDetailWindow(self.root, order_data)
+                    return
                 self.queue.put(("update_status", f"Caricamento dati viaggiatori per ordine #{order_id}..."))
                 
                 def fetch_viaggiatori_and_show():
                     viaggiatori = self.woo_manager.get_viaggiatori_for_order(order_id)
                     
                     if viaggiatori is not None:
-                        raw_data = order_data.get('raw_data', {})
-                        raw_data['_viaggiatori_data'] = viaggiatori 
-                        order_data['raw_data'] = raw_data
+                        self.database_manager.save_travelers([(order_id, order_hash, viaggiatori)])
+                        order_data['travelers'] = viaggiatori
+                    else:
+                        # Negozio non raggiungibile: meglio i dati di una versione precedente che nessun dato
+                        order_data['travelers'] = self.database_manager.get_travelers(order_id)
                     
                     def open_window():
                         self.queue.put(("update_status", "Pronto."))
@@ -275,11 +388,60 @@ class GestionaleGitemania:
         except Exception as e:
             messagebox.showerror("Errore", f"Impossibile visualizzare i dettagli dell'ordine.\nDettaglio: {e}")
             
+    def _compact_database(self):
+        if not messagebox.askyesno("Compatta Database", "Ricomprimere i dati grezzi di tutti gli ordini?\nL'operazione può richiedere alcuni minuti."): return
+        self.queue.put(("update_status", "Compattazione del database in corso..."))
+        def task():
+            try:
+                result = self.database_manager.compact_raw_data()
+                self.queue.put(("info", f"Database compattato: {result['orders']} ordini.\nDimensione: {result['size_before'] / 1048576:.1f} MB → {result['size_after'] / 1048576:.1f} MB"))
+            except Exception as e:
+                self.queue.put(("error", f"Compattazione del database fallita: {e}"))
+        threading.Thread(target=task, daemon=True).start()
+            
+    def _archive_orders(self):
+        days = config.get('app', 'archive_after_days', DatabaseManager.ARCHIVE_AFTER_DAYS)
+        if not messagebox.askyesno("Archivia Ordini", f"Spostare nell'archivio gli ordini conclusi più vecchi di {days} giorni?\nResteranno consultabili con \"Includi archivio\" e negli export."): return
+        self.queue.put(("update_status", "Archiviazione ordini in corso..."))
+        def task():
+            moved = self.database_manager.archive_orders(days)
+            self.queue.put(("info", f"Ordini archiviati: {moved}."))
+            if moved: self.queue.put(("refresh_view", None))
+        threading.Thread(target=task, daemon=True).start()
+
+    def _backup_database(self):
+        self.queue.put(("update_status", "Backup del database in corso..."))
+        def task():
+            try:
+                result = self.database_manager.backup_database(progress_callback=lambda done, total: self.queue.put(("update_status", f"Backup del database: {done * 100 // max(total, 1)}%")))
+                self.queue.put(("info", f"Backup completato: {os.path.basename(result['path'])} ({result['size'] / 1048576:.1f} MB)."))
+            except Exception as e:
+                self.queue.put(("error", f"Backup fallito: {e}"))
+        threading.Thread(target=task, daemon=True).start()
+
+    def _restore_database(self):
+        backup_path = filedialog.askopenfilename(title="Ripristina backup", initialdir=self.database_manager.backup_dir, filetypes=[("Backup database", "*.db.gz *.db")])
+        if not backup_path: return
+        if not messagebox.askyesno("Ripristina Backup", f"Sostituire i dati attuali con il backup\n{os.path.basename(backup_path)}?"): return
+        self.queue.put(("update_status", "Ripristino del backup in corso..."))
+        def task():
+            try:
+                result = self.database_manager.restore_database(backup_path)
+                self.queue.put(("info", f"Backup ripristinato: {result['orders']} ordini."))
+                self.queue.put(("refresh_view", None))
+            except Exception as e:
+                self.queue.put(("error", f"Ripristino fallito: {e}"))
+        threading.Thread(target=task, daemon=True).start()
+
     def _export_orders(self):
         self.queue.put(("update_status", "Preparazione dell'export in corso..."))
         current_filters = self._get_current_filters()
         threading.Thread(target=self.export_manager.export_orders_csv, args=(current_filters,), daemon=True).start()
         
+    def _export_orders_columnar(self):
+        self.queue.put(("update_status", "Preparazione dell'export colonnare in corso..."))
+        threading.Thread(target=self.export_manager.export_orders_columnar, args=(self._get_current_filters(),), daemon=True).start()
+
     def _on_export_complete(self, result, export_type):
         result_data = {'file_name': result.file_name, 'total_records': result.total_records, 'file_path': result.file_path, 'error_message': result.error_message}
         self.queue.put(("export_complete", (result.success, result_data, export_type)))
@@ -298,15 +460,38 @@ class GestionaleGitemania:
         self.queue.put(("update_status", f"Recupero ordini per il prodotto ID: {product_id}..."))
 
         def task():
-            orders = self.woo_manager.get_orders_for_product(product_id, date_from, date_to)
-            if orders:
-                customers = self._aggregate_customer_data(orders)
-                self.queue.put(("customer_list_updated", customers))
-            else:
-                self.queue.put(("customer_list_updated", []))
+            # Gli ordini creati fino al segnalibro della sincronizzazione sono tutti in locale (anche archiviati):
+            # l'API serve solo per quelli più recenti, o per tutto se lo storico non è mai stato scaricato
+            covered_until = self.database_manager.get_local_coverage()
+            customers = []
+            if covered_until:
+                customers = self.database_manager.get_customers_for_product(product_id, date_from, date_to, until=covered_until)
+                if date_to and f"{date_to}T23:59:59" <= covered_until:
+                    self.queue.put(("customer_list_updated", customers)); return
+            if not (self.woo_manager and self.woo_manager.api):
+                self.queue.put(("customer_list_updated", customers)); return
+            after = max(covered_until, f"{date_from}T00:00:00") if covered_until and date_from else covered_until
+            try: orders = self.woo_manager.get_orders_for_product(product_id, date_from, date_to, after=after)
+            except Exception as e: self.queue.put(("error", f"Recupero ordini del prodotto non riuscito: {e}")); return
+            self.queue.put(("customer_list_updated", self._merge_customer_lists(customers, self._aggregate_customer_data(orders))))
         
         threading.Thread(target=task, daemon=True).start()
 
+    def _merge_customer_lists(self, local: List[Dict], remote: List[Dict]) -> List[Dict]:
+        """Unisce clienti calcolati su intervalli di date disgiunti (locale e API) sommando acquisti e spesa."""
+        merged = {DatabaseManager.customer_key(customer['customer_email']): dict(customer) for customer in local}
+        for customer in remote:
+            key = DatabaseManager.customer_key(customer['customer_email'])
+            current = merged.get(key)
+            if current is None:
+                merged[key] = dict(customer); continue
+            current['total_purchases'] += customer['total_purchases']
+            current['total_spent'] += customer['total_spent']
+            # Clienti con ordini senza data: last_purchase può mancare su uno dei due lati
+            current['last_purchase'] = max(filter(None, (current['last_purchase'], customer['last_purchase'])), default=None)
+            for field in ('customer_name', 'customer_phone'): current[field] = current[field] or customer[field]
+        return sorted(merged.values(), key=lambda customer: customer['last_purchase'] or '', reverse=True)
+
     def _aggregate_customer_data(self, orders: List[Dict]) -> List[Dict]:
         customer_agg = defaultdict(lambda: {
             'total_purchases': 0,
@@ -318,7 +503,7 @@ class GestionaleGitemania:
         })
 
         for order in orders:
-            email = order.get('billing', {}).get('email', '').lower()
+            email = DatabaseManager.customer_key(order.get('billing', {}).get('email'))
             if not email:
                 continue
 
@@ -326,7 +511,7 @@ class GestionaleGitemania:
             customer['total_purchases'] += 1
             customer['total_spent'] += float(order.get('total', 0.0))
 
-            if order.get('date_created') > customer['last_purchase']:
+            if (order.get('date_created') or '') > customer['last_purchase']:
                 customer['last_purchase'] = order.get('date_created')
 
             if not customer['customer_name']:
@@ -60,7 +60,7 @@ class AboutDialog(tk.Toplevel):
 class OrderDetailWindow(tk.Toplevel):
     def __init__(self, parent, order: Dict):
         super().__init__(parent)
-        self.title(f"Dettaglio Ordine #{order.get('number', '')}")
+        self.title(f"Dettaglio Ordine #{order.get('order_number') or order.get('woo_id', '')}")
         self.geometry("800x650")
         
         main_frame = ttk.Frame(self, padding=10)
@@ -180,6 +180,10 @@ class OrderDetailWindow(tk.Toplevel):
                 return [{'Info': str(value)}]
             return None
 
+        # Dati dell'endpoint gitemania/v1 salvati nel database locale
+        result = process_value(order.get('travelers'))
+        if result: return result
+
         # Cerca nei meta_data (dove il filtro PHP li inserirà)
         meta_data = raw_data.get('meta_data', [])
         for item in meta_data:
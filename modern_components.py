@@ -37,10 +37,12 @@ class ModernStatusBar(ttk.Frame):
         self.sync_indicator.configure(text="🔄" if syncing else "⏸️")
 
 class ModernOrdersView(ttk.Frame):
-    def __init__(self, parent, on_filter_apply: Callable, **kwargs):
+    def __init__(self, parent, on_filter_apply: Callable, on_load_more: Callable = None, **kwargs):
         super().__init__(parent, **kwargs)
         self.orders_data = []
         self.on_filter_apply = on_filter_apply
+        self.on_load_more = on_load_more
+        self._search_after_id = None
         self._create_widgets()
 
     def _create_widgets(self):
@@ -50,6 +52,12 @@ class ModernOrdersView(ttk.Frame):
         # --- NUOVA BARRA FILTRI ---
         self._create_filter_bar()
 
+        # --- Caricamento a pagine ---
+        pager_frame = ttk.Frame(self, padding=(10, 0, 10, 5))
+        pager_frame.pack(fill='x', side='bottom')
+        self.load_more_button = ttk.Button(pager_frame, text="Carica altri ordini", command=lambda: self.on_load_more and self.on_load_more(), state='disabled')
+        self.load_more_button.pack(side='right')
+
         table_container = ttk.Frame(self, style='Card.TFrame', padding=10)
         table_container.pack(fill='both', expand=True, padx=10, pady=5)
         
@@ -75,6 +83,7 @@ class ModernOrdersView(ttk.Frame):
         search_entry = ttk.Entry(filter_frame, textvariable=self.search_var, width=30)
         search_entry.pack(side='left', padx=(0, 15))
         search_entry.bind("<Return>", lambda event: self.on_filter_apply())
+        search_entry.bind("<KeyRelease>", self._on_search_typed)
 
         # --- Filtro per stato ---
         ttk.Label(filter_frame, text="Stato:").pack(side='left', padx=(0, 5))
@@ -83,6 +92,10 @@ class ModernOrdersView(ttk.Frame):
         status_combo = ttk.Combobox(filter_frame, textvariable=self.status_var, values=status_options, state="readonly", width=15)
         status_combo.pack(side='left', padx=(0, 15))
 
+        # --- Ricerca anche negli ordini archiviati ---
+        self.include_archive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(filter_frame, text="Includi archivio", variable=self.include_archive_var, command=self.on_filter_apply).pack(side='left', padx=(0, 15))
+
         # --- Pulsanti ---
         apply_button = ttk.Button(filter_frame, text="Applica Filtri", command=self.on_filter_apply, style="Primary.TButton")
         apply_button.pack(side='left', padx=5)
@@ -90,16 +103,30 @@ class ModernOrdersView(ttk.Frame):
         clear_button = ttk.Button(filter_frame, text="Pulisci", command=self._clear_filters)
         clear_button.pack(side='left', padx=5)
 
+    def _on_search_typed(self, event=None):
+        # Ricerca mentre si digita (indice full-text): attende una breve pausa prima di interrogare il DB
+        if event is not None and event.keysym == 'Return': return
+        if self._search_after_id: self.after_cancel(self._search_after_id)
+        term = self.search_var.get().strip()
+        self._search_after_id = self.after(300, self.on_filter_apply) if not term or len(term) >= 3 else None
+
     def _clear_filters(self):
         self.search_var.set("")
         self.status_var.set("")
+        self.include_archive_var.set(False)
         self.on_filter_apply()
         
-    def update_orders(self, orders: List[Dict]):
-        self.orders_data = orders
+    def update_orders(self, orders: List[Dict], has_more: bool = False):
+        self.orders_data = list(orders)
         self.tree.delete(*self.tree.get_children())
         if orders:
             for order in orders: self._add_order_to_tree(order)
+        self.load_more_button.configure(state='normal' if has_more else 'disabled')
+
+    def append_orders(self, orders: List[Dict], has_more: bool = False):
+        self.orders_data.extend(orders)
+        for order in orders: self._add_order_to_tree(order)
+        self.load_more_button.configure(state='normal' if has_more else 'disabled')
             
     def _on_double_click(self, event):
         if not self.tree.selection(): return
@@ -114,8 +141,7 @@ class ModernOrdersView(ttk.Frame):
     def _add_order_to_tree(self, order: Dict):
         try:
             order_id = f"#{order.get('woo_id', 'N/D')}"
-            billing = order.get('billing_data', {}) or {}
-            customer_name = f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip() or billing.get('email', 'N/D')
+            customer_name = order.get('customer_name') or order.get('customer_email') or 'N/D'
             status_raw = order.get('status', 'n/d').lower()
             status_text = f"{GiteManiTheme.get_status_icon(status_raw)} {status_raw.capitalize()}"
             total_text = f"€ {float(order.get('total', 0.0)):,.2f}"
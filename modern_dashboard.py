@@ -45,12 +45,12 @@ class ModernDashboard(ttk.Frame):
         }
         
         kpi_data = [
-            ("Ordini Totali", "total_orders", "📦", "primary"),
-            ("Fatturato", "total_revenue", "€", "success"),
+            ("Ordini del Mese", "total_orders", "📦", "primary"),
+            ("Fatturato del Mese", "total_revenue", "€", "success"),
             ("Ordine Medio", "avg_order", "🛒", "info"),
             ("In Elaborazione", "pending_orders", "🔄", "warning"),
             ("Crescita Mensile", "growth", "📈", "primary"),
-            ("Tasso Conversione", "conversion", "🎯", "success")
+            ("Tasso Completamento", "conversion", "🎯", "success")
         ]
 
         for i, (title, key, icon, color) in enumerate(kpi_data):
@@ -116,43 +116,48 @@ class ModernDashboard(ttk.Frame):
         
         self._update_all_charts({})
 
-    def update_dashboard(self, stats: Dict):
+    def update_dashboard(self, stats: Dict, kpis: Dict = None):
         self.stats_data = stats
-        self._update_kpi(stats)
+        self._update_kpi(kpis or {})
         self._update_all_charts(stats)
-        
-    def _update_kpi(self, stats: Dict):
-        total_orders = stats.get('total_orders', 0)
-        total_revenue = stats.get('total_revenue', 0)
-        pending_orders = (stats.get('by_status', {}).get('processing', 0) + 
-                          stats.get('by_status', {}).get('pending', 0))
-        avg_order = total_revenue / total_orders if total_orders > 0 else 0
-        
-        self.kpi_vars['total_orders']['value'].set(f"{total_orders:,}")
-        self.kpi_vars['total_orders']['trend'].set("▲ +15% vs mese prec.")
-        
-        self.kpi_vars['total_revenue']['value'].set(f"€{total_revenue:,.2f}")
-        self.kpi_vars['total_revenue']['trend'].set("▲ +12% vs mese prec.")
 
-        self.kpi_vars['avg_order']['value'].set(f"€{avg_order:.2f}")
-        self.kpi_vars['avg_order']['trend'].set("▼ -2% vs mese prec.")
+    @staticmethod
+    def _format_trend(change, unit: str = "%") -> str:
+        if change is None: return "Nessun dato mese prec."
+        if change == 0: return "Invariato vs mese prec."
+        return f"{'▲' if change > 0 else '▼'} {change:+.1f}{unit} vs mese prec."
+        
+    def _update_kpi(self, kpis: Dict):
+        """KPI del mese in corso confrontati con lo stesso intervallo del mese precedente (DatabaseManager.get_kpis)."""
+        current = kpis.get('current', {})
+        changes = kpis.get('changes', {})
+        
+        self.kpi_vars['total_orders']['value'].set(f"{current.get('orders', 0):,}")
+        self.kpi_vars['total_orders']['trend'].set(self._format_trend(changes.get('orders')))
+        
+        self.kpi_vars['total_revenue']['value'].set(f"€{current.get('revenue', 0):,.2f}")
+        self.kpi_vars['total_revenue']['trend'].set(self._format_trend(changes.get('revenue')))
+
+        self.kpi_vars['avg_order']['value'].set(f"€{current.get('avg_order', 0):.2f}")
+        self.kpi_vars['avg_order']['trend'].set(self._format_trend(changes.get('avg_order')))
 
-        self.kpi_vars['pending_orders']['value'].set(f"{pending_orders}")
-        self.kpi_vars['pending_orders']['trend'].set("Invariato")
+        self.kpi_vars['pending_orders']['value'].set(f"{kpis.get('pending_backlog', 0)}")
+        self.kpi_vars['pending_orders']['trend'].set(f"{current.get('pending', 0)} aperti questo mese")
 
-        self.kpi_vars['growth']['value'].set("+12.5%")
-        self.kpi_vars['growth']['trend'].set("Obiettivo: 15%")
+        growth = kpis.get('growth')
+        self.kpi_vars['growth']['value'].set(f"{growth:+.1f}%" if growth is not None else "n/d")
+        self.kpi_vars['growth']['trend'].set("Fatturato vs mese prec.")
         
-        self.kpi_vars['conversion']['value'].set("3.2%")
-        self.kpi_vars['conversion']['trend'].set("▲ +0.5% vs mese prec.")
+        self.kpi_vars['conversion']['value'].set(f"{current.get('completion_rate', 0):.1f}%")
+        self.kpi_vars['conversion']['trend'].set(self._format_trend(changes.get('completion_rate'), " pt"))
 
         for key, trend_info in self.kpi_vars.items():
             widget = trend_info['trend']._widget
             if hasattr(widget, 'winfo_exists') and widget.winfo_exists():
                 text = trend_info['trend'].get()
-                if '▲' in text or '+' in text:
+                if '▲' in text:
                     widget.configure(foreground=GiteManiTheme.COLORS['success'])
-                elif '▼' in text or '-' in text:
+                elif '▼' in text:
                     widget.configure(foreground=GiteManiTheme.COLORS['danger'])
                 else:
                     widget.configure(foreground=GiteManiTheme.COLORS['text_secondary'])
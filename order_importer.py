@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import offline degli ordini per Gestionale Gitemania
+Legge un export ordini WooCommerce (array JSON o NDJSON, anche compresso .gz) a flusso
+e lo passa al DatabaseManager senza caricare l'intero file in memoria
+"""
+
+import gzip, json
+from typing import Dict, Iterator
+
+class OrderImporter:
+    READ_CHUNK_SIZE = 1 << 20  # caratteri letti per volta dal file
+
+    def __init__(self, database_manager):
+        self.database_manager = database_manager
+
+    def import_file(self, file_path: str, progress_callback=None, batch_size: int = None) -> dict:
+        """Importa il file in un'unica transazione; progress_callback riceve il numero di ordini letti finora."""
+        with self._open(file_path) as handle:
+            return self.database_manager.bulk_import(self.iter_orders(handle), batch_size, progress_callback)
+
+    @staticmethod
+    def _open(file_path: str):
+        # Il formato compresso si riconosce dal contenuto, non dall'estensione
+        with open(file_path, 'rb') as probe: compressed = probe.read(2) == b'\x1f\x8b'
+        if compressed: return gzip.open(file_path, 'rt', encoding='utf-8-sig')
+        return open(file_path, 'r', encoding='utf-8-sig')
+
+    def iter_orders(self, handle) -> Iterator[Dict]:
+        """Ordini uno alla volta: '[' iniziale = array JSON, altrimenti un oggetto JSON per riga (NDJSON)."""
+        buffer = handle.read(self.READ_CHUNK_SIZE).lstrip()
+        if buffer.startswith('['):
+            yield from self._iter_json_array(handle, buffer[1:])
+            return
+        line_number = 0
+        for line in self._iter_lines(handle, buffer):
+            line_number += 1
+            if not line.strip(): continue
+            try: yield json.loads(line)
+            except json.JSONDecodeError as e: raise ValueError(f"Riga {line_number} non valida: {e}") from e
+
+    def _iter_lines(self, handle, buffer: str) -> Iterator[str]:
+        while buffer:
+            *lines, buffer = buffer.split('\n')
+            yield from lines
+            chunk = handle.read(self.READ_CHUNK_SIZE)
+            if not chunk: break
+            buffer += chunk
+        if buffer: yield buffer
+
+    def _iter_json_array(self, handle, buffer: str) -> Iterator[Dict]:
+        decoder, position, eof = json.JSONDecoder(), 0, False
+        while True:
+            # Salta spazi e virgole tra un elemento e l'altro
+            while position < len(buffer) and buffer[position] in ' \t\r\n,': position += 1
+            if position < len(buffer) and buffer[position] == ']': return
+            try:
+                order, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # Elemento a cavallo tra due blocchi: si legge altro testo e si riprova
+                if eof: raise ValueError(f"Array JSON non valido: {e}") from e
+                chunk = handle.read(self.READ_CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk; position = 0
+                continue
+            yield order
+            position = end
+            if position > self.READ_CHUNK_SIZE:
+                buffer = buffer[position:]; position = 0
@@ -8,7 +8,15 @@ Sviluppato da TechExpresso
 
 import sys
 import os
+import gzip
+import json
+import shutil
+import sqlite3
+import tempfile
 import unittest
+import time
+import threading
+import requests
 from unittest.mock import Mock, patch, MagicMock
 from datetime import datetime, timedelta
 
@@ -16,9 +24,18 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from config import Config
-from woocommerce_api import WooCommerceManager
+from woocommerce_api import WooCommerceManager, RateLimiter
 from supabase_manager import SupabaseManager
 from export_manager import ExportManager
+from database_manager import DatabaseManager
+from order_importer import OrderImporter
+from webhook_server import WebhookReceiver
+from traveler_prefetcher import TravelerPrefetcher
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 class TestConfig(unittest.TestCase):
     """Test configurazione applicazione"""
@@ -58,8 +75,9 @@ class TestWooCommerceManager(unittest.TestCase):
     
     def setUp(self):
         self.woo_manager = WooCommerceManager()
+        self.woo_manager.rate_limiter = RateLimiter(rate=50, max_rate=50, burst=8)  # server finto: nessuna attesa
         
-    @patch('woocommerce_api.API')
+    @patch('woocommerce_api.SessionAPI')
     def test_initialization_success(self, mock_api):
         """Test inizializzazione WooCommerce riuscita"""
         # Mock API response
@@ -117,6 +135,83 @@ class TestWooCommerceManager(unittest.TestCase):
         # Test che non sollevi eccezioni
         self.woo_manager._default_order_handler(test_event)
         
+    def test_orders_paged_concurrent_in_order(self):
+        """Test download parallelo delle pagine con consegna ordinata"""
+        import random
+        total, active, peak, lock = 730, [0], [0], threading.Lock()
+        def fake_get(endpoint, params=None):
+            with lock: active[0] += 1; peak[0] = max(peak[0], active[0])
+            time.sleep(random.uniform(0, 0.01))
+            start = (params['page'] - 1) * params['per_page']
+            response = Mock()
+            response.json.return_value = [{'id': i} for i in range(start + 1, min(start + params['per_page'], total) + 1)]
+            response.headers = {'X-WP-Total': str(total), 'X-WP-TotalPages': '8'}
+            with lock: active[0] -= 1
+            return response
+        self.woo_manager.api = Mock(get=Mock(side_effect=fake_get))
+        pages = []
+        self.assertTrue(self.woo_manager.get_orders_paged(page_callback=pages.append, concurrency=3))
+        self.assertEqual([o['id'] for page in pages for o in page], list(range(1, total + 1)))
+        self.assertLessEqual(peak[0], 3)
+        unordered = []
+        self.assertTrue(self.woo_manager.get_orders_paged(page_callback=unordered.append, ordered=False))
+        self.assertEqual(sorted(o['id'] for page in unordered for o in page), list(range(1, total + 1)))
+
+    def test_retry_and_rate_limit(self):
+        """Test nuovi tentativi su 429/503 con Retry-After e nessun risultato parziale"""
+        self.woo_manager.RETRY_BACKOFF_BASE = 0.01
+        calls = []
+        def make_response(status, body=None, headers=None):
+            response = Mock(status_code=status, reason='', headers=headers or {})
+            response.json.return_value = body
+            response.raise_for_status.side_effect = None if status < 400 else Exception(f"HTTP {status}")
+            return response
+        def fake_get(endpoint, params=None):
+            calls.append((params['page'], time.monotonic()))
+            if len(calls) == 1: return make_response(429, headers={'Retry-After': '0.2'})
+            if len(calls) == 3: return make_response(503)
+            headers = {'X-WP-Total': '150', 'X-WP-TotalPages': '2'}
+            return make_response(200, [{'id': params['page']}] * (100 if params['page'] == 1 else 50), headers)
+        self.woo_manager.api = Mock(get=Mock(side_effect=fake_get))
+        rate = self.woo_manager.rate_limiter.rate
+        self.assertEqual(len(self.woo_manager.get_all_products()), 150)
+        self.assertGreaterEqual(calls[1][1] - calls[0][1], 0.2)  # Retry-After rispettato
+        self.assertEqual([page for page, _ in calls], [1, 1, 2, 2])
+        self.assertLess(self.woo_manager.rate_limiter.rate, rate)  # 429/503 rallentano tutto il client
+        # Errore persistente: eccezione invece di una lista troncata
+        self.woo_manager.rate_limiter = RateLimiter(rate=50, max_rate=50, burst=8)
+        self.woo_manager.api = Mock(get=Mock(return_value=make_response(502)))
+        with self.assertRaises(Exception):
+            self.woo_manager.get_orders_for_product(10)
+
+    def test_session_reuses_connections(self):
+        """Test sessione keep-alive condivisa da wc/v3 e gitemania/v1"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        seen, queries = [], []
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                seen.append((self.client_address[1], self.path.split('?')[0]))
+                queries.append(self.path.partition('?')[2])
+                body = b'[]'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers(); self.wfile.write(body)
+            def log_message(self, *args): pass
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.assertTrue(self.woo_manager.initialize(f"http://127.0.0.1:{server.server_port}", "ck_test", "cs_test"))
+            self.assertEqual(self.woo_manager.get_viaggiatori_for_order(42), [])
+            self.woo_manager.api.get('orders')
+        finally:
+            self.woo_manager.close(); server.shutdown(); server.server_close()
+        self.assertEqual([path for _, path in seen],
+                         ['/wp-json/wc/v3/system_status', '/wp-json/gitemania/v1/viaggiatori/42', '/wp-json/wc/v3/orders'])
+        self.assertEqual(len({port for port, _ in seen}), 1)
+        # Negozio HTTP: ogni richiesta firmata OAuth 1.0a come farebbe la libreria
+        self.assertTrue(all('oauth_signature=' in query and 'oauth_consumer_key=ck_test' in query for query in queries))
+
 class TestSupabaseManager(unittest.TestCase):
     """Test Supabase Database Manager"""
     
@@ -170,6 +265,535 @@ class TestSupabaseManager(unittest.TestCase):
         self.assertEqual(extracted['customer_name'], 'Mario Rossi')
         self.assertEqual(extracted['hash_signature'], 'test_hash')
         
+def make_test_order(woo_id, status='completed', total='100.00', date='2025-01-01T12:00:00', **extra):
+    """Ordine WooCommerce minimale per i test del database locale"""
+    order = {
+        'id': woo_id,
+        'number': str(woo_id),
+        'status': status,
+        'total': total,
+        'billing': {'email': f'cliente{woo_id}@example.com', 'first_name': 'Mario', 'last_name': 'Rossi'},
+        'line_items': [{'product_id': 10, 'variation_id': 0, 'name': 'Tour Dolomiti', 'quantity': 2, 'subtotal': total, 'total': total}],
+        'date_created': date,
+        'date_modified': date
+    }
+    order.update(extra)
+    return order
+
+class TestDatabaseManager(unittest.TestCase):
+    """Test Database Manager SQLite locale"""
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = DatabaseManager(os.path.join(self.tmp_dir, 'test.db'))
+        
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        
+    def test_sync_counts_inserted_and_updated(self):
+        """Test conteggio inseriti/aggiornati nell'upsert per pagina"""
+        self.assertEqual(self.db.sync_multiple_orders([make_test_order(1), make_test_order(2)]), (2, 0))
+        
+        # Ordine invariato = nessuna scrittura, ordine modificato = aggiornamento
+        self.assertEqual(self.db.sync_multiple_orders([make_test_order(1), make_test_order(2, status='refunded'), make_test_order(3)]), (1, 1))
+        
+        statuses = {o['woo_id']: o['status'] for o in self.db.get_orders()}
+        self.assertEqual(statuses, {1: 'completed', 2: 'refunded', 3: 'completed'})
+        
+    def test_search_orders(self):
+        """Test ricerca ordini per sottostringa e più parole"""
+        order = make_test_order(7, billing={'email': 'giulia.bianchi@example.com', 'first_name': 'Giulia', 'last_name': 'Bianchi'})
+        self.db.sync_multiple_orders([order, make_test_order(8)])
+        
+        for term in ['bianchi', 'ulia bian', 'GIULIA example', '7']:
+            found = [o['woo_id'] for o in self.db.get_orders({'search_term': term})]
+            self.assertEqual(found, [7], term)
+            
+    def test_product_sales_from_order_items(self):
+        """Test aggregazioni per prodotto dalla tabella order_items"""
+        self.db.sync_multiple_orders([make_test_order(1), make_test_order(2, total='50.00')])
+        
+        sales = self.db.get_product_sales()
+        self.assertEqual(sales, [{'name': 'Tour Dolomiti', 'quantity': 4, 'revenue': 150.0, 'orders': 2}])
+        self.assertEqual(self.db.get_order_stats()['top_products'], {'Tour Dolomiti': 4})
+        self.assertEqual(len(self.db.get_customers_for_product(10)), 2)
+        
+    def test_rollups_follow_status_changes(self):
+        """Test aggiornamento incrementale dei rollup giornalieri"""
+        self.db.sync_multiple_orders([make_test_order(1, status='processing'), make_test_order(2)])
+        self.db.sync_multiple_orders([make_test_order(1, status='completed', total='80.00')])
+        
+        stats = self.db.get_order_stats()
+        self.assertEqual(stats['by_status'], {'completed': 2})
+        self.assertEqual(stats['total_orders'], 2)
+        self.assertEqual(stats['total_revenue'], 180.0)
+        self.assertEqual(stats['by_date'], {'2025-01-01': 2})
+        
+    def test_order_records_projection(self):
+        """Test record ordine con decodifica JSON pigra e proiezione colonne"""
+        self.db.sync_multiple_orders([make_test_order(1)])
+        
+        full = self.db.get_order(1)
+        self.assertEqual(full['billing_data']['email'], 'cliente1@example.com')
+        self.assertEqual(full.get('raw_data', {}).get('number'), '1')
+        
+        listed = self.db.get_orders(columns=DatabaseManager.LIST_COLUMNS)[0]
+        self.assertEqual(listed['customer_name'], 'Mario Rossi')
+        self.assertNotIn('raw_data', listed)
+        self.assertEqual(listed.get('raw_data', {}), {})
+        
+    def test_keyset_pagination(self):
+        """Test paginazione keyset e iteratore a blocchi"""
+        orders = [make_test_order(i, date=f'2025-01-{i:02d}T10:00:00') for i in range(1, 11)]
+        self.db.sync_multiple_orders(orders)
+        
+        page, next_key = self.db.get_orders_page(limit=4)
+        self.assertEqual([o['woo_id'] for o in page], [10, 9, 8, 7])
+        page, next_key = self.db.get_orders_page(after_key=next_key, limit=4)
+        self.assertEqual([o['woo_id'] for o in page], [6, 5, 4, 3])
+        page, next_key = self.db.get_orders_page(after_key=next_key, limit=4)
+        self.assertEqual([o['woo_id'] for o in page], [2, 1])
+        self.assertIsNone(next_key)
+        
+        self.assertEqual([o['woo_id'] for o in self.db.iter_orders(batch_size=3)], list(range(10, 0, -1)))
+
+    def test_iter_orders_includes_undated(self):
+        """Test ordini senza date_created presenti sia in get_orders sia in iter_orders"""
+        orders = [make_test_order(i, date=f'2025-01-{i:02d}T10:00:00') for i in range(1, 6)]
+        orders += [make_test_order(i, date=None) for i in range(6, 9)]
+        self.db.sync_multiple_orders(orders)
+        expected = [o['woo_id'] for o in self.db.get_orders()]
+        self.assertEqual(len(expected), 8)
+        for batch_size in (2, 3, 5, 100):
+            self.assertEqual([o['woo_id'] for o in self.db.iter_orders(batch_size=batch_size)], expected)
+        # Un errore di lettura interrompe l'iterazione con un'eccezione, non con un elenco troncato
+        with patch.object(self.db, '_build_orders_query', side_effect=sqlite3.OperationalError('disk I/O error')):
+            with self.assertRaises(sqlite3.OperationalError):
+                list(self.db.iter_orders())
+        
+    def test_compressed_raw_data_roundtrip(self):
+        """Test raw_data compresso e ricomposto in modo trasparente"""
+        order = make_test_order(1, shipping={'city': 'Bolzano'}, shipping_lines=[], meta_data=[{'key': 'nota', 'value': 'x'}])
+        self.db.sync_multiple_orders([order])
+        self.assertEqual(self.db.get_order(1)['raw_data'], order)
+        
+        result = self.db.compact_raw_data()
+        self.assertEqual(result['orders'], 1)
+        self.assertEqual(self.db.get_order(1)['raw_data'], order)
+        
+    def test_customers_maintained_at_ingest(self):
+        """Test tabella clienti e liste clienti per prodotto dal database locale"""
+        billing = {'email': 'Anna@Example.com ', 'first_name': 'Anna', 'last_name': 'Verdi', 'phone': '3331234567'}
+        self.db.sync_multiple_orders([
+            make_test_order(1, billing=billing, date='2025-02-01T10:00:00'),
+            make_test_order(2, billing=billing, total='50.00', date='2025-03-01T10:00:00', line_items=[{'product_id': 20, 'name': 'Tour Etna', 'quantity': 1, 'total': '50.00'}]),
+        ])
+        
+        customer = self.db.get_customer('anna@example.com')
+        self.assertEqual(customer['purchase_count'], 2)
+        self.assertEqual(customer['total_spent'], 150.0)
+        self.assertEqual(customer['phone'], '3331234567')
+        self.assertEqual(customer['first_purchase'], '2025-02-01T10:00:00')
+        
+        customers = self.db.get_customers_for_product(20)
+        self.assertEqual(len(customers), 1)
+        self.assertEqual(customers[0]['customer_email'], 'anna@example.com')
+        self.assertEqual(customers[0]['total_purchases'], 1)
+        self.assertEqual(self.db.get_customers_for_product(20, date_to='2025-02-28'), [])
+
+    def test_write_queue_batches_from_threads(self):
+        """Test coda di scrittura: batch concorrenti con conteggi per singolo Future"""
+        futures = []
+
+        def submit(start):
+            futures.append(self.db.submit_orders([make_test_order(start + i) for i in range(50)]))
+
+        threads = [threading.Thread(target=submit, args=(n * 100,)) for n in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        self.assertEqual([f.result(timeout=10) for f in futures], [(50, 0)] * 8)
+        self.assertEqual(self.db.sync_multiple_orders([make_test_order(0, status='processing')]), (0, 1))
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 400)
+
+    def test_result_cache_follows_data_generation(self):
+        """Test cache dei risultati invalidata solo da modifiche reali"""
+        self.db.sync_multiple_orders([make_test_order(1), make_test_order(2)])
+        generation = self.db.data_generation
+        first = self.db.get_orders({'search_term': 'Rossi '})
+        with patch.object(self.db, '_query_orders', side_effect=AssertionError("risultato non servito dalla cache")):
+            cached = self.db.get_orders({'search_term': 'rossi'})
+        # Record annotati dal chiamante non modificano la cache
+        first[0]['status'] = 'annotato'; first[0]['billing_data']['email'] = 'x'; first[0]['_riga'] = 1
+        self.assertIsNot(cached[0], first[0])
+        self.assertEqual(self.db.get_orders()[0]['status'], 'completed')
+        self.assertEqual(self.db.get_orders({'search_term': 'rossi'})[0]['billing_data']['email'], 'cliente2@example.com')
+        page, _ = self.db.get_orders_page(limit=1)
+        page[0]['status'] = 'annotato'
+        self.assertEqual(self.db.get_orders_page(limit=1)[0][0]['status'], 'completed')
+        
+        # Pagina identica = nessuna nuova generazione, statistiche servite dalla cache
+        self.db.sync_multiple_orders([make_test_order(1)])
+        self.assertEqual(self.db.data_generation, generation)
+        self.db.get_order_stats()['by_status']['completed'] = 0
+        self.assertEqual(self.db.get_order_stats()['by_status'], {'completed': 2})
+        
+        self.db.sync_multiple_orders([make_test_order(3, status='processing')])
+        self.assertGreater(self.db.data_generation, generation)
+        self.assertEqual(len(self.db.get_orders()), 3)
+        self.assertEqual(self.db.get_order_stats()['by_status'], {'completed': 2, 'processing': 1})
+
+    def test_kpis_compare_with_previous_period(self):
+        """Test KPI periodo corrente contro lo stesso intervallo del periodo precedente"""
+        self.db.sync_multiple_orders([
+            make_test_order(1, date='2025-03-05T10:00:00'),
+            make_test_order(2, status='processing', total='50.00', date='2025-03-10T10:00:00'),
+            make_test_order(3, date='2025-02-03T10:00:00'),
+            make_test_order(4, date='2025-02-20T10:00:00'),  # oltre il 12 febbraio: fuori dal confronto
+            make_test_order(5, status='pending', date='2024-12-01T10:00:00'),
+        ])
+        
+        kpis = self.db.get_kpis('month', today=datetime(2025, 3, 12))
+        self.assertEqual((kpis['previous']['start'], kpis['previous']['end']), ('2025-02-01', '2025-02-12'))
+        self.assertEqual(kpis['current']['orders'], 2)
+        self.assertEqual(kpis['current']['revenue'], 150.0)
+        self.assertEqual(kpis['current']['avg_order'], 75.0)
+        self.assertEqual(kpis['current']['completion_rate'], 50.0)
+        self.assertEqual(kpis['pending_backlog'], 2)
+        self.assertEqual(kpis['changes']['orders'], 100.0)
+        self.assertEqual(kpis['growth'], 50.0)
+        self.assertIsNone(self.db.get_kpis('ytd', today=datetime(2025, 3, 12))['growth'])
+
+    def test_archive_old_final_orders(self):
+        """Test archivio storico: viste correnti senza archivio, letture storiche con ATTACH"""
+        self.db.sync_multiple_orders([
+            make_test_order(1, date='2020-01-01T10:00:00'),
+            make_test_order(2, status='processing', date='2020-01-02T10:00:00'),  # non finale: resta
+            make_test_order(3, date=datetime.now().strftime('%Y-%m-%dT%H:%M:%S')),
+        ])
+        
+        self.assertEqual(self.db.archive_orders(older_than_days=1500), 1)
+        self.assertEqual(sorted(o['woo_id'] for o in self.db.get_orders()), [2, 3])
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 2)
+        self.assertIsNone(self.db.get_customer('cliente1@example.com'))
+        self.assertEqual([o['woo_id'] for o in self.db.iter_orders({'include_archive': True})], [3, 2, 1])
+        self.assertEqual(self.db.get_order(1)['status'], 'completed')
+        
+        # Il controllo hash non vede l'archivio: l'ordine torna tra i correnti senza duplicati storici
+        self.assertEqual(self.db.sync_multiple_orders([make_test_order(1, status='refunded', date='2020-01-01T10:00:00')]), (1, 0))
+        history = self.db.get_orders({'include_archive': True})
+        self.assertEqual(len(history), 3)
+        self.assertEqual(self.db.get_order(1)['status'], 'refunded')
+
+        # Un ordine eliminato sul negozio sparisce anche dalla copia archiviata
+        self.assertEqual(self.db.delete_orders([1]), 1)
+        self.assertIsNone(self.db.get_order(1))
+        self.db.sync_multiple_orders([make_test_order(4, date='2020-01-03T10:00:00')])
+        self.assertEqual(self.db.archive_orders(older_than_days=1500), 1)
+        self.assertEqual(self.db.delete_orders([4]), 1)
+        self.assertIsNone(self.db.get_order(4))
+        self.assertEqual([o['woo_id'] for o in self.db.iter_orders({'include_archive': True})], [3, 2])
+
+    def test_maintenance_runs_due_tasks(self):
+        """Test manutenzione nelle pause: attività scadute, registro con durata e byte recuperati"""
+        self.db.sync_multiple_orders([make_test_order(i, customer_note='x' * 2000) for i in range(1, 301)])
+        self.db.archive_orders(older_than_days=0)
+        
+        results = {r['task']: r for r in self.db.run_maintenance(time_budget=5)}
+        self.assertEqual(set(results), set(DatabaseManager.MAINTENANCE_INTERVALS))
+        self.assertEqual(results['integrity_check']['result'], 'ok')
+        self.assertGreater(results['incremental_vacuum']['bytes_reclaimed'], 0)
+        self.assertEqual(self.db._get_reader().execute("PRAGMA freelist_count").fetchone()[0], 0)
+        
+        # Al giro successivo resta solo il checkpoint, che ha intervallo zero
+        self.assertEqual([r['task'] for r in self.db.run_maintenance(time_budget=5)], ['wal_checkpoint'])
+        self.assertEqual(len(self.db.get_maintenance_log()), 5)
+        self.assertEqual(self.db.run_maintenance(time_budget=0), [])
+        # Nessuna scrittura nel frattempo: il checkpoint non ha nulla da fare e non aggiunge righe al registro
+        self.assertEqual(self.db.run_maintenance(time_budget=5), [])
+        self.assertEqual(len(self.db.get_maintenance_log()), 5)
+        
+        # Registro potato alle ultime MAINTENANCE_LOG_KEEP esecuzioni per attività
+        self.db.MAINTENANCE_LOG_KEEP = 2
+        for i in range(3):
+            self.db.sync_multiple_orders([make_test_order(1000 + i)])
+            self.assertEqual([r['task'] for r in self.db.run_maintenance(time_budget=5)], ['wal_checkpoint'])
+        self.assertEqual([r['task'] for r in self.db.get_maintenance_log()].count('wal_checkpoint'), 2)
+        
+        # Il controllo di integrità (in sola lettura) può usare tutta la pausa, le altre attività solo MAINTENANCE_TIME_BUDGET
+        budgets = {}
+        with patch.object(self.db, 'MAINTENANCE_INTERVALS', {'optimize': 0, 'integrity_check': 0}), \
+             patch.object(self.db, '_run_maintenance_task', side_effect=lambda task, deadline: budgets.setdefault(task, deadline - time.monotonic())):
+            self.db.run_maintenance(time_budget=60)
+        self.assertLessEqual(budgets['optimize'], DatabaseManager.MAINTENANCE_TIME_BUDGET)
+        self.assertGreater(budgets['integrity_check'], DatabaseManager.MAINTENANCE_TIME_BUDGET)
+
+    def test_poller_watermark_commits_with_pages(self):
+        """Test sincronizzazione delta: segnalibro salvato con ogni pagina e ripresa dopo un errore"""
+        store = {i: make_test_order(i, date=f'2025-03-01T10:{i % 60:02d}:00') for i in range(1, 251)}
+        requested = []
+        def fake_get(endpoint, params=None):
+            requested.append(params['modified_after'])
+            changed = sorted((o for o in store.values() if o['date_modified'] > params['modified_after']), key=lambda o: o['date_modified'])
+            start = (params['page'] - 1) * params['per_page']
+            response = Mock(headers={'X-WP-Total': str(len(changed)), 'X-WP-TotalPages': str(-(-len(changed) // params['per_page']))})
+            response.json.return_value = changed[start:start + params['per_page']]
+            return response
+        key = DatabaseManager.MODIFIED_AFTER_KEY
+        woo = WooCommerceManager(on_order_update=lambda page: self.db.submit_orders(page, watermark_key=key).result(),
+                                 get_watermark=lambda: self.db.get_sync_state(key))
+        woo.api = Mock(get=Mock(side_effect=fake_get))
+        self.db.advance_sync_state(key, '2025-02-28T00:00:00')
+        self.assertTrue(woo.poll_changes())
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 250)
+        self.assertEqual(self.db.get_sync_state(key), '2025-03-01T10:59:00')
+        # Un ordine vecchio cambia stato: il giro successivo lo trova grazie a modified_after
+        store[7] = make_test_order(7, status='refunded', date='2025-03-02T09:00:00')
+        self.assertTrue(woo.poll_changes())
+        self.assertEqual(requested[-1], '2025-03-01T10:53:59')  # segnalibro - MODIFIED_AFTER_OVERLAP, secondo incluso
+        self.assertEqual(self.db.get_order(7)['status'], 'refunded')
+        self.assertEqual(self.db.get_sync_state(key), '2025-03-02T09:00:00')
+        # Se il salvataggio di una pagina fallisce il segnalibro resta dov'era
+        store[8] = make_test_order(8, status='cancelled', date='2025-03-03T09:00:00')
+        with patch.object(self.db, '_ingest_batch', side_effect=sqlite3.OperationalError('disk I/O error')):
+            self.assertFalse(woo.poll_changes())
+        self.assertEqual(self.db.get_sync_state(key), '2025-03-02T09:00:00')
+        self.assertTrue(woo.poll_changes())
+        self.assertEqual(self.db.get_order(8)['status'], 'cancelled')
+
+    def test_poller_keyset_keeps_updates_made_during_download(self):
+        """Test delta sync keyset: ordini modificati durante il download e pareggi di date_modified"""
+        store = {i: make_test_order(i, date=f'2025-03-01T11:{i // 10:02d}:00') for i in range(1, 301)}
+        store.update({i: make_test_order(i, date='2025-03-01T12:00:00') for i in range(301, 451)})  # 150 nello stesso secondo
+        calls = []
+        def fake_get(endpoint, params=None):
+            calls.append((params['modified_after'], params['page']))
+            if len(calls) == 2:
+                # Durante il download l'ordine 50 (già consegnato) viene modificato e passa in coda:
+                # con l'offset le righe seguenti scivolerebbero indietro su una pagina già letta
+                store[50] = make_test_order(50, status='refunded', date='2025-03-01T12:10:00')
+            changed = sorted((o for o in store.values() if o['date_modified'] > params['modified_after']), key=lambda o: (o['date_modified'], o['id']))
+            start = (params['page'] - 1) * params['per_page']
+            response = Mock(headers={'X-WP-Total': str(len(changed)), 'X-WP-TotalPages': str(-(-len(changed) // params['per_page']))})
+            response.json.return_value = changed[start:start + params['per_page']]
+            return response
+        key = DatabaseManager.MODIFIED_AFTER_KEY
+        delivered = []
+        def on_page(page):
+            delivered.extend(o['id'] for o in page)
+            self.db.submit_orders(page, watermark_key=key).result()
+        woo = WooCommerceManager(on_order_update=on_page, get_watermark=lambda: self.db.get_sync_state(key))
+        woo.api = Mock(get=Mock(side_effect=fake_get))
+        self.db.advance_sync_state(key, '2025-03-01T00:00:00')
+        self.assertTrue(woo.poll_changes())
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 450)
+        self.assertEqual(self.db.get_order(50)['status'], 'refunded')
+        self.assertEqual(self.db.get_sync_state(key), '2025-03-01T12:10:00')
+        self.assertEqual(len(delivered), 451)  # 450 ordini + la nuova versione del 50, nessun doppione al confine
+        self.assertIn(('2025-03-01T11:59:59', 2), calls)  # pagina intera nello stesso secondo: offset su quel secondo
+
+    def test_partial_profile_updates_declared_columns(self):
+        """Test profili _fields: aggiornamento delle sole colonne dichiarate"""
+        self.db.sync_multiple_orders([make_test_order(i, status='processing', date='2025-04-01T10:00:00') for i in range(1, 4)])
+        profile = WooCommerceManager.FIELD_PROFILES['minimal']
+        sent = []
+        def fake_get(endpoint, params=None):
+            sent.append(params['_fields'])
+            response = Mock(headers={'X-WP-Total': '4', 'X-WP-TotalPages': '1'})
+            response.json.return_value = [{'id': 1, 'status': 'completed', 'date_modified': '2025-04-02T09:00:00'},
+                                          {'id': 2, 'status': 'cancelled', 'date_modified': '2025-03-01T09:00:00'},  # più vecchio del locale
+                                          {'id': 3, 'status': 'processing', 'date_modified': '2025-04-01T10:00:00'},
+                                          {'id': 99, 'status': 'completed', 'date_modified': '2025-04-02T09:00:00'}]  # sconosciuto
+            return response
+        woo = WooCommerceManager()
+        woo.api = Mock(get=Mock(side_effect=fake_get))
+        results = []
+        self.assertTrue(woo.get_orders_paged(profile='minimal', page_callback=lambda page: results.append(self.db.submit_orders(page, columns=profile['columns']).result())))
+        self.assertEqual(sent, ['id,status,date_modified'])
+        self.assertEqual(results, [(0, 1)])
+        order = self.db.get_order(1)
+        self.assertEqual((order['status'], order['total'], order['customer_email']), ('completed', 100.0, 'cliente1@example.com'))
+        self.assertIsNone(order['hash_signature'])
+        self.assertEqual(self.db.get_order(2)['status'], 'processing')
+        self.assertIsNone(self.db.get_order(99))
+        self.assertEqual(self.db.get_order_stats()['by_status'], {'completed': 1, 'processing': 2})
+        # La versione completa successiva riscrive la riga anche con lo stesso contenuto
+        self.assertEqual(self.db.sync_multiple_orders([make_test_order(1, status='completed', date='2025-04-02T09:00:00')]), (0, 1))
+        with self.assertRaises(ValueError):
+            self.db.submit_orders([], columns=('status', 'raw_data'))
+
+    def test_webhook_deliveries_from_fake_sender(self):
+        """Test ricevitore webhook con firma HMAC e mittente locale finto"""
+        import urllib.request, urllib.error
+        secret = 'segreto-di-test'
+        receiver = WebhookReceiver(secret, on_order=lambda order: self.db.submit_orders([order], newer_only=True).result(),
+                                   on_order_deleted=lambda woo_id: self.db.delete_orders([woo_id]), port=0)
+        receiver.start()
+        def deliver(topic, payload, signature=None):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            headers = {'Content-Type': 'application/json', 'X-WC-Webhook-Topic': topic,
+                       'X-WC-Webhook-Signature': signature or WebhookReceiver.sign(secret, body)}
+            request = urllib.request.Request(f"http://127.0.0.1:{receiver.port}/webhook", data=body, headers=headers)
+            try: return urllib.request.urlopen(request, timeout=5).status
+            except urllib.error.HTTPError as e: return e.code
+        try:
+            self.assertEqual(deliver('order.created', make_test_order(1, status='processing')), 200)
+            self.assertEqual(deliver('order.created', make_test_order(2)), 200)
+            self.assertEqual(deliver('order.updated', make_test_order(1, status='completed', date='2025-01-02T08:00:00')), 200)
+            self.assertEqual(deliver('order.updated', make_test_order(2, status='refunded'), signature='firma-falsa'), 401)
+            self.assertEqual(deliver('order.updated', b'webhook_id=12'), 200)
+            self.assertEqual(self.db.get_order_stats()['by_status'], {'completed': 2})
+            # Consegna ripetuta in ritardo: la versione precedente non sostituisce quella più recente
+            self.assertEqual(deliver('order.updated', make_test_order(1, status='processing', date='2025-01-01T12:00:00')), 200)
+            self.assertEqual(self.db.get_order(1)['status'], 'completed')
+            self.assertEqual(self.db.get_order(1)['date_modified'], '2025-01-02T08:00:00')
+            self.assertEqual(self.db.get_order_stats()['by_status'], {'completed': 2})
+            self.assertEqual(deliver('order.deleted', {'id': 2}), 200)
+            self.assertIsNone(self.db.get_order(2))
+            self.assertEqual(self.db.get_order_stats()['total_orders'], 1)
+        finally:
+            receiver.stop()
+
+    def test_traveler_prefetch_follows_order_hash(self):
+        """Test prefetch viaggiatori: salvati con l'hash, riscaricati solo se l'ordine cambia, falliti in backoff"""
+        self.db.sync_multiple_orders([make_test_order(i) for i in range(1, 6)])
+        requested = []
+        def fake_get(endpoint, params=None):
+            woo_id = int(endpoint.rsplit('/', 1)[1])
+            requested.append(woo_id)
+            if woo_id == 5: raise requests.ConnectionError("timeout")
+            response = Mock(status_code=200, headers={})
+            if woo_id == 4:  # ordine senza dati viaggiatori
+                response.status_code = 404
+                response.raise_for_status.side_effect = requests.HTTPError("404 Not Found", response=response)
+            response.json.return_value = [{'nome': f'Viaggiatore {woo_id}', 'cognome': 'Bianchi'}]
+            return response
+        woo = WooCommerceManager()
+        woo.RETRY_BACKOFF_BASE = 0.001
+        woo.rate_limiter = RateLimiter(rate=100, max_rate=100, burst=10)
+        woo.custom_api = Mock(get=Mock(side_effect=fake_get))
+        prefetcher = TravelerPrefetcher(woo, self.db)
+        self.assertEqual(prefetcher.run_once(), (4, 5))
+        self.assertEqual(self.db.get_travelers(2)[0]['nome'], 'Viaggiatore 2')
+        self.assertEqual(self.db.get_travelers(4), [])
+        # L'ordine fallito resta in backoff: il giro successivo non lo richiede
+        requested.clear()
+        self.assertEqual(prefetcher.run_once(), (0, 0))
+        self.assertEqual(requested, [])
+        self.db.sync_multiple_orders([make_test_order(3, status='cancelled')])
+        self.assertIsNone(self.db.get_travelers(3, self.db.get_order(3)['hash_signature']))
+        self.assertEqual([woo_id for woo_id, _ in self.db.orders_needing_travelers()], [3])
+        # Scaduto il backoff l'ordine torna in coda; un nuovo errore raddoppia l'attesa
+        self.db._execute_write(lambda conn: conn.execute("UPDATE traveler_failures SET retry_after = '2000-01-01T00:00:00'"))
+        self.assertEqual(sorted(woo_id for woo_id, _ in self.db.orders_needing_travelers()), [3, 5])
+        self.assertEqual(prefetcher.run_once(), (1, 2))
+        self.assertEqual(self.db._get_reader().execute("SELECT attempts FROM traveler_failures WHERE woo_id = 5").fetchone()[0], 2)
+        self.assertEqual(ExportManager(self.db)._extract_traveler_data({'woo_id': 2})[0]['cognome'], 'Bianchi')
+
+    def test_product_customers_local_coverage(self):
+        """Test liste clienti per prodotto: ordini archiviati inclusi e copertura della sincronizzazione"""
+        self.assertIsNone(self.db.get_local_coverage())
+        tour = [{'product_id': 30, 'variation_id': 0, 'name': 'Tour Sila', 'quantity': 1, 'total': '80.00'}]
+        self.db.bulk_import([make_test_order(1, total='80.00', date='2020-05-01T10:00:00', line_items=tour),
+                             make_test_order(2, total='80.00', date='2025-05-01T10:00:00', line_items=tour * 2),
+                             make_test_order(3, total='80.00', date='2025-06-01T10:00:00', line_items=tour, billing={'email': 'cliente1@example.com'}),
+                             make_test_order(4, date='2025-06-02T10:00:00')])
+        # Un export può essere parziale: l'import non rende affidabile la copia locale
+        self.assertIsNone(self.db.get_local_coverage())
+        self.db.advance_sync_state(DatabaseManager.FULL_SYNC_KEY, '2025-06-02T11:00:00')  # sincronizzazione completa
+        self.assertEqual(self.db.get_local_coverage(), '2025-06-02T10:00:00')
+        self.assertEqual(self.db.archive_orders(older_than_days=1500), 1)
+        customers = {c['customer_email']: c for c in self.db.get_customers_for_product(30)}
+        self.assertEqual(customers['cliente1@example.com']['total_purchases'], 2)  # ordine archiviato + ordine recente
+        self.assertEqual(customers['cliente1@example.com']['customer_name'], 'Mario Rossi')
+        self.assertEqual(customers['cliente2@example.com']['total_purchases'], 1)  # due righe dello stesso prodotto
+        self.assertIn(DatabaseManager.customer_key(' Cliente1@Example.COM '), customers)  # stessa chiave per locale e API
+        limited = self.db.get_customers_for_product(30, date_from='2025-01-01', until='2025-05-15T00:00:00')
+        self.assertEqual([c['customer_email'] for c in limited], ['cliente2@example.com'])
+
+    def test_bulk_import_from_export_files(self):
+        """Test import offline da array JSON e NDJSON compresso, con segnalibro per la sincronizzazione delta"""
+        orders = [make_test_order(i, date=f'2025-01-{i:02d}T10:00:00') for i in range(1, 21)]
+        array_path = os.path.join(self.tmp_dir, 'ordini.json')
+        with open(array_path, 'w', encoding='utf-8') as f: json.dump(orders[:10], f, indent=2)
+        ndjson_path = os.path.join(self.tmp_dir, 'ordini.ndjson.gz')
+        with gzip.open(ndjson_path, 'wt', encoding='utf-8') as f: f.writelines(json.dumps(o) + '\n' for o in orders[5:])
+        
+        importer = OrderImporter(self.db)
+        importer.READ_CHUNK_SIZE = 64  # forza elementi a cavallo tra blocchi
+        progress = []
+        result = importer.import_file(array_path, progress_callback=progress.append, batch_size=4)
+        self.assertEqual((result['orders'], result['inserted']), (10, 10))
+        self.assertEqual(progress, [4, 8, 10])
+        
+        result = importer.import_file(ndjson_path)
+        self.assertEqual((result['orders'], result['inserted'], result['updated']), (15, 10, 0))
+        self.assertEqual(self.db.get_sync_state(DatabaseManager.MODIFIED_AFTER_KEY), '2025-01-20T10:00:00')
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 20)
+        self.assertEqual(len(self.db.get_orders({'search_term': 'cliente17@'})), 1)
+        self.assertEqual(self.db.get_customer('cliente3@example.com')['purchase_count'], 1)
+
+    def test_backup_rotation_and_restore(self):
+        """Test backup compresso a rotazione e ripristino con verifica di integrità"""
+        self.db.sync_multiple_orders([make_test_order(i) for i in range(1, 6)])
+        DatabaseManager.BACKUP_STEP_PAGES, step_pages = 2, DatabaseManager.BACKUP_STEP_PAGES
+        try:
+            steps = []
+            def on_step(done, total):
+                # Le scritture non attendono il backup e restano fuori dallo snapshot già iniziato
+                if not steps:
+                    self.db.sync_multiple_orders([make_test_order(7)])
+                    self.db.advance_sync_state('backup_test', 'x')
+                    self.db.delete_orders([1])
+                steps.append(done)
+            backup = self.db.backup_database(progress_callback=on_step)
+        finally:
+            DatabaseManager.BACKUP_STEP_PAGES = step_pages
+        self.assertTrue(backup['path'].endswith('.db.gz'))
+        self.assertGreater(len(steps), 1)
+        self.assertIsNone(self.db.get_order(1))
+        self.assertEqual(self.db.get_sync_state('backup_test'), 'x')
+        
+        self.db.sync_multiple_orders([make_test_order(6)])
+        self.assertEqual(self.db.restore_database(backup['path'])['orders'], 5)
+        self.assertIsNone(self.db.get_order(6))
+        self.assertIsNone(self.db.get_order(7))
+        self.assertEqual(self.db.get_order(1)['woo_id'], 1)
+        self.assertEqual(self.db.get_order_stats()['total_orders'], 5)
+        
+        broken = os.path.join(self.tmp_dir, 'rotto.db')
+        with open(broken, 'wb') as f: f.write(b'non un database')
+        with self.assertRaises(Exception): self.db.restore_database(broken)
+        self.assertEqual(len(self.db.get_orders()), 5)
+        
+        for name in ('test_20200101_000000.db.gz', 'test_20200102_000000.db.gz'):
+            with open(os.path.join(self.db.backup_dir, name), 'wb') as f: f.write(b'')
+        self.db._rotate_backups(2)
+        self.assertEqual([os.path.basename(p) for p in self.db.list_backups()], [os.path.basename(backup['path']), 'test_20200102_000000.db.gz'])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow non installato")
+    def test_columnar_export(self):
+        """Test export Parquet di ordini, righe prodotto e viaggiatori con colonne a dizionario"""
+        import pyarrow.parquet as pq
+        travelers = json.dumps([{'nome': 'Anna', 'cognome': 'Verdi', 'partenza': 'Roma'}])
+        self.db.sync_multiple_orders([make_test_order(i, status='completed' if i % 2 else 'processing', meta_data=[{'key': 'dati_viaggiatori', 'value': travelers}]) for i in range(1, 8)])
+        results = []
+        export_manager = ExportManager(self.db, on_export_complete=lambda result, export_type: results.append(result))
+        export_manager.exports_dir = self.tmp_dir
+        export_manager.COLUMNAR_BATCH_SIZE = 3  # più blocchi con dizionari che crescono
+        
+        export_manager.export_orders_columnar()
+        self.assertTrue(results[0].success, results[0].error_message)
+        orders = pq.read_table(os.path.join(results[0].file_path, 'orders.parquet'))
+        items = pq.read_table(os.path.join(results[0].file_path, 'order_items.parquet'))
+        travelers = pq.read_table(os.path.join(results[0].file_path, 'travelers.parquet'))
+        self.assertEqual((orders.num_rows, items.num_rows, travelers.num_rows), (7, 7, 7))
+        self.assertTrue(pyarrow.types.is_dictionary(orders.schema.field('status').type))
+        self.assertEqual(sorted(set(orders.column('status').to_pylist())), ['completed', 'processing'])
+        self.assertEqual(items.column('quantity').to_pylist(), [2] * 7)
+        self.assertEqual(travelers.column('partenza').to_pylist(), ['Roma'] * 7)
+
 class TestExportManager(unittest.TestCase):
     """Test Export Manager"""
     
@@ -217,7 +841,7 @@ class IntegrationTest(unittest.TestCase):
         self.assertIsNotNone(self.supabase_manager)
         self.assertIsNotNone(self.export_manager)
         
-    @patch('woocommerce_api.API')
+    @patch('woocommerce_api.SessionAPI')
     @patch('supabase.create_client')
     def test_end_to_end_simulation(self, mock_supabase, mock_woo_api):
         """Test simulazione end-to-end"""
@@ -272,6 +896,7 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(TestConfig))
     suite.addTests(loader.loadTestsFromTestCase(TestWooCommerceManager))
     suite.addTests(loader.loadTestsFromTestCase(TestSupabaseManager))
+    suite.addTests(loader.loadTestsFromTestCase(TestDatabaseManager))
     suite.addTests(loader.loadTestsFromTestCase(TestExportManager))
     suite.addTests(loader.loadTestsFromTestCase(IntegrationTest))
     
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prefetch dei dati viaggiatori per Gestionale Gitemania
+Thread in background che scarica da gitemania/v1/viaggiatori i dati degli ordini nuovi o modificati,
+con un numero limitato di richieste contemporanee, e li salva nel database locale insieme all'hash
+dell'ordine: un ordine viene riscaricato solo quando cambia. I download falliti vengono registrati e
+riprovati con backoff, senza bloccare la coda sugli stessi ordini.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import config
+
+class TravelerPrefetcher:
+    CONCURRENCY = 4     # richieste contemporanee (app.traveler_concurrency)
+    BATCH_SIZE = 200    # ordini esaminati per giro
+    IDLE_INTERVAL = 300  # secondi di attesa quando non c'è nulla da scaricare (wake() anticipa il giro)
+
+    def __init__(self, woo_manager, database_manager):
+        self.woo_manager = woo_manager
+        self.database_manager = database_manager
+        self.running = False
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._loop, name="traveler-prefetch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def wake(self):
+        """Da chiamare dopo una sincronizzazione: i nuovi ordini vengono esaminati subito."""
+        self._wake.set()
+
+    def _loop(self):
+        while self.running:
+            try:
+                fetched, pending = self.run_once()
+            except Exception as e:
+                print(f"❌ Errore prefetch viaggiatori: {e}")
+                fetched, pending = 0, 0
+            # Blocco pieno: si prosegue subito (anche i falliti sono registrati e non tornano nel blocco successivo);
+            # altrimenti si attende un nuovo sync o il prossimo giro
+            if pending < self.BATCH_SIZE:
+                self._wake.wait(self.IDLE_INTERVAL)
+                self._wake.clear()
+
+    def run_once(self, limit: int = None) -> tuple:
+        """Un giro: restituisce (ordini salvati, ordini da aggiornare trovati). Le richieste fallite vengono
+        registrate come tali e riprovate solo dopo il backoff (DatabaseManager.save_travelers)."""
+        if not self.woo_manager.custom_api: return 0, 0
+        pending = self.database_manager.orders_needing_travelers(limit or self.BATCH_SIZE)
+        if not pending: return 0, 0
+        concurrency = max(1, config.get('app', 'traveler_concurrency', self.CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="travelers") as pool:
+            travelers = list(pool.map(lambda item: self.woo_manager.get_viaggiatori_for_order(item[0]), pending))
+        results = [(woo_id, order_hash, data) for (woo_id, order_hash), data in zip(pending, travelers)]
+        self.database_manager.save_travelers(results)
+        return sum(data is not None for data in travelers), len(pending)
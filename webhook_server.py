@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ricevitore webhook WooCommerce per Gestionale Gitemania
+Server HTTP locale (opzionale) che riceve le consegne order.created/updated/deleted, ne verifica la
+firma X-WC-Webhook-Signature e le passa alle stesse funzioni di salvataggio della sincronizzazione.
+Il negozio deve poter raggiungere l'indirizzo (ad esempio tramite reverse proxy o tunnel HTTPS).
+"""
+
+import base64, hashlib, hmac, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length') or 0)
+        if self.path.split('?')[0] != receiver.path:
+            status = 404
+        elif length > receiver.MAX_BODY_SIZE:
+            status = 413
+            self.close_connection = True  # il corpo non viene letto
+        else:
+            status = receiver.handle_delivery(self.headers, self.rfile.read(length))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookReceiver:
+    MAX_BODY_SIZE = 5 * 1024 * 1024
+    ORDER_TOPICS = ('order.created', 'order.updated', 'order.restored')
+
+    def __init__(self, secret: str, on_order: Callable, on_order_deleted: Callable,
+                 host: str = '127.0.0.1', port: int = 8765, path: str = '/webhook'):
+        if not secret: raise ValueError("Il segreto del webhook è obbligatorio per verificare le consegne")
+        self.secret = secret.encode()
+        self.on_order = on_order                  # riceve l'ordine completo; deve salvarlo prima di restituire
+        self.on_order_deleted = on_order_deleted  # riceve il woo_id dell'ordine eliminato
+        self.host, self.port, self.path = host, port, path
+        self.last_delivery = None  # time.time() dell'ultima consegna valida
+        self._server = None
+
+    @staticmethod
+    def sign(secret, body: bytes) -> str:
+        """Firma WooCommerce: HMAC-SHA256 del corpo con il segreto del webhook, in base64."""
+        key = secret.encode() if isinstance(secret, str) else secret
+        return base64.b64encode(hmac.new(key, body, hashlib.sha256).digest()).decode()
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    def start(self):
+        """Avvia il server in un thread in background (port=0 sceglie una porta libera)."""
+        if self._server: return
+        self._server = ThreadingHTTPServer((self.host, self.port), _WebhookHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, name="webhook-server", daemon=True).start()
+        print(f"📡 Webhook in ascolto su http://{self.host}:{self.port}{self.path}")
+
+    def stop(self):
+        if not self._server: return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def handle_delivery(self, headers, body: bytes) -> int:
+        """
+        Gestisce una consegna e restituisce il codice HTTP. La risposta 200 arriva solo dopo il salvataggio:
+        in caso di errore WooCommerce riceve 500 e ripete la consegna.
+        """
+        signature = headers.get('X-WC-Webhook-Signature')
+        if signature and not hmac.compare_digest(signature.strip(), self.sign(self.secret, body)): return 401
+        # Ping inviato da WooCommerce alla creazione del webhook ("webhook_id=N")
+        if body.startswith(b'webhook_id='): return 200
+        if not signature: return 401
+        topic = headers.get('X-WC-Webhook-Topic', '')
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400
+        try:
+            if topic in self.ORDER_TOPICS: self.on_order(payload)
+            elif topic == 'order.deleted': self.on_order_deleted(int(payload['id']))
+            else: return 200  # argomenti non gestiti: confermati per non farli ripetere
+        except Exception as e:
+            print(f"❌ Errore salvataggio webhook {topic}: {e}")
+            return 500
+        self.last_delivery = time.time()
+        return 200
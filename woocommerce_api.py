@@ -3,30 +3,211 @@
 """
 Modulo WooCommerce API per Gestionale Gitemania (Versione Finale con Paginazione e Callback Real-time)
 """
-import threading, time, requests # Importa 'requests'
+import threading, time, random, requests # Importa 'requests'
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from typing import Dict, List, Optional, Callable
+from json import dumps as jsonencode
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
 from woocommerce import API
+from woocommerce.oauth import OAuth
 from config import config
 
+class SessionAPI(API):
+    """Client WooCommerce che passa dalla requests.Session condivisa (connessioni keep-alive riusate)
+    invece di aprire una connessione, con relativo handshake TLS, per ogni chiamata. Della libreria usa
+    solo la configurazione pubblica (url, versione, chiavi, timeout) e la classe OAuth per i negozi HTTP."""
+
+    def __init__(self, url, consumer_key, consumer_secret, session: requests.Session, **kwargs):
+        super().__init__(url, consumer_key, consumer_secret, **kwargs)
+        self.session = session
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, None, **kwargs)
+
+    def post(self, endpoint, data, **kwargs):
+        return self.request("POST", endpoint, data, **kwargs)
+
+    def put(self, endpoint, data, **kwargs):
+        return self.request("PUT", endpoint, data, **kwargs)
+
+    def delete(self, endpoint, **kwargs):
+        return self.request("DELETE", endpoint, None, **kwargs)
+
+    def options(self, endpoint, **kwargs):
+        return self.request("OPTIONS", endpoint, None, **kwargs)
+
+    def endpoint_url(self, endpoint: str) -> str:
+        return f"{self.url.rstrip('/')}/{'wp-json' if self.wp_api else 'wc-api'}/{self.version}/{endpoint}"
+
+    def request(self, method: str, endpoint: str, data=None, params: dict = None, **kwargs) -> requests.Response:
+        """Richiesta sulla sessione condivisa, autenticata come fa la libreria: Basic auth (o chiavi nella query)
+        su HTTPS, firma OAuth 1.0a su HTTP."""
+        params = dict(params or {})
+        url, auth = self.endpoint_url(endpoint), None
+        headers = {"user-agent": self.user_agent, "accept": "application/json"}
+        if self.is_ssl and not self.query_string_auth:
+            auth = HTTPBasicAuth(self.consumer_key, self.consumer_secret)
+        elif self.is_ssl:
+            params.update({"consumer_key": self.consumer_key, "consumer_secret": self.consumer_secret})
+        else:
+            oauth = OAuth(url=f"{url}?{urlencode(params)}" if params else url, consumer_key=self.consumer_key,
+                          consumer_secret=self.consumer_secret, version=self.version, method=method)
+            url, params = oauth.get_oauth_url(), {}
+        if data is not None:
+            data = jsonencode(data, ensure_ascii=False).encode('utf-8')
+            headers["content-type"] = "application/json;charset=utf-8"
+        return self.session.request(method=method, url=url, verify=self.verify_ssl, auth=auth, params=params,
+                                    data=data, timeout=self.timeout, headers=headers, **kwargs)
+
+class RateLimiter:
+    """Token bucket condiviso da tutte le richieste verso il negozio. Il ritmo sale finché il server
+    risponde rapidamente, si dimezza a ogni 429/503 e resta fermo per il Retry-After indicato."""
+    MIN_RATE = 0.5  # richieste al secondo
+    FAST_RESPONSE = 1.0  # secondi: risposte più rapide fanno salire il ritmo
+    RAMP_UP = 0.25  # richieste al secondo aggiunte per ogni risposta rapida
+
+    def __init__(self, rate: float, max_rate: float, burst: int):
+        self.rate, self.max_rate, self.burst = max(self.MIN_RATE, rate), max(rate, max_rate), max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Attende il proprio turno (un gettone) prima di inviare una richiesta."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+
+    def on_response(self, elapsed: float):
+        if elapsed < self.FAST_RESPONSE:
+            with self._lock: self.rate = min(self.max_rate, self.rate + self.RAMP_UP)
+
+    def on_throttle(self, retry_after: float = None):
+        with self._lock:
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self._tokens = 0.0
+            if retry_after: self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
 class WooCommerceManager:
-    def __init__(self, on_order_update: Callable = None):
+    MODIFIED_AFTER_OVERLAP = timedelta(minutes=5)  # margine all'indietro nelle sincronizzazioni delta
+    SYNC_CONCURRENCY = 4  # pagine scaricate in parallelo (app.sync_concurrency), per non sovraccaricare il negozio
+    HTTP_POOL_SIZE = 10  # connessioni keep-alive tenute aperte verso il negozio (app.http_pool_size)
+    HTTP_RETRIES = 3  # nuovi tentativi per GET su errori di rete, 429 e 5xx temporanei (app.http_retries)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    RETRY_BACKOFF_BASE = 1.0  # secondi, raddoppiati a ogni tentativo (con jitter)
+    RETRY_BACKOFF_MAX = 30.0
+    RETRY_AFTER_MAX = 300.0  # Retry-After più lunghi vengono ridotti a questo valore
+    RATE_LIMIT = 4.0  # richieste al secondo iniziali (app.rate_limit), poi adattate alla risposta del server
+    RATE_LIMIT_MAX = 20.0  # (app.rate_limit_max)
+    POLL_BACKOFF_MAX = 300.0  # attesa massima tra due polling falliti
+    RECONCILE_INTERVAL = 900  # secondi tra due polling quando arrivano i webhook (app.reconcile_interval)
+    # Proiezioni '_fields' degli ordini: campi chiesti al negozio (None = ordine completo) e colonne di 'orders'
+    # che DatabaseManager può aggiornare da quei campi (submit_orders(..., columns=...); None = ingest completo).
+    # Restano fuori meta_data, _links, righe tasse/coupon/commissioni e rimborsi, la parte più pesante del JSON.
+    FIELD_PROFILES = {
+        'minimal': {'fields': ('id', 'status', 'date_modified'), 'columns': ('status', 'date_modified')},
+        'list': {'fields': ('id', 'number', 'status', 'currency', 'total', 'total_tax', 'shipping_total', 'customer_id', 'billing',
+                            'line_items', 'payment_method', 'payment_method_title', 'date_created', 'date_modified', 'date_completed'),
+                 'columns': ('order_number', 'status', 'currency', 'total', 'total_tax', 'shipping_total', 'customer_id', 'customer_email',
+                             'customer_name', 'billing_data', 'line_items', 'payment_method', 'payment_method_title',
+                             'date_created', 'date_modified', 'date_completed')},
+        'full': {'fields': None, 'columns': None},
+    }
+    HTTP_CONNECT_TIMEOUT = 10  # secondi (app.http_connect_timeout)
+    HTTP_READ_TIMEOUT = 60  # secondi (app.http_timeout)
+
+    def __init__(self, on_order_update: Callable = None, on_idle: Callable = None, get_watermark: Callable = None):
         self.api = None
+        self.custom_api = None  # stesso negozio, namespace gitemania/v1
+        self.session = self._create_session()
+        self.rate_limiter = RateLimiter(config.get('app', 'rate_limit', self.RATE_LIMIT), config.get('app', 'rate_limit_max', self.RATE_LIMIT_MAX),
+                                        burst=config.get('app', 'sync_concurrency', self.SYNC_CONCURRENCY))
         self.sync_running = False
+        # on_order_update riceve le pagine in ordine di modifica e deve salvarle (con il segnalibro) prima di
+        # restituire: un'eccezione interrompe il giro e il polling successivo riparte dall'ultimo segnalibro salvato
         self.on_order_update = on_order_update or (lambda orders: None)
-        self.last_sync = datetime.now(timezone.utc) - timedelta(days=1)
+        self.on_idle = on_idle  # riceve i secondi liberi fino al prossimo polling (es. manutenzione del DB)
+        self.get_watermark = get_watermark or (lambda: None)  # date_modified più recente già salvata in locale
+        self.webhooks_active = False  # con i webhook attivi il polling serve solo a recuperare consegne perse
         
     def initialize(self, base_url: str, consumer_key: str, consumer_secret: str) -> bool:
         try:
-            self.api = API(url=base_url, consumer_key=consumer_key, consumer_secret=consumer_secret,
-                           version="wc/v3", timeout=60, verify_ssl=True)
-            response = self.api.get("system_status")
-            response.raise_for_status()
+            timeout = (config.get('app', 'http_connect_timeout', self.HTTP_CONNECT_TIMEOUT),
+                       config.get('app', 'http_timeout', self.HTTP_READ_TIMEOUT))
+            self.api = SessionAPI(url=base_url, consumer_key=consumer_key, consumer_secret=consumer_secret,
+                                  session=self.session, version="wc/v3", timeout=timeout, verify_ssl=True)
+            self.custom_api = SessionAPI(url=base_url, consumer_key=consumer_key, consumer_secret=consumer_secret,
+                                         session=self.session, version="gitemania/v1", timeout=timeout, verify_ssl=True)
+            self._get(self.api, "system_status")
             return True
         except Exception as e:
             print(f"❌ Errore inizializzazione WooCommerce: {e}")
             return False
             
+    def _create_session(self) -> requests.Session:
+        """Sessione HTTP unica per tutte le chiamate, con pool dimensionato sui download paralleli
+        (i nuovi tentativi sono gestiti da _get, insieme al limitatore)."""
+        pool_size = max(config.get('app', 'http_pool_size', self.HTTP_POOL_SIZE),
+                        config.get('app', 'sync_concurrency', self.SYNC_CONCURRENCY))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """Chiude le connessioni keep-alive (alla chiusura dell'applicazione)."""
+        self.stop_sync()
+        self.session.close()
+
+    def _get(self, api: API, endpoint: str, params: dict = None) -> requests.Response:
+        """GET attraverso il limitatore condiviso. Errori di rete, 429 e 5xx temporanei vengono ritentati
+        con backoff esponenziale e jitter (o dopo il Retry-After del server); gli altri errori HTTP e
+        l'ultimo tentativo fallito sollevano un'eccezione."""
+        retries = config.get('app', 'http_retries', self.HTTP_RETRIES)
+        for attempt in range(retries + 1):
+            self.rate_limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = api.get(endpoint, params=params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error, retry_after = e, None
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    self.rate_limiter.on_response(time.monotonic() - started)
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} {response.reason} per {endpoint}", response=response)
+                retry_after = self._retry_after(response)
+                # Il server chiede di rallentare: vale per tutti i thread, non solo per questa richiesta
+                if retry_after is not None or response.status_code in (429, 503): self.rate_limiter.on_throttle(retry_after)
+            if attempt == retries: raise error
+            print(f"⚠️ {error}: nuovo tentativo {attempt + 1}/{retries}")
+            if retry_after is None: time.sleep(random.uniform(0, min(self.RETRY_BACKOFF_MAX, self.RETRY_BACKOFF_BASE * 2 ** attempt)))
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        """Secondi indicati da Retry-After (numero o data HTTP), None se assente o non leggibile."""
+        value = response.headers.get('Retry-After')
+        if not value: return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try: seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError): return None
+        return min(self.RETRY_AFTER_MAX, max(0.0, seconds))
+
     def start_sync(self):
         if self.sync_running: return
         self.sync_running = True
@@ -39,149 +220,175 @@ class WooCommerceManager:
         print("⏹️ Sincronizzazione periodica fermata")
         
     def _polling_loop(self):
+        failures = 0
         while self.sync_running:
+            cycle_start = time.monotonic()
             try:
-                updated_orders = self.fetch_orders_since(self.last_sync)
-                if updated_orders:
-                    self.on_order_update(updated_orders)
-                    self.last_sync = datetime.now(timezone.utc)
-                time.sleep(config.get('app', 'sync_interval', 60))
+                success = self.poll_changes()
             except Exception as e:
                 print(f"❌ Errore polling: {e}")
-                time.sleep(60)
+                success = False
+            if not success:
+                # Giro fallito: si riprova presto, poi sempre più di rado (con jitter) finché il negozio non risponde
+                failures += 1
+                time.sleep(random.uniform(0.5, 1.0) * min(self.POLL_BACKOFF_MAX, self.RETRY_BACKOFF_BASE * 2 ** failures))
+                continue
+            failures = 0
+            if self.webhooks_active: interval = config.get('app', 'reconcile_interval', self.RECONCILE_INTERVAL)
+            else: interval = config.get('app', 'sync_interval', 60)
+            if self.on_idle and self.sync_running:
+                # Pausa tra due polling: la sincronizzazione di questo giro è già stata salvata
+                self.on_idle(interval - (time.monotonic() - cycle_start))
+            time.sleep(max(0, interval - (time.monotonic() - cycle_start)))
 
-    def fetch_orders_since(self, since_datetime: datetime) -> Optional[List[Dict]]:
-        if not self.api: return None
-        try:
-            params = {"after": since_datetime.isoformat()}
-            response = self.api.get("orders", params=params)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(f"❌ Errore durante il recupero degli ordini da {since_datetime}: {e}")
-            return None
+    def poll_changes(self) -> bool:
+        """Un giro di sincronizzazione delta: tutte le pagine di ordini modificati dopo il segnalibro salvato
+        (alla prima esecuzione, le ultime 24 ore)."""
+        watermark = self.get_watermark() or (datetime.now() - timedelta(days=1)).isoformat(timespec='seconds')
+        return self.get_orders_modified_after(watermark, page_callback=self.on_order_update)
 
-    def fetch_last_day_orders(self) -> Optional[List[Dict]]:
-        if not self.api: return None
+    def get_orders_paged(self, params: dict = None, page_callback: Callable = None, concurrency: int = None, ordered: bool = True,
+                         profile: str = 'full') -> bool:
+        """
+        Scarica tutte le pagine di ordini (vedi _get_paged) e le passa a page_callback, con i soli campi
+        del profilo indicato (FIELD_PROFILES). Senza parametri di ordinamento si ordina per id crescente,
+        così i nuovi ordini arrivati durante il download non spostano le pagine già richieste.
+        Restituisce False se il download si interrompe.
+        """
+        if not self.api: return False
         try:
-            twenty_four_hours_ago = datetime.now(timezone.utc) - timedelta(days=1)
-            return self.fetch_orders_since(twenty_four_hours_ago)
+            params = {'orderby': 'id', 'order': 'asc', **self._profile_params(profile), **(params or {})}
+            self._get_paged('orders', params, page_callback, concurrency, ordered)
+            return True
         except Exception as e:
-            print(f"❌ Errore durante il recupero degli ordini delle ultime 24 ore: {e}")
-            return None
+            print(f"❌ Eccezione grave in get_orders_paged: {e}")
+            return False
+
+    def _profile_params(self, profile: str) -> dict:
+        if profile not in self.FIELD_PROFILES: raise ValueError(f"Profilo di campi sconosciuto: {profile}")
+        fields = self.FIELD_PROFILES[profile]['fields']
+        return {'_fields': ','.join(fields)} if fields else {}
+
+    def _get_paged(self, endpoint: str, params: dict, page_callback: Callable, concurrency: int = None, ordered: bool = True):
+        """
+        Dalla prima risposta legge X-WP-Total/X-WP-TotalPages e scarica le altre pagine con al massimo
+        'concurrency' richieste contemporanee (app.sync_concurrency), al ritmo del limitatore condiviso.
+        Le pagine arrivano a page_callback, sempre sul thread chiamante, in ordine di pagina oppure,
+        con ordered=False, appena pronte. Una pagina che fallisce anche dopo i nuovi tentativi
+        interrompe il download con un'eccezione: mai risultati parziali silenziosi.
+        """
+        per_page = 100
+        concurrency = max(1, concurrency or config.get('app', 'sync_concurrency', self.SYNC_CONCURRENCY))
+        base_params = {'per_page': per_page, **params}
+        print(f"📄 Download pagina 1 di {endpoint}...")
+        items, total_items, total_pages = self._fetch_page(endpoint, base_params, 1)
+        if items and page_callback: page_callback(items)
+        if total_pages is None:
+            # Intestazioni assenti (proxy, cache): si procede una pagina alla volta fino all'ultima
+            page = 1
+            while len(items) == per_page:
+                page += 1
+                print(f"📄 Download pagina {page} di {endpoint}...")
+                items, _, _ = self._fetch_page(endpoint, base_params, page)
+                if items and page_callback: page_callback(items)
+            print("✅ Download di tutte le pagine completato.")
+            return
+        print(f"📄 {total_items} {endpoint} in {total_pages} pagine, {concurrency} download in parallelo")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="woo-pages") as pool:
+            in_flight, next_page = {}, 2
+            try:
+                while in_flight or next_page <= total_pages:
+                    # Finestra limitata: al massimo 2 x concurrency pagine scaricate e non ancora consegnate
+                    while next_page <= total_pages and len(in_flight) < concurrency * 2:
+                        in_flight[next_page] = pool.submit(self._fetch_page, endpoint, base_params, next_page); next_page += 1
+                    if ordered:
+                        page = min(in_flight)
+                    else:
+                        done, _ = wait(in_flight.values(), return_when=FIRST_COMPLETED)
+                        page = next(p for p, future in in_flight.items() if future in done)
+                    items, _, _ = in_flight.pop(page).result()
+                    if items and page_callback: page_callback(items)
+            except BaseException:
+                for future in in_flight.values(): future.cancel()
+                raise
+        print("✅ Download di tutte le pagine completato.")
 
-    def get_orders_paged(self, params: dict = None, page_callback: Callable = None) -> bool:
+    def _fetch_page(self, endpoint: str, params: dict, page: int):
+        """Una pagina con i totali dichiarati dal server (None se le intestazioni mancano)."""
+        response = self._get(self.api, endpoint, {**params, 'page': page})
+        total_items, total_pages = response.headers.get('X-WP-Total'), response.headers.get('X-WP-TotalPages')
+        return response.json(), (int(total_items) if total_items else None), (int(total_pages) if total_pages else None)
+
+    def get_orders_modified_after(self, modified_after: str, page_callback: Callable = None, profile: str = 'full') -> bool:
+        """
+        Sincronizzazione delta: solo gli ordini modificati dopo 'modified_after' (data ISO, ora del sito),
+        ripartendo MODIFIED_AFTER_OVERLAP prima. Paginazione keyset su date_modified: ogni richiesta riparte
+        dall'ultima data di modifica ricevuta invece che da un offset, così un ordine modificato durante il
+        download passa in coda e arriva in una pagina successiva senza far scorrere gli altri su pagine già
+        lette. Le pagine sono quindi sequenziali e arrivano a page_callback in ordine di modifica crescente.
+        Gli ordini dello stesso secondo già consegnati (stessi id e date_modified) vengono scartati.
+        """
         if not self.api: return False
-        page = 1
         per_page = 100
         try:
+            params = {'orderby': 'modified', 'order': 'asc', 'per_page': per_page, **self._profile_params(profile)}
+            cursor = datetime.fromisoformat(modified_after) - self.MODIFIED_AFTER_OVERLAP
+            delivered, page = {}, 1  # id -> date_modified degli ordini consegnati dal secondo del cursore in poi
             while True:
-                current_params = {'per_page': per_page, 'page': page}
-                if params: current_params.update(params)
-                print(f"📄 Download pagina {page} di ordini...")
-                response = self.api.get('orders', params=current_params)
-                response.raise_for_status()
-                orders_page = response.json()
-                if not orders_page:
-                    print("✅ Download di tutte le pagine completato.")
-                    break
-                if page_callback:
-                    page_callback(orders_page)
-                if len(orders_page) < per_page:
-                    print("✅ Raggiunta l'ultima pagina.")
-                    break
-                page += 1
-                time.sleep(1)
+                # modified_after esclude l'istante indicato: si chiede anche il secondo del cursore
+                since = (cursor - timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')
+                print(f"📄 Download ordini modificati dopo {since} (pagina {page})...")
+                items, _, _ = self._fetch_page('orders', {**params, 'modified_after': since}, page)
+                fresh = [order for order in items if delivered.get(order.get('id'), ()) != order.get('date_modified')]
+                if fresh and page_callback: page_callback(fresh)
+                if len(items) < per_page: break
+                newest = max((datetime.fromisoformat(order['date_modified']) for order in items if order.get('date_modified')), default=cursor)
+                if newest > cursor:
+                    cursor, page = newest, 1
+                    delivered = {woo_id: modified for woo_id, modified in delivered.items() if datetime.fromisoformat(modified) >= cursor}
+                else:
+                    page += 1  # una pagina intera nello stesso secondo: si prosegue con l'offset su quel secondo
+                delivered.update((order.get('id'), order.get('date_modified')) for order in fresh if order.get('date_modified'))
+            print("✅ Download degli ordini modificati completato.")
             return True
         except Exception as e:
-            print(f"❌ Eccezione grave in get_orders_paged (pagina {page}): {e}")
+            print(f"❌ Eccezione grave in get_orders_modified_after: {e}")
             return False
-            
+
     def get_all_products(self) -> List[Dict]:
-        """Recupera tutti i prodotti da WooCommerce."""
+        """Recupera tutti i prodotti da WooCommerce; se una pagina non arriva solleva un'eccezione."""
         if not self.api: return []
-        
         all_products = []
-        page = 1
-        per_page = 100
-        
-        while True:
-            try:
-                params = {'per_page': per_page, 'page': page}
-                response = self.api.get('products', params=params)
-                response.raise_for_status()
-                products_page = response.json()
-                
-                if not products_page:
-                    break
-                
-                all_products.extend(products_page)
-                
-                if len(products_page) < per_page:
-                    break
-                
-                page += 1
-            except Exception as e:
-                print(f"❌ Errore recupero pagina {page} di prodotti: {e}")
-                break
-                
+        self._get_paged('products', {'orderby': 'id', 'order': 'asc'}, all_products.extend)
         return all_products
 
-    def get_orders_for_product(self, product_id: int, date_from: str = None, date_to: str = None) -> List[Dict]:
-        """Recupera tutti gli ordini per un prodotto specifico, con filtri di data."""
+    def get_orders_for_product(self, product_id: int, date_from: str = None, date_to: str = None, profile: str = 'list', after: str = None) -> List[Dict]:
+        """Recupera tutti gli ordini per un prodotto specifico, con filtri di data; se una pagina non arriva solleva un'eccezione.
+        Il profilo 'list' basta per l'elenco clienti (dati di fatturazione, totale, date). 'after' (data e ora ISO,
+        esclusa) sostituisce date_from, ad esempio per chiedere solo gli ordini non ancora sincronizzati."""
         if not self.api: return []
-        
-        all_orders = []
-        page = 1
-        per_page = 100
-        
-        params = {'product': product_id}
-        if date_from:
+        params = {'product': product_id, 'orderby': 'id', 'order': 'asc', **self._profile_params(profile)}
+        if after:
+            params['after'] = after
+        elif date_from:
             params['after'] = f"{date_from}T00:00:00"
         if date_to:
             params['before'] = f"{date_to}T23:59:59"
-
-        while True:
-            try:
-                current_params = {'per_page': per_page, 'page': page, **params}
-                response = self.api.get('orders', params=current_params)
-                response.raise_for_status()
-                orders_page = response.json()
-                
-                if not orders_page:
-                    break
-                
-                all_orders.extend(orders_page)
-                
-                if len(orders_page) < per_page:
-                    break
-                
-                page += 1
-            except Exception as e:
-                print(f"❌ Errore recupero ordini per prodotto {product_id}, pagina {page}: {e}")
-                break
-                
+        all_orders = []
+        self._get_paged('orders', params, all_orders.extend)
         return all_orders
 
     def get_viaggiatori_for_order(self, order_id: int) -> Optional[List[Dict]]:
-        """
-        Chiama l'endpoint API custom per ottenere i dati dei viaggiatori.
-        USA 'requests' DIRETTAMENTE PER EVITARE IL NAMESPACE wc/v3.
-        """
-        if not self.api:
+        """Dati dei viaggiatori dall'endpoint custom gitemania/v1, sulla stessa sessione delle chiamate wc/v3."""
+        if not self.custom_api:
             return None
         try:
-            # Costruisce l'URL corretto manualmente
-            url = f"{self.api.url}/wp-json/gitemania/v1/viaggiatori/{order_id}"
-            
-            # Esegue la richiesta con l'autenticazione corretta
-            response = requests.get(
-                url,
-                auth=(self.api.consumer_key, self.api.consumer_secret),
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
+            return self._get(self.custom_api, f"viaggiatori/{order_id}").json()
+        except requests.HTTPError as e:
+            # 404: l'ordine non ha dati viaggiatori, è un risultato (vuoto) e non un errore da riprovare
+            if e.response is not None and e.response.status_code == 404: return []
+            print(f"❌ Errore nel recuperare i dati viaggiatori per l'ordine {order_id}: {e}")
+            return None
         except Exception as e:
             print(f"❌ Errore nel recuperare i dati viaggiatori per l'ordine {order_id}: {e}")
             return None